@@ -1,16 +1,18 @@
 import os
 import logging
-from flask import Flask, render_template, request, jsonify, send_file, flash, redirect, url_for, session
+from flask import Flask, Response, render_template, request, jsonify, send_file, flash, redirect, url_for, session
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 import uuid
+import json
+from upload import MAX_IMAGE_PIXELS, UploadRequest, UploadRejected, ingest_file, multi_file_uploads
 from datetime import datetime, timezone, timedelta
-from dem_processor import DEMProcessor
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging (LOG_LEVEL=DEBUG for the per-stage processing details)
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
 
 class Base(DeclarativeBase):
     pass
@@ -18,7 +20,7 @@ class Base(DeclarativeBase):
 db = SQLAlchemy(model_class=Base)
 
 # Create the app
-app = Flask(_name_)
+app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
@@ -33,11 +35,25 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
 UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'outputs'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tiff', 'tif'}
-MAX_FILE_SIZE = 16 * 1024 * 1024  # 16MB
+MAX_FILE_SIZE = int(os.environ.get('DEM_MAX_UPLOAD_MB', 256)) * 1024 * 1024
+MAX_JOB_WORKERS = os.cpu_count() or 1  # Upper bound for per-job parallel tile workers
+CACHE_FOLDER = os.path.join(OUTPUT_FOLDER, 'cache')
+TILES_FOLDER = os.path.join(OUTPUT_FOLDER, 'tiles')
+TILE_MAX_AGE = 7 * 24 * 3600  # Tiles and meshes of a finished job never change
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('DEM_CACHE_MAX_MB', 2048)) * 1024 * 1024
+BATCH_ROOT = os.environ.get('DEM_BATCH_ROOT')  # Server directory batches may read from (disabled when unset)
+MAX_BATCH_ITEMS = int(os.environ.get('DEM_MAX_BATCH_ITEMS', 1000))
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
+app.config['CACHE_FOLDER'] = CACHE_FOLDER
+app.config['TILES_FOLDER'] = TILES_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
+app.config['MAX_IMAGE_PIXELS'] = MAX_IMAGE_PIXELS
+app.config['BATCH_ROOT'] = BATCH_ROOT
+
+# Uploads are hashed, validated and stored while they stream in (see upload.py)
+app.request_class = UploadRequest
 
 # Ensure upload and output directories exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -47,22 +63,175 @@ os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 db.init_app(app)
 
 with app.app_context():
-    # Import models to create tables
+    # Import models to create tables, then add the columns older databases lack
     import models
+    from schema import upgrade_schema
     db.create_all()
+    upgrade_schema(db)
+
+# Content-addressed cache of finished results (see result_cache.py)
+from result_cache import ResultCache, file_sha256, cache_key
+from artifacts import ARTIFACTS, artifact_filename, ensure_artifact, parse_formats
+from tiles import TilePyramid
+from mesh import DEFAULT_MESH_SIZE, ensure_mesh, fill_viewer, lod_size, plotly_bundle_path
+from terrain_mesh import DEFAULT_MESH_MAX_ERROR
+from profiling import StageProfiler
+from batch import collect_inputs
+import dem_store
+import metrics
+from metrics import JOBS, UPLOAD_BYTES, UPLOADS_REJECTED, CACHE_REQUESTS, observe_stage_metrics
+app.extensions['result_cache'] = ResultCache(CACHE_FOLDER, RESULT_CACHE_MAX_BYTES)
+app.extensions['dem_store'] = dem_store.DEMStore()  # Memory-mapped DEMs of the query API
+
+# Load OpenCV and Pillow now rather than on the first upload or tile request
+# (with `gunicorn --preload` the forked workers share them; see warmup.py)
+if os.environ.get('DEM_PRELOAD') == '1':
+    from warmup import warm_up
+    warm_up(processing=False)
+
+# Optionally run the job worker pool inside the web process (otherwise run `python worker.py`)
+if os.environ.get('DEM_EMBEDDED_WORKER') == '1':
+    from worker import JobWorkerPool
+    JobWorkerPool(app).start()
 
 # Template context processor to make timezone functions available in templates
 @app.context_processor
 def utility_processor():
-    return dict(timezone=timezone, timedelta=timedelta)
+    return dict(timezone=timezone, timedelta=timedelta, max_upload_mb=MAX_FILE_SIZE // (1024 * 1024))
 
 def allowed_file(filename):
     """Check if the uploaded file has an allowed extension."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def read_job_parameters(form, defaults=None):
+    """Parse processing parameters from a submitted form."""
+    from dem_processor import SOLVERS, DEFAULT_SUN_AZIMUTH, DEFAULT_SUN_ELEVATION
+    from sfs_solver import REFLECTANCE_MODELS
+    defaults = defaults or {}
+    eager_formats = form.getlist('eager_formats') if 'eager_formats' in form else defaults.get('eager_formats')
+    mesh_max_error = form.get('mesh_max_error') or defaults.get('mesh_max_error')
+    mesh_max_error = DEFAULT_MESH_MAX_ERROR if mesh_max_error is None else float(mesh_max_error)
+    if mesh_max_error < 0:
+        raise ValueError("Mesh error bound must not be negative")
+    solver = form.get('solver') or defaults.get('solver') or 'heuristic'
+    if solver not in SOLVERS:
+        raise ValueError(f"Unknown solver: {solver}")
+    reflectance = form.get('reflectance') or defaults.get('reflectance') or 'lambert'
+    if reflectance not in REFLECTANCE_MODELS:
+        raise ValueError(f"Unknown reflectance model: {reflectance}")
+    sun_azimuth = form.get('sun_azimuth') or defaults.get('sun_azimuth')
+    sun_azimuth = DEFAULT_SUN_AZIMUTH if sun_azimuth is None else float(sun_azimuth) % 360
+    sun_elevation = form.get('sun_elevation') or defaults.get('sun_elevation')
+    sun_elevation = DEFAULT_SUN_ELEVATION if sun_elevation is None else float(sun_elevation)
+    if not 0 < sun_elevation < 90:
+        raise ValueError("Sun elevation must be between 0 and 90 degrees")
+    return {
+        'scale_factor': float(form.get('scale_factor', defaults.get('scale_factor', 1.0))),
+        'smoothing': int(form.get('smoothing', defaults.get('smoothing', 3))),
+        'elevation_range': float(form.get('elevation_range', defaults.get('elevation_range', 255.0))),
+        'workers': min(max(int(form.get('workers', defaults.get('workers', 1))), 1), MAX_JOB_WORKERS),
+        'eager_formats': ','.join(parse_formats(eager_formats)),
+        'mesh_max_error': mesh_max_error,
+        'solver': solver,
+        'sun_azimuth': sun_azimuth,
+        'sun_elevation': sun_elevation,
+        'reflectance': reflectance,
+    }
+
+def create_job(job_id, filename, stored_filename, content_hash, params, batch_id=None):
+    """
+    Create a ProcessingJob for an uploaded file.
+    
+    Identical bytes with identical parameters reuse an earlier result from the
+    result cache; otherwise the job is queued as 'pending' for the worker pool.
+    Jobs submitted together through /batch share a batch_id.
+    
+    Returns:
+        Tuple (job, cache entry or None)
+    """
+    from models import ProcessingJob
+    from stage_cache import STAGES
+    
+    result_key = cache_key(content_hash, params)
+    result_cache = app.extensions['result_cache']
+    cached = result_cache.lookup(result_key)
+    
+    job = ProcessingJob(
+        id=job_id,
+        filename=filename,
+        filepath=stored_filename,
+        content_hash=content_hash,
+        batch_id=batch_id,
+        cache_key=result_key,
+        status='pending',
+        created_at=datetime.utcnow(),
+        **params
+    )
+    if cached is not None:
+        job.status = 'completed'
+        job.output_files = result_cache.materialize(cached, job_id, app.config['OUTPUT_FOLDER'])
+        job.processing_log = f"Reused cached result of job {cached.source_job_id}\n{cached.processing_log or ''}"
+        job.stage_report = json.dumps({name: 'reused' for name in STAGES})
+        job.statistics = cached.statistics
+        job.completed_at = datetime.utcnow()
+    db.session.add(job)
+    db.session.commit()
+    JOBS.inc(status='queued' if cached is None else 'cached')
+    return job, cached
+
+def record_generated_files(job, generated, metrics=None):
+    """Add lazily generated artifacts (and the metrics of their writers) to a job and its result cache entry."""
+    output_files = json.loads(job.output_files) if job.output_files else {}
+    output_files.update(generated)
+    job.output_files = json.dumps(output_files)
+    if metrics:
+        stage_metrics = json.loads(job.stage_metrics) if job.stage_metrics else {}
+        stage_metrics.update(metrics)
+        job.stage_metrics = json.dumps(stage_metrics)
+    db.session.commit()
+    
+    if job.cache_key:
+        try:
+            app.extensions['result_cache'].add_files(job.cache_key, job.id, app.config['OUTPUT_FOLDER'], generated)
+        except Exception as e:
+            logging.error(f"Could not cache generated files of job {job.id}: {str(e)}")
+            db.session.rollback()
+
+def batch_directory_inputs(directory, manifest=None):
+    """
+    Images of a server-side batch: a directory below BATCH_ROOT, or the
+    newline-separated manifest of files and directories relative to it.
+    """
+    root = app.config['BATCH_ROOT']
+    if not root:
+        raise ValueError("Server-side batch directories are disabled (set DEM_BATCH_ROOT)")
+    root = os.path.realpath(root)
+    base = os.path.join(root, directory)
+    names = [line.strip() for line in (manifest or '').splitlines()]
+    names = [name for name in names if name and not name.startswith('#')] or ['.']
+    
+    # Checked before and after expansion (directories may contain symlinks)
+    requested = [os.path.realpath(os.path.join(base, name)) for name in names]
+    for path in requested:
+        if os.path.commonpath([root, path]) != root:
+            raise ValueError("Batch paths must stay inside the batch root")
+    paths = collect_inputs(requested)
+    if any(os.path.commonpath([root, os.path.realpath(path)]) != root for path in paths):
+        raise ValueError("Batch paths must stay inside the batch root")
+    return paths
+
+def queue_batch_item(batch_id, filename, upload, content_hash, params):
+    """Store one ingested image of a batch under a new job id and queue the job."""
+    job_id = str(uuid.uuid4())
+    stored_filename = f"{job_id}.{filename.rsplit('.', 1)[1].lower()}"
+    upload.store(os.path.join(app.config['UPLOAD_FOLDER'], stored_filename))
+    job, _ = create_job(job_id, secure_filename(filename) or stored_filename, stored_filename, content_hash,
+                        params, batch_id=batch_id)
+    return job
+
 @app.route("/")
-def home():
-    return render_template("results_new.html")  # or your preferred homepage
+def index():
+    return render_template("index.html")
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
@@ -87,79 +256,181 @@ def upload_file():
         file_extension = filename.rsplit('.', 1)[1].lower()
         unique_filename = f"{unique_id}.{file_extension}"
         
-        # Save uploaded file
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(filepath)
-        
-        # Get processing parameters from form
-        scale_factor = float(request.form.get('scale_factor', 1.0))
-        smoothing = int(request.form.get('smoothing', 3))
-        elevation_range = float(request.form.get('elevation_range', 255.0))
+        # The upload was hashed and its header checked while it arrived; the
+        # worker decodes it, so a corrupt file fails its job
+        upload = file.stream
+        content_hash = upload.finish()
+        UPLOAD_BYTES.observe(upload.size)
+        params = read_job_parameters(request.form)
+        upload.store(os.path.join(app.config['UPLOAD_FOLDER'], unique_filename))
         
-        # Create processing record
-        from models import ProcessingJob
-        job = ProcessingJob(
-            id=unique_id,
-            filename=filename,
-            filepath=unique_filename,
-            scale_factor=scale_factor,
-            smoothing=smoothing,
-            elevation_range=elevation_range,
-            status='processing',
-            created_at=datetime.utcnow()
-        )
-        db.session.add(job)
-        db.session.commit()
+        # Queue the job
+        job, cached = create_job(unique_id, filename, unique_filename, content_hash, params)
         
         # Store job ID in session for tracking
         session['job_id'] = unique_id
         
-        # Process the image
-        processor = DEMProcessor()
-        try:
-            result = processor.process_image(
-                filepath, 
-                output_folder=app.config['OUTPUT_FOLDER'],
-                job_id=unique_id,
-                scale_factor=scale_factor,
-                smoothing=smoothing,
-                elevation_range=elevation_range
-            )
-            
-            # Update job status
-            job.status = 'completed'
-            job.output_files = result['output_files']
-            job.processing_log = result['log']
-            job.completed_at = datetime.utcnow()
-            db.session.commit()
-            
-            flash('DEM processing completed successfully!', 'success')
-            return redirect(url_for('results', job_id=unique_id))
-            
-        except Exception as e:
-            logging.error(f"Processing error: {str(e)}")
-            job.status = 'failed'
-            job.processing_log = f"Error: {str(e)}"
-            db.session.commit()
-            flash(f'Processing failed: {str(e)}', 'error')
-            return redirect(url_for('index'))
+        if cached is not None:
+            flash('DEM processing completed successfully! (cached result)', 'success')
+        else:
+            flash('Image uploaded. DEM processing has been queued.', 'success')
+        return redirect(url_for('results', job_id=unique_id))
             
+    except RequestEntityTooLarge:
+        raise
+    except UploadRejected as e:
+        UPLOADS_REJECTED.inc()
+        flash(f'Upload failed: {str(e)}', 'error')
+        return redirect(url_for('index'))
     except Exception as e:
         logging.error(f"Upload error: {str(e)}")
         flash(f'Upload failed: {str(e)}', 'error')
         return redirect(url_for('index'))
 
+@app.route('/batch', methods=['POST'])
+@multi_file_uploads
+def batch_upload():
+    """
+    Queue a batch of images that share one parameter set.
+    
+    The images are uploaded as several `files`, or named by a server-side
+    `directory` below DEM_BATCH_ROOT (optionally narrowed by a `manifest`
+    listing one path per line). Each accepted image becomes a job on the
+    worker pool; GET /batch/<batch_id> reports per-item progress.
+    """
+    try:
+        params = read_job_parameters(request.form)
+        uploads = [file for file in request.files.getlist('files') if file.filename]
+        directory = request.form.get('directory')
+        if uploads and directory:
+            raise ValueError("Send either files or a directory, not both")
+        if directory:
+            paths = batch_directory_inputs(directory, request.form.get('manifest'))
+        elif uploads:
+            paths = None
+        else:
+            raise ValueError("No images in batch")
+        if len(paths if paths is not None else uploads) > MAX_BATCH_ITEMS:
+            raise ValueError(f"A batch may contain at most {MAX_BATCH_ITEMS} images")
+    except RequestEntityTooLarge:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+    
+    batch_id = str(uuid.uuid4())
+    jobs = []
+    rejected = []
+    for index in range(len(paths if paths is not None else uploads)):
+        filename = os.path.basename(paths[index]) if paths is not None else uploads[index].filename
+        try:
+            if not allowed_file(filename):
+                raise UploadRejected("Invalid file format")
+            if paths is not None:
+                upload, content_hash = ingest_file(paths[index], app.config['UPLOAD_FOLDER'],
+                                                   app.config.get('MAX_IMAGE_PIXELS'))
+            else:
+                upload = uploads[index].stream
+                content_hash = upload.finish()
+                UPLOAD_BYTES.observe(upload.size)
+            try:
+                jobs.append(queue_batch_item(batch_id, filename, upload, content_hash, params))
+            finally:
+                upload.close()
+        except (UploadRejected, OSError) as e:
+            UPLOADS_REJECTED.inc()
+            rejected.append({'filename': filename, 'error': str(e)})
+    
+    logging.info(f"Batch {batch_id}: {len(jobs)} jobs queued, {len(rejected)} images rejected")
+    return jsonify({
+        'batch_id': batch_id,
+        'status_url': url_for('batch_status', batch_id=batch_id),
+        'jobs': [{'job_id': job.id, 'filename': job.filename, 'status': job.status} for job in jobs],
+        'rejected': rejected,
+    }), 202 if jobs else 400
+
+@app.route('/batch/<batch_id>')
+def batch_status(batch_id):
+    """Per-item progress and summary of a batch."""
+    from models import ProcessingJob
+    jobs = ProcessingJob.query.filter_by(batch_id=batch_id).order_by(ProcessingJob.created_at).all()
+    if not jobs:
+        return jsonify({'error': 'Unknown batch'}), 404
+    
+    counts = {status: 0 for status in ('pending', 'processing', 'completed', 'failed')}
+    items = []
+    for job in jobs:
+        counts[job.status] = counts.get(job.status, 0) + 1
+        seconds = None
+        if job.started_at and job.completed_at:
+            seconds = (job.completed_at - job.started_at).total_seconds()
+        items.append({
+            'job_id': job.id,
+            'filename': job.filename,
+            'status': job.status,
+            'seconds': seconds,
+            'results_url': url_for('results', job_id=job.id),
+        })
+    
+    return jsonify({
+        'batch_id': batch_id,
+        'done': counts['pending'] + counts['processing'] == 0,
+        'summary': dict(total=len(jobs), **counts),
+        'items': items,
+    })
+
 @app.route('/results/<job_id>')
 def results(job_id):
     """Display processing results."""
     from models import ProcessingJob
     job = ProcessingJob.query.get_or_404(job_id)
     
-    if job.status != 'completed':
-        flash('Processing not completed or failed', 'error')
-        return redirect(url_for('index'))
+    if job.status in ('pending', 'processing'):
+        return render_template('processing.html', job=job)
     
-    return render_template('results.html', job=job)
+    if job.status == 'failed':
+        return render_template('failed.html', job=job)
+    
+    # Interactive tiled preview when the DEM array is available
+    try:
+        tile_info = TilePyramid(app.config['OUTPUT_FOLDER'], job.id, app.config['TILES_FOLDER']).info()
+    except FileNotFoundError:
+        tile_info = None
+    
+    return render_template('results.html', job=job, tile_info=tile_info)
+
+@app.route('/rerun/<job_id>', methods=['POST'])
+def rerun_job(job_id):
+    """Process an earlier upload again with new parameters, reusing cached stages."""
+    from models import ProcessingJob
+    source = ProcessingJob.query.get_or_404(job_id)
+    
+    try:
+        params = read_job_parameters(request.form, defaults={
+            'scale_factor': source.scale_factor,
+            'smoothing': source.smoothing,
+            'elevation_range': source.elevation_range,
+            'workers': source.workers or 1,
+            'eager_formats': source.eager_formats,
+            'mesh_max_error': source.mesh_max_error,
+            'solver': source.solver,
+            'sun_azimuth': source.sun_azimuth,
+            'sun_elevation': source.sun_elevation,
+            'reflectance': source.reflectance,
+        })
+        content_hash = source.content_hash or file_sha256(
+            os.path.join(app.config['UPLOAD_FOLDER'], source.filepath))
+        job, cached = create_job(str(uuid.uuid4()), source.filename, source.filepath, content_hash, params)
+    except Exception as e:
+        logging.error(f"Rerun error: {str(e)}")
+        flash(f'Rerun failed: {str(e)}', 'error')
+        return redirect(url_for('results', job_id=job_id))
+    
+    session['job_id'] = job.id
+    if cached is not None:
+        flash('DEM processing completed successfully! (cached result)', 'success')
+    else:
+        flash('DEM processing has been queued with the new parameters.', 'success')
+    return redirect(url_for('results', job_id=job.id))
 
 @app.route('/download/<job_id>/<file_type>')
 def download_file(job_id, file_type):
@@ -171,31 +442,219 @@ def download_file(job_id, file_type):
         flash('File not available', 'error')
         return redirect(url_for('index'))
     
-    filename_map = {
-        'dem': f"{job_id}_dem.tif",
-        'ascii': f"{job_id}_dem.asc", 
-        'visualization': f"{job_id}_3d_plot.html",
-        'dem_image': f"{job_id}_dem_image.png",
-        'dem_topview': f"{job_id}_dem_image_topview.png",
-        'dem_grayscale': f"{job_id}_dem_image_grayscale.png"
-    }
-    
-    if file_type not in filename_map:
+    if file_type not in ARTIFACTS:
         flash('Invalid file type', 'error')
         return redirect(url_for('results', job_id=job_id))
     
-    filepath = os.path.join(app.config['OUTPUT_FOLDER'], filename_map[file_type])
-    
-    if not os.path.exists(filepath):
+    # Formats are rendered from the job's DEM the first time they are requested
+    profiler = StageProfiler()
+    try:
+        generated = ensure_artifact(app.config['OUTPUT_FOLDER'], job_id, file_type,
+                                    options={'max_error': job.mesh_max_error}, profiler=profiler)
+    except FileNotFoundError:
         flash('File not found', 'error')
         return redirect(url_for('results', job_id=job_id))
+    CACHE_REQUESTS.inc(cache='artifact', outcome='miss' if generated else 'hit')
+    if generated:
+        observe_stage_metrics(profiler.report())
+        record_generated_files(job, generated, profiler.report())
+    
+    filepath = os.path.join(app.config['OUTPUT_FOLDER'], artifact_filename(job_id, file_type))
     
-    # For HTML visualization files, serve inline for iframe viewing
+    # For HTML visualization files, serve inline for iframe viewing, pointed at this job's mesh
     if file_type == 'visualization':
-        return send_file(filepath, as_attachment=False, mimetype='text/html')
+        with open(filepath) as f:
+            return Response(fill_viewer(f.read(), url_for('dem_mesh', job_id=job_id)), mimetype='text/html')
     else:
         return send_file(filepath, as_attachment=True)
 
+@app.route('/tiles/<job_id>/<int:z>/<int:x>/<int:y>.png')
+def dem_tile(job_id, z, x, y):
+    """Serve one 256x256 XYZ preview tile, rendering it from the DEM on first request."""
+    pyramid = TilePyramid(app.config['OUTPUT_FOLDER'], job_id, app.config['TILES_FOLDER'])
+    try:
+        path = pyramid.render(z, x, y)
+    except FileNotFoundError:
+        path = None
+    if path is None:
+        return 'Tile not found', 404
+    
+    response = send_file(os.path.abspath(path), mimetype='image/png', max_age=TILE_MAX_AGE, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/mesh/<job_id>')
+def dem_mesh(job_id):
+    """Serve a job's surface as a quantised binary mesh for the 3D viewer."""
+    size = lod_size(request.args.get('size', DEFAULT_MESH_SIZE, type=int))
+    try:
+        path = ensure_mesh(app.config['OUTPUT_FOLDER'], job_id, size)
+    except FileNotFoundError:
+        return 'Mesh not found', 404
+    
+    response = send_file(os.path.abspath(path), mimetype='application/octet-stream',
+                         max_age=TILE_MAX_AGE, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+def completed_dem(job_id):
+    """Memory map of a completed job's DEM, or None."""
+    from models import ProcessingJob
+    job = db.session.get(ProcessingJob, job_id)
+    if job is None or job.status != 'completed':
+        return None
+    try:
+        return app.extensions['dem_store'].open(app.config['OUTPUT_FOLDER'], job_id)
+    except FileNotFoundError:
+        return None
+
+def parse_points(value):
+    """Points written as 'x,y;x,y;...'."""
+    points = []
+    for pair in (value or '').split(';'):
+        if pair.strip():
+            coordinates = pair.split(',')
+            if len(coordinates) != 2:
+                raise ValueError("Points must be written as x,y;x,y;...")
+            points.append((float(coordinates[0]), float(coordinates[1])))
+    return points
+
+def dem_query_response(payload, array=None):
+    """JSON payload, or `array` streamed as a .npy file with ?format=npy; immutable either way."""
+    output_format = request.args.get('format', 'json')
+    if output_format == 'npy' and array is not None:
+        response = Response(dem_store.npy_chunks(array), mimetype='application/octet-stream')
+    elif output_format == 'json':
+        response = jsonify(payload)
+    else:
+        return jsonify({'error': f"Unsupported format: {output_format}"}), 400
+    # A finished job's DEM never changes
+    response.cache_control.public = True
+    response.cache_control.max_age = TILE_MAX_AGE
+    return response
+
+@app.route('/api/dem/<job_id>')
+def dem_info(job_id):
+    """Size and elevation statistics of a job's DEM, and its query endpoints."""
+    dem = completed_dem(job_id)
+    if dem is None:
+        return jsonify({'error': 'DEM not found'}), 404
+    from artifacts import dem_stats_path
+    from dem_stats import load_statistics
+    statistics = load_statistics(dem_stats_path(app.config['OUTPUT_FOLDER'], job_id))
+    return dem_query_response({
+        'job_id': job_id,
+        'width': dem.shape[1],
+        'height': dem.shape[0],
+        'dtype': dem.dtype.name,
+        'statistics': statistics.summary() if statistics is not None else None,
+        'point_url': url_for('dem_point', job_id=job_id),
+        'profile_url': url_for('dem_line_profile', job_id=job_id),
+        'window_url': url_for('dem_window', job_id=job_id),
+    })
+
+@app.route('/api/dem/<job_id>/point')
+def dem_point(job_id):
+    """
+    Elevation at pixel position ?x=&y=, or at several ?points=x,y;x,y.
+    
+    Fractional positions are interpolated bilinearly.
+    """
+    dem = completed_dem(job_id)
+    if dem is None:
+        return jsonify({'error': 'DEM not found'}), 404
+    try:
+        if 'points' in request.args:
+            points = parse_points(request.args['points'])
+            if len(points) > dem_store.MAX_JSON_VALUES // 3:
+                raise ValueError(f"At most {dem_store.MAX_JSON_VALUES // 3} points per request")
+            xs, ys = [x for x, _ in points], [y for _, y in points]
+            elevation = dem_store.sample(dem, xs, ys)
+            return dem_query_response({'x': xs, 'y': ys, 'elevation': dem_store.json_values(elevation)})
+        x, y = request.args.get('x', type=float), request.args.get('y', type=float)
+        if x is None or y is None:
+            raise ValueError("Give x and y, or points")
+        elevation = dem_store.sample(dem, [x], [y])
+        return dem_query_response({'x': x, 'y': y, 'elevation': dem_store.json_values(elevation)[0]})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/dem/<job_id>/profile', methods=['GET', 'POST'])
+def dem_line_profile(job_id):
+    """
+    Bilinearly interpolated elevations along a polyline.
+    
+    The vertices are ?points=x,y;x,y;... (or a JSON body {"points": [[x, y],
+    ...], "spacing": 1} for long lines), sampled every ?spacing= pixels (1 by
+    default). JSON responses carry four values per sample and are limited to
+    DEM_QUERY_MAX_JSON_VALUES values; ?format=npy returns just the
+    elevations as a .npy file, for up to DEM_QUERY_MAX_VALUES samples.
+    """
+    dem = completed_dem(job_id)
+    if dem is None:
+        return jsonify({'error': 'DEM not found'}), 404
+    try:
+        body = request.get_json(silent=True) if request.method == 'POST' else None
+        if body is not None:
+            if not isinstance(body, dict):
+                raise ValueError('The JSON body must be an object like {"points": [[x, y], ...]}')
+            points, spacing = body.get('points') or [], float(body.get('spacing', 1.0))
+        else:
+            points, spacing = parse_points(request.args.get('points')), request.args.get('spacing', 1.0, type=float)
+        as_json = request.args.get('format', 'json') == 'json'
+        max_samples = dem_store.MAX_JSON_VALUES // 4 if as_json else dem_store.MAX_QUERY_VALUES
+        distance, xs, ys, elevation = dem_store.profile(dem, points, spacing, max_samples)
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
+    return dem_query_response({
+        'spacing': spacing,
+        'length': float(distance[-1]),
+        'distance': distance.tolist(),
+        'x': xs.tolist(),
+        'y': ys.tolist(),
+        'elevation': dem_store.json_values(elevation),
+    }, elevation.astype(dem.dtype))
+
+@app.route('/api/dem/<job_id>/window')
+def dem_window(job_id):
+    """
+    Elevations of the pixel window ?x0=&y0=&x1=&y1= (end exclusive), every ?step= pixels.
+    
+    JSON responses are limited to DEM_QUERY_MAX_JSON_VALUES values; ?format=npy
+    streams windows of up to DEM_QUERY_MAX_VALUES values straight from the
+    memory map as a .npy file.
+    """
+    dem = completed_dem(job_id)
+    if dem is None:
+        return jsonify({'error': 'DEM not found'}), 404
+    bounds = [request.args.get(name, type=int) for name in ('x0', 'y0', 'x1', 'y1')]
+    as_json = request.args.get('format', 'json') == 'json'
+    try:
+        if None in bounds:
+            raise ValueError("Give the window as integers x0, y0, x1 and y1")
+        step = request.args.get('step', 1, type=int)
+        values = dem_store.window(dem, *bounds, step=step)
+        if as_json and values.size > dem_store.MAX_JSON_VALUES:
+            raise ValueError(f"JSON windows may have at most {dem_store.MAX_JSON_VALUES} values; "
+                             "use format=npy or a larger step")
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    x0, y0, x1, y1 = bounds
+    payload = None
+    if as_json:
+        payload = {'x0': x0, 'y0': y0, 'x1': x1, 'y1': y1, 'step': step, 'width': values.shape[1],
+                   'height': values.shape[0], 'elevation': dem_store.json_values(values)}
+    return dem_query_response(payload, values)
+
+@app.route('/assets/plotly.min.js')
+def plotly_bundle():
+    """The plotly.js bundle shared by all 3D viewer pages."""
+    response = send_file(plotly_bundle_path(), mimetype='text/javascript', max_age=TILE_MAX_AGE, conditional=True)
+    response.cache_control.public = True
+    return response
+
 @app.route('/status/<job_id>')
 def get_status(job_id):
     """Get processing status (for AJAX requests)."""
@@ -205,15 +664,54 @@ def get_status(job_id):
     return jsonify({
         'status': job.status,
         'log': job.processing_log,
+        'attempts': job.attempts,
+        'stage_metrics': [dict(stage=stage, **metrics) for stage, metrics in job.metrics],
+        'statistics': job.stats,
         'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
         'completed_at': job.completed_at.isoformat() if job.completed_at else None
     })
 
+def job_status_counts():
+    """Number of jobs per status (pending is the queue depth)."""
+    from sqlalchemy import select, func
+    from models import ProcessingJob
+    counts = dict.fromkeys(('pending', 'processing', 'completed', 'failed'), 0)
+    with app.app_context():  # Also collected outside requests by a standalone worker
+        rows = db.session.execute(select(ProcessingJob.status, func.count()).group_by(ProcessingJob.status)).all()
+    counts.update(rows)
+    return {(status,): count for status, count in counts.items()}
+
+def disk_usage():
+    """Bytes stored in the upload and output folders."""
+    return {
+        ('uploads',): metrics.directory_size(app.config['UPLOAD_FOLDER']),
+        ('outputs',): metrics.directory_size(app.config['OUTPUT_FOLDER']),
+    }
+
+def result_cache_usage():
+    """Bytes counted against the result cache budget, and bytes only the cache still holds."""
+    with app.app_context():
+        stats = app.extensions['result_cache'].stats()
+    return {('budgeted',): stats['size_bytes'], ('exclusive',): stats['exclusive_bytes']}
+
+# Collected on scrape, but at most once per DEM_METRICS_REFRESH seconds
+metrics.Gauge('dem_jobs', 'Jobs in the database by status', ['status'], function=metrics.throttled(job_status_counts))
+metrics.Gauge('dem_disk_usage_bytes', 'Disk space used by folder', ['folder'], function=metrics.throttled(disk_usage))
+metrics.Gauge('dem_result_cache_bytes', 'Result cache size: budgeted entry bytes and bytes held only by the cache',
+              ['kind'], function=metrics.throttled(result_cache_usage))
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Metrics of this process in the Prometheus text format."""
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.errorhandler(413)
 def too_large(e):
     """Handle file too large error."""
-    flash("File is too large. Maximum size is 16MB.", 'error')
+    UPLOADS_REJECTED.inc()
+    flash(f"File is too large. Maximum size is {MAX_FILE_SIZE // (1024 * 1024)}MB.", 'error')
     return redirect(url_for('index'))
 
-if _name_ == '_main_':
+if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,189 @@
+"""
+On-demand generation of downloadable DEM artifacts.
+
+Processing only persists the core DEM as ``<job_id>_dem.npy``. Every download
+format (PNG renderings, GeoTIFF, plain or gzipped ASCII grid, 3D plot, terrain
+meshes and terrain derivatives) is rendered from that array the first time it is requested and
+kept next to it afterwards. Jobs can ask for selected formats to be generated
+eagerly by the worker instead. Writers that take job options, such as the
+meshes' error bound, receive them from the job.
+"""
+import os
+import shutil
+import logging
+import tempfile
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from profiling import measure
+
+Artifact = namedtuple('Artifact', ['output_key', 'suffix', 'writer', 'writer_suffix', 'options'], defaults=((),))
+Artifact.__doc__ = """
+Output file of a download type, the DEMProcessor writer producing it and the
+job options passed on to the writer as keyword arguments.
+"""
+
+# Download types (the `file_type` of /download) and how to produce them. The
+# three PNGs come from a single _save_dem_image call, and all terrain
+# derivatives (see terrain_derivatives.py) from one _save_terrain_derivatives call.
+ARTIFACTS = {
+    'dem': Artifact('dem_tiff', '_dem.tif', '_save_geotiff', '_dem.tif'),
+    'ascii': Artifact('dem_ascii', '_dem.asc', '_save_ascii_grid', '_dem.asc'),
+    'ascii_gz': Artifact('dem_ascii_gz', '_dem.asc.gz', '_save_ascii_grid', '_dem.asc.gz'),
+    'visualization': Artifact('visualization', '_3d_plot.html', '_create_3d_visualization', '_3d_plot.html'),
+    'dem_image': Artifact('dem_image', '_dem_image.png', '_save_dem_image', '_dem_image.png'),
+    'dem_topview': Artifact('dem_topview', '_dem_image_topview.png', '_save_dem_image', '_dem_image.png'),
+    'dem_grayscale': Artifact('dem_grayscale', '_dem_image_grayscale.png', '_save_dem_image', '_dem_image.png'),
+    'mesh_obj': Artifact('mesh_obj', '_terrain.obj', '_save_terrain_mesh', '_terrain.obj', ('max_error',)),
+    'mesh_ply': Artifact('mesh_ply', '_terrain.ply', '_save_terrain_mesh', '_terrain.ply', ('max_error',)),
+    'mesh_glb': Artifact('mesh_glb', '_terrain.glb', '_save_terrain_mesh', '_terrain.glb', ('max_error',)),
+    'slope': Artifact('slope_tiff', '_slope.tif', '_save_terrain_derivatives', '_slope.tif'),
+    'aspect': Artifact('aspect_tiff', '_aspect.tif', '_save_terrain_derivatives', '_slope.tif'),
+    'curvature': Artifact('curvature_tiff', '_curvature.tif', '_save_terrain_derivatives', '_slope.tif'),
+    'roughness': Artifact('roughness_tiff', '_roughness.tif', '_save_terrain_derivatives', '_slope.tif'),
+    'hillshade': Artifact('hillshade', '_hillshade.png', '_save_terrain_derivatives', '_slope.tif'),
+    'derivative_stats': Artifact('derivative_stats', '_derivatives.json', '_save_terrain_derivatives', '_slope.tif'),
+}
+
+# Core DEM every artifact is rendered from
+DEM_ARRAY_SUFFIX = '_dem.npy'
+
+# Statistics of the core DEM (see dem_stats.py), shared by the writers
+DEM_STATS_SUFFIX = '_dem_stats.json'
+
+# Formats generated by the worker when a job does not choose its own
+DEFAULT_EAGER_FORMATS = os.environ.get('DEM_EAGER_FORMATS', '')
+
+# Concurrent requests for one (output folder, job, writer) render once. Keys
+# share a fixed set of striped locks, so the table does not grow with the
+# number of jobs; unrelated keys on the same stripe merely wait for each other
+LOCK_STRIPES = 64
+_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+
+def parse_formats(value):
+    """Turn a comma-separated list (or iterable) of download types into a validated tuple."""
+    if value is None:
+        value = DEFAULT_EAGER_FORMATS
+    if isinstance(value, str):
+        value = value.split(',')
+    formats = tuple(dict.fromkeys(name.strip() for name in value if name and name.strip()))
+    unknown = [name for name in formats if name not in ARTIFACTS]
+    if unknown:
+        raise ValueError(f"Unknown output format(s): {', '.join(unknown)}")
+    return formats
+
+
+def artifact_filename(job_id, file_type):
+    """File name of a download type for a job."""
+    return f"{job_id}{ARTIFACTS[file_type].suffix}"
+
+
+def dem_array_path(output_folder, job_id):
+    return os.path.join(output_folder, f"{job_id}{DEM_ARRAY_SUFFIX}")
+
+
+def dem_stats_path(output_folder, job_id):
+    return os.path.join(output_folder, f"{job_id}{DEM_STATS_SUFFIX}")
+
+
+def remove_job_outputs(output_folder, job_id):
+    """
+    Delete a job's DEM array, statistics, rendered formats and viewer meshes.
+
+    Called before a job is (re)computed, so files of an earlier run under the
+    same job id are not mistaken for the new results.
+
+    Returns:
+        Names of the removed files
+    """
+    from mesh import MESH_LOD_SIZES, mesh_path
+    suffixes = {DEM_ARRAY_SUFFIX, DEM_STATS_SUFFIX}
+    for artifact in ARTIFACTS.values():
+        suffixes.update((artifact.suffix, artifact.writer_suffix))
+    paths = [os.path.join(output_folder, f"{job_id}{suffix}") for suffix in sorted(suffixes)]
+    paths += [mesh_path(output_folder, job_id, size) for size in MESH_LOD_SIZES]
+    removed = []
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        removed.append(os.path.basename(path))
+    return removed
+
+
+def _writer_lock(output_folder, job_id, writer):
+    return _locks[hash((os.path.abspath(output_folder), job_id, writer)) % LOCK_STRIPES]
+
+
+def ensure_artifact(output_folder, job_id, file_type, processor=None, dem_data=None, options=None, profiler=None):
+    """
+    Make sure a download type exists for a job, rendering it from the DEM if needed.
+
+    Args:
+        output_folder: Directory holding the job's files
+        job_id: Job identifier
+        file_type: Key of ARTIFACTS
+        processor: DEMProcessor providing the writer (created when omitted)
+        dem_data: Already loaded DEM; read from ``<job_id>_dem.npy`` otherwise
+        options: Job options (e.g. ``max_error``); those the writer accepts
+            are passed to it, unset ones fall back to the writer's defaults
+        profiler: Optional StageProfiler recording the writer as ``output:<file_type>``
+
+    Returns:
+        Dictionary of output_files entries created by this call (empty if the
+        file already existed)
+
+    Raises:
+        FileNotFoundError: If neither the artifact nor the core DEM exists
+    """
+    artifact = ARTIFACTS[file_type]
+    if os.path.exists(os.path.join(output_folder, artifact_filename(job_id, file_type))):
+        return {}
+
+    with _writer_lock(output_folder, job_id, artifact.writer):
+        # Another request may have rendered it while we waited
+        if os.path.exists(os.path.join(output_folder, artifact_filename(job_id, file_type))):
+            return {}
+
+        if processor is None:
+            from dem_processor import DEMProcessor
+            processor = DEMProcessor()
+        if dem_data is None:
+            dem_path = dem_array_path(output_folder, job_id)
+            if not os.path.exists(dem_path):
+                raise FileNotFoundError(f"No DEM array for job {job_id}")
+            dem_data = np.load(dem_path, mmap_mode='r')
+            # Writers normalise with the statistics saved by the worker instead of rescanning
+            from dem_stats import load_statistics
+            statistics = load_statistics(dem_stats_path(output_folder, job_id))
+            if statistics is not None:
+                processor.share_statistics(dem_data, statistics)
+
+        logging.getLogger(__name__).info(f"Generating {file_type} for job {job_id}")
+        # Render into a private directory and move the files into place, so
+        # readers never see a partially written artifact
+        scratch = tempfile.mkdtemp(prefix=f".{job_id}-", dir=output_folder)
+        try:
+            writer_path = os.path.join(scratch, f"{job_id}{artifact.writer_suffix}")
+            writer = getattr(processor, artifact.writer)
+            kwargs = {name: options[name] for name in artifact.options
+                      if options and options.get(name) is not None}
+            with measure(profiler, f'output:{file_type}'):
+                if artifact.writer == '_create_3d_visualization':
+                    writer(dem_data, writer_path, job_id)
+                else:
+                    writer(dem_data, writer_path, **kwargs)
+            for name in os.listdir(scratch):
+                os.replace(os.path.join(scratch, name), os.path.join(output_folder, name))
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    return {
+        other.output_key: f"{job_id}{other.suffix}"
+        for other in ARTIFACTS.values()
+        if other.writer == artifact.writer and os.path.exists(os.path.join(output_folder, f"{job_id}{other.suffix}"))
+    }
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Batch conversion of whole directories of images.
+
+The command line entry point runs DEMProcessor over a manifest of images with
+one shared parameter set, without the web application or its database:
+
+    python batch.py orbit_0412/ --output dems/ --formats dem,mesh_glb --jobs 2
+    python batch.py --manifest tiles.txt --output dems/ --smoothing 5
+
+Items flow through a three-stage pipeline connected by bounded queues. One
+thread decodes the next images, a pool of `jobs` threads computes DEMs, and
+one thread writes the requested download formats. Decoding of the next image
+therefore overlaps with computing the current one and writing the previous
+one. Per-item progress is printed as items finish, and a JSON summary report
+is written to the output folder. Rerunning into the same folder replaces the
+DEM and formats of every item processed again.
+
+The web application queues the same kind of batch on its worker pool through
+POST /batch (see app.py); both use collect_inputs() to expand the manifest.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from collections import namedtuple
+
+# Image extensions picked up from directories
+BATCH_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff')
+
+# Decoded images and computed DEMs waiting for the next stage (per queue)
+DEFAULT_PREFETCH = int(os.environ.get('DEM_BATCH_PREFETCH', 2))
+
+REPORT_FILENAME = 'batch_report.json'
+
+BatchItem = namedtuple('BatchItem', ['index', 'path', 'name'])
+BatchItem.__doc__ = "Input image of a batch and the job id its outputs are named after."
+
+_DONE = object()  # Queue sentinel
+
+
+def read_manifest(path):
+    """
+    Read a manifest file: one image or directory path per line.
+
+    Blank lines and lines starting with '#' are ignored; relative paths are
+    relative to the manifest's directory.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path) as f:
+        lines = [line.strip() for line in f]
+    return [os.path.join(base, line) for line in lines if line and not line.startswith('#')]
+
+
+def collect_inputs(paths):
+    """
+    Expand files and directories into the sorted list of images to process.
+
+    Directories contribute their image files (non-recursively, by extension);
+    files are taken as given, in order, and duplicates are dropped.
+
+    Raises:
+        FileNotFoundError: If a path does not exist
+    """
+    inputs = []
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(name for name in os.listdir(path)
+                           if name.lower().endswith(BATCH_EXTENSIONS) and not name.startswith('.'))
+            inputs.extend(os.path.join(path, name) for name in names)
+        elif os.path.isfile(path):
+            inputs.append(path)
+        else:
+            raise FileNotFoundError(f"No such file or directory: {path}")
+    return list(dict.fromkeys(inputs))
+
+
+def batch_items(paths):
+    """Number input paths and give each a unique output name derived from its file name."""
+    items = []
+    used = set()
+    for index, path in enumerate(paths):
+        stem = re.sub(r'[^A-Za-z0-9_.-]+', '_', os.path.splitext(os.path.basename(path))[0]) or 'image'
+        name = stem
+        suffix = 1
+        while name in used:
+            suffix += 1
+            name = f"{stem}_{suffix}"
+        used.add(name)
+        items.append(BatchItem(index, path, name))
+    return items
+
+
+class BatchRunner:
+    """Pipelined decode / compute / write of a list of images with shared parameters."""
+
+    def __init__(self, output_folder, params=None, formats=(), jobs=1, prefetch=None, progress=None):
+        """
+        Args:
+            output_folder: Directory receiving ``<name>_dem.npy`` and the formats
+            params: DEMProcessor.process_image keyword arguments shared by all
+                items (scale_factor, smoothing, elevation_range, workers, ...)
+            formats: Download types (keys of artifacts.ARTIFACTS) written per item
+            jobs: Number of images computed concurrently
+            prefetch: Capacity of the decoded and computed queues (defaults to
+                DEM_BATCH_PREFETCH); bounds the images held in memory
+            progress: Optional callable(record, done, total) invoked as items finish
+        """
+        from artifacts import parse_formats
+        self.output_folder = output_folder
+        self.params = dict(params or {})
+        self.formats = parse_formats(formats)
+        self.jobs = max(int(jobs), 1)
+        self.prefetch = max(int(DEFAULT_PREFETCH if prefetch is None else prefetch), 1)
+        self.progress = progress
+        self.logger = logging.getLogger(__name__)
+        os.makedirs(output_folder, exist_ok=True)
+
+    def run(self, paths):
+        """
+        Process every image and return the summary report.
+
+        Failures of single items are recorded in the report; they do not stop
+        the batch.
+        """
+        items = batch_items(paths)
+        decoded = queue.Queue(maxsize=self.prefetch)
+        computed = queue.Queue(maxsize=self.prefetch)
+        records = []
+        started = time.perf_counter()
+
+        threads = [threading.Thread(target=self._decode, args=(items, decoded), name='batch-decode')]
+        threads += [threading.Thread(target=self._compute, args=(decoded, computed), name=f'batch-compute-{n}')
+                    for n in range(self.jobs)]
+        for thread in threads:
+            thread.start()
+
+        # Writing runs in this thread until every compute thread has finished
+        from dem_processor import DEMProcessor
+        writer = DEMProcessor()
+        remaining = self.jobs
+        while remaining:
+            entry = computed.get()
+            if entry is _DONE:
+                remaining -= 1
+                continue
+            record = self._write(writer, *entry)
+            records.append(record)
+            if self.progress is not None:
+                self.progress(record, len(records), len(items))
+        for thread in threads:
+            thread.join()
+
+        return self._report(records, time.perf_counter() - started)
+
+    def _decode(self, items, decoded):
+        """Decode stage: read images ahead of the compute threads."""
+        from dem_processor import DEMProcessor
+        reader = DEMProcessor()
+        try:
+            for item in items:
+                record = {'input': item.path, 'name': item.name}
+                start = time.perf_counter()
+                try:
+                    image = reader._load_grayscale(item.path)
+                except Exception as e:
+                    image = None
+                    record['error'] = f"Decoding failed: {str(e)}"
+                record['decode_seconds'] = time.perf_counter() - start
+                decoded.put((item, image, record))
+        finally:
+            for _ in range(self.jobs):
+                decoded.put(_DONE)
+
+    def _compute(self, decoded, computed):
+        """Compute stage: one DEMProcessor per thread (its scratch buffers are not shared)."""
+        from dem_processor import DEMProcessor
+        processor = DEMProcessor()
+        try:
+            while True:
+                entry = decoded.get()
+                if entry is _DONE:
+                    break
+                item, image, record = entry
+                if image is not None:
+                    start = time.perf_counter()
+                    result = processor.process_image(item.path, self.output_folder, item.name, image=image,
+                                                     formats=(), **self.params)
+                    record['compute_seconds'] = time.perf_counter() - start
+                    if result['status'] == 'success':
+                        record['output_files'] = json.loads(result['output_files'])
+                        record['statistics'] = result['statistics']
+                    else:
+                        record['error'] = result['error']
+                    del image, result
+                computed.put((item, record))
+        finally:
+            computed.put(_DONE)
+
+    def _write(self, writer, item, record):
+        """Write stage: render the requested formats from the saved DEM."""
+        import numpy as np
+        from artifacts import dem_array_path, ensure_artifact
+        if 'error' not in record and self.formats:
+            start = time.perf_counter()
+            options = {'max_error': self.params.get('mesh_max_error')}
+            file_type = self.formats[0]
+            try:
+                # One DEM array per item lets the writer memoize shared work (the mesh)
+                dem_data = np.load(dem_array_path(self.output_folder, item.name), mmap_mode='r')
+                for file_type in self.formats:
+                    record['output_files'].update(ensure_artifact(
+                        self.output_folder, item.name, file_type, processor=writer, dem_data=dem_data,
+                        options=options))
+            except Exception as e:
+                record['error'] = f"Writing {file_type} failed: {str(e)}"
+            record['write_seconds'] = time.perf_counter() - start
+        record['status'] = 'failed' if 'error' in record else 'completed'
+        if record['status'] == 'failed':
+            self.logger.error(f"Batch item {item.path}: {record['error']}")
+        record['index'] = item.index
+        return record
+
+    def _report(self, records, seconds):
+        records.sort(key=lambda record: record.pop('index'))
+        completed = sum(record['status'] == 'completed' for record in records)
+        return {
+            'summary': {
+                'total': len(records),
+                'completed': completed,
+                'failed': len(records) - completed,
+                'seconds': round(seconds, 3),
+                'images_per_second': round(len(records) / seconds, 3) if seconds > 0 else None,
+            },
+            'parameters': self.params,
+            'formats': list(self.formats),
+            'items': records,
+        }
+
+
+def print_progress(record, done, total):
+    """Progress line of a finished batch item."""
+    timings = ', '.join(f"{stage} {record[f'{stage}_seconds']:.2f}s"
+                        for stage in ('decode', 'compute', 'write') if f'{stage}_seconds' in record)
+    outcome = 'ok' if record['status'] == 'completed' else f"FAILED: {record['error']}"
+    print(f"[{done:>{len(str(total))}}/{total}] {record['name']}: {outcome} ({timings})", flush=True)
+
+
+def main(argv=None):
+    from dem_processor import SOLVERS, DEFAULT_SUN_AZIMUTH, DEFAULT_SUN_ELEVATION
+    from sfs_solver import REFLECTANCE_MODELS
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='*', help='Image files and/or directories of images')
+    parser.add_argument('--manifest', help='File listing one image or directory per line')
+    parser.add_argument('--output', required=True, help='Output directory')
+    parser.add_argument('--scale-factor', type=float, default=1.0)
+    parser.add_argument('--smoothing', type=int, default=3)
+    parser.add_argument('--elevation-range', type=float, default=255.0)
+    parser.add_argument('--mesh-max-error', type=float, help='Vertical error bound (m) of mesh formats')
+    parser.add_argument('--solver', choices=SOLVERS, default='heuristic',
+                        help='Height estimator; sfs is the shape-from-shading solver')
+    parser.add_argument('--sun-azimuth', type=float, default=DEFAULT_SUN_AZIMUTH,
+                        help='Sun azimuth of --solver sfs (degrees clockwise from image up)')
+    parser.add_argument('--sun-elevation', type=float, default=DEFAULT_SUN_ELEVATION,
+                        help='Sun elevation of --solver sfs (degrees)')
+    parser.add_argument('--reflectance', choices=REFLECTANCE_MODELS, default='lambert',
+                        help='Reflectance model of --solver sfs')
+    parser.add_argument('--workers', type=int, default=1, help='Parallel tile workers per image')
+    parser.add_argument('--formats', default='', help='Comma-separated download types to write, e.g. dem,mesh_glb')
+    parser.add_argument('--jobs', type=int, default=1, help='Images computed concurrently')
+    parser.add_argument('--prefetch', type=int, default=None, help='Images decoded ahead of the compute threads')
+    parser.add_argument('--report', help=f'Summary report path (default: <output>/{REPORT_FILENAME})')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    paths = list(args.inputs)
+    if args.manifest:
+        paths.extend(read_manifest(args.manifest))
+    try:
+        inputs = collect_inputs(paths)
+    except FileNotFoundError as e:
+        parser.error(str(e))
+    if not inputs:
+        parser.error('no input images')
+
+    params = {
+        'scale_factor': args.scale_factor,
+        'smoothing': args.smoothing,
+        'elevation_range': args.elevation_range,
+        'workers': args.workers,
+        'mesh_max_error': args.mesh_max_error,
+        'solver': args.solver,
+        'sun_azimuth': args.sun_azimuth,
+        'sun_elevation': args.sun_elevation,
+        'reflectance': args.reflectance,
+    }
+    try:
+        runner = BatchRunner(args.output, params, formats=args.formats, jobs=args.jobs,
+                             prefetch=args.prefetch, progress=print_progress)
+    except ValueError as e:
+        parser.error(str(e))
+    report = runner.run(inputs)
+
+    report_path = args.report or os.path.join(args.output, REPORT_FILENAME)
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2, default=float)
+    summary = report['summary']
+    print(f"{summary['completed']}/{summary['total']} images converted in {summary['seconds']:.1f}s "
+          f"({summary['failed']} failed); report: {report_path}")
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
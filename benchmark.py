@@ -0,0 +1,558 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the DEM processing pipeline.
+
+Usage:
+    python benchmark.py parallel --size 4096 --workers 1 2 4 8
+    python benchmark.py kernel --size 8192 --precision float32
+    python benchmark.py ascii --size 2048
+    python benchmark.py geotiff --size 4096
+    python benchmark.py render --size 4096
+    python benchmark.py mesh --size 8192 --max-error 0.5 1 2 5
+    python benchmark.py suite --sizes 512 2048 8192 --repeat 3 --output bench.json
+    python benchmark.py suite --compare baseline.json --threshold 0.1
+    python benchmark.py compare baseline.json bench.json
+    python benchmark.py startup --repeat 3
+
+The suite runs the whole pipeline on seeded synthetic terrain (see
+synthetic_terrain.py), records the wall time, CPU time, peak memory growth and
+bytes written of every stage and output writer, and saves them as JSON. A
+comparison against an earlier result exits with status 1 when a stage got
+slower (or a case used more memory) by more than the threshold. The parallel
+benchmark exits with status 1 when a tiled DEM differs from the in-memory one
+by more than tiling.tolerance() of the elevation range.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from dem_processor import DEMProcessor
+from tiling import TiledHeightFromShading, tolerance
+
+SUITE_SIZES = (512, 1024, 2048, 4096)
+SUITE_FORMATS = 'dem,ascii_gz,dem_image,visualization,mesh_glb,mesh_obj,mesh_ply'
+
+# Relative slowdown reported as a regression, and the absolute changes below
+# which differences are treated as noise
+REGRESSION_THRESHOLD = 0.10
+MIN_REGRESSION_SECONDS = 0.05
+MIN_REGRESSION_BYTES = 16 * 1024 * 1024
+
+
+def synthetic_surface(size, seed=0):
+    """Smoothed random surface used as benchmark input."""
+    rng = np.random.default_rng(seed)
+    noise = rng.random((size, size), dtype=np.float32)
+    surface = cv2.GaussianBlur(noise, (0, 0), size / 64) + 0.2 * noise
+    surface = (surface - surface.min()) / (surface.max() - surface.min())
+    return (surface * 255).astype(np.uint8)
+
+
+def synthetic_dem(size, elevation_range=255.0, seed=0):
+    """Smooth multi-scale random terrain in meters, used where the DEM itself is the input."""
+    rng = np.random.default_rng(seed)
+    dem = np.zeros((size, size), dtype=np.float32)
+    for sigma, weight in ((size / 32, 1.0), (size / 256, 0.15), (size / 2048, 0.02)):
+        octave = cv2.GaussianBlur(rng.random((size, size), dtype=np.float32), (0, 0), max(sigma, 0.5))
+        dem += weight * (octave - octave.mean()) / octave.std()
+    return (dem - dem.min()) * np.float32(elevation_range / (dem.max() - dem.min()))
+
+
+def timed(func, repeat):
+    """Best wall time of `repeat` calls, and the last result."""
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_parallel(args):
+    """Speedup and accuracy of the tiled height-from-shading engine per worker count."""
+    processor = DEMProcessor()
+    image = synthetic_surface(args.size)
+    enhanced = processor._enhance_contrast(image)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        baseline, reference = timed(
+            lambda: processor._height_from_shading(enhanced, 1.0, args.smoothing, 255.0), args.repeat
+        )
+        bound = tolerance(args.smoothing)
+        elevation_range = float(reference.max() - reference.min()) or 1.0
+        worst = 0.0
+        print(f"Image: {args.size}x{args.size}, smoothing {args.smoothing}, {os.cpu_count()} CPUs")
+        print(f"{'mode':<22}{'seconds':>10}{'speedup':>10}{'max |diff|':>14}{'of range':>12}")
+        print(f"{'in-memory':<22}{baseline:>10.3f}{1.0:>10.2f}{0.0:>14.2e}{0.0:>12.2e}")
+
+        for workers in args.workers:
+            engine = TiledHeightFromShading(processor, workers=workers, executor=args.executor)
+            output = os.path.join(tmp, f"dem_{workers}.npy")
+            seconds, dem = timed(
+                lambda: processor._scale_dem(engine.run(enhanced, output, args.smoothing), 255.0), args.repeat
+            )
+            diff = float(np.abs(np.asarray(dem) - reference).max())
+            worst = max(worst, diff / elevation_range)
+            label = f"tiled {args.executor} x{workers}"
+            print(f"{label:<22}{seconds:>10.3f}{baseline / seconds:>10.2f}{diff:>14.2e}{diff / elevation_range:>12.2e}")
+            del dem
+
+    if worst > bound:
+        print(f"\nTiled DEMs differ by {worst:.2e} of the elevation range, more than {bound:.0e}")
+        return 1
+    return 0
+
+
+def bench_kernel(args):
+    """Wall time and peak RSS of in-memory height-from-shading (run once per process)."""
+    image = synthetic_surface(args.size)
+    processor = DEMProcessor(precision=args.precision)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    seconds, dem = timed(lambda: processor._height_from_shading(image, 1.0, args.smoothing, 255.0), args.repeat)
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Image: {args.size}x{args.size}, precision {dem.dtype}")
+    print(f"Time: {seconds:.3f} s, peak RSS: {peak_mb:.0f} MB "
+          f"(+{(peak_mb - rss_before / 1024):.0f} MB during the kernel)")
+
+
+def legacy_ascii_grid(dem_data, output_path):
+    """The original per-value ASCII Grid writer, kept as the benchmark baseline."""
+    height, width = dem_data.shape
+    with open(output_path, 'w') as f:
+        f.write(f"ncols {width}\nnrows {height}\nxllcorner 0.0\nyllcorner 0.0\n"
+                f"cellsize 1.0\nNODATA_value -9999\n")
+        for row in dem_data:
+            f.write(' '.join([f'{val:.6f}' for val in row]) + '\n')
+
+
+def bench_ascii(args):
+    """Rows per second of the ASCII Grid writer, before and after vectorisation."""
+    processor = DEMProcessor()
+    dem = processor._height_from_shading(synthetic_surface(args.size), 1.0, 3, 255.0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, 'legacy.asc')
+        writers = [
+            ('per-value f-strings', lambda: legacy_ascii_grid(dem, legacy_path), legacy_path),
+            ('vectorized', lambda: processor._save_ascii_grid(dem, os.path.join(tmp, 'new.asc')),
+             os.path.join(tmp, 'new.asc')),
+            ('vectorized .gz', lambda: processor._save_ascii_grid(dem, os.path.join(tmp, 'new.asc.gz')),
+             os.path.join(tmp, 'new.asc.gz')),
+        ]
+        print(f"DEM: {args.size}x{args.size} {dem.dtype}")
+        print(f"{'writer':<24}{'seconds':>10}{'rows/s':>12}{'MB':>10}")
+        for label, write, path in writers:
+            seconds, _ = timed(write, args.repeat)
+            size_mb = os.path.getsize(path) / 1024 / 1024
+            print(f"{label:<24}{seconds:>10.3f}{args.size / seconds:>12.0f}{size_mb:>10.1f}")
+
+        with open(legacy_path, 'rb') as old, open(os.path.join(tmp, 'new.asc'), 'rb') as new:
+            print(f"Byte-identical: {old.read() == new.read()}")
+
+
+def legacy_geotiff(dem_data, output_path):
+    """The original striped, uncompressed GeoTIFF writer (uint16 PIL fallback)."""
+    try:
+        import rasterio
+        from rasterio.transform import from_bounds
+        from rasterio.crs import CRS
+
+        height, width = dem_data.shape
+        with rasterio.open(output_path, 'w', driver='GTiff', height=height, width=width, count=1,
+                           dtype=dem_data.dtype, crs=CRS.from_epsg(4326),
+                           transform=from_bounds(0, 0, width, height, width, height)) as dst:
+            dst.write(dem_data, 1)
+    except ImportError:
+        from PIL import Image
+        dem_scaled = ((dem_data - dem_data.min()) / (dem_data.max() - dem_data.min()) * 65535).astype(np.uint16)
+        Image.fromarray(dem_scaled).save(output_path)
+
+
+def bench_geotiff(args):
+    """Write time and file size of the GeoTIFF writers."""
+    import geotiff
+
+    processor = DEMProcessor()
+    dem = processor._height_from_shading(synthetic_surface(args.size), 1.0, 3, 255.0)
+    factors = geotiff.overview_factors(dem.shape)
+
+    writers = [('legacy striped', lambda path: legacy_geotiff(dem, path))]
+    backends = [('builtin', geotiff._write_builtin)]
+    for module, writer in (('tifffile', geotiff._write_tifffile), ('rasterio', geotiff._write_rasterio)):
+        try:
+            __import__(module)
+            backends.append((module, writer))
+        except ImportError:
+            pass
+    for name, writer in backends:
+        for compression in args.compression:
+            if name == 'builtin' and compression not in ('deflate', 'none'):
+                continue
+            writers.append((f"{name} {compression} {args.dtype}",
+                            lambda path, w=writer, c=compression: w(dem, path, np.dtype(args.dtype), c,
+                                                                    geotiff.GEOTIFF_TILE_SIZE, factors, 4326)))
+
+    print(f"DEM: {args.size}x{args.size} {dem.dtype}, overviews {factors}")
+    print(f"{'writer':<34}{'seconds':>10}{'MB':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for index, (label, write) in enumerate(writers):
+            path = os.path.join(tmp, f"{index}.tif")
+            seconds, _ = timed(lambda: write(path), args.repeat)
+            print(f"{label:<34}{seconds:>10.3f}{os.path.getsize(path) / 1024 / 1024:>10.1f}")
+
+
+def bench_render(args):
+    """Time of the preview renderers (lookup table vs matplotlib)."""
+    processor = DEMProcessor()
+    dem = processor._height_from_shading(synthetic_surface(args.size), 1.0, 3, 255.0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        renderers = [
+            ('lookup table', processor._save_dem_image),
+            ('matplotlib', processor._save_dem_image_matplotlib),
+        ]
+        print(f"DEM: {args.size}x{args.size} {dem.dtype}")
+        print(f"{'renderer':<16}{'seconds':>10}")
+        for index, (label, render) in enumerate(renderers):
+            path = os.path.join(tmp, f"{index}.png")
+            seconds, _ = timed(lambda: render(dem, path), args.repeat)
+            print(f"{label:<16}{seconds:>10.3f}")
+
+
+def bench_mesh(args):
+    """Build time and size of error-bounded terrain meshes."""
+    from terrain_mesh import build_terrain_mesh, rtin_grid, triangle_errors, write_mesh
+
+    dem = synthetic_dem(args.size, args.elevation_range)
+    grid, (rows, _) = rtin_grid(dem)
+    print(f"DEM: {args.size}x{args.size} {dem.dtype}, {dem.min():.1f}..{dem.max():.1f} m, RTIN grid {grid.shape[0]}")
+    print(f"{'max error':>10}{'seconds':>10}{'vertices':>12}{'% of DEM':>10}{'faces':>12}{'actual':>10}"
+          f"{'obj MB':>8}{'ply MB':>8}{'glb MB':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for max_error in args.max_error:
+            seconds, mesh = timed(lambda: build_terrain_mesh(dem, max_error), args.repeat)
+            # Grid indices of the vertices, to measure the true deviation of the faces
+            grid_index = (rows - 1 - mesh.vertices[:, 1].astype(np.int64)) * grid.shape[0] + \
+                mesh.vertices[:, 0].astype(np.int64)
+            actual = triangle_errors(grid, grid_index[mesh.faces.astype(np.int64)]).max()
+            sizes = []
+            for extension in ('.obj', '.ply', '.glb'):
+                path = os.path.join(tmp, f"mesh{extension}")
+                write_mesh(mesh, path)
+                sizes.append(os.path.getsize(path) / 1024 / 1024)
+            print(f"{max_error:>10g}{seconds:>10.2f}{len(mesh.vertices):>12}"
+                  f"{100 * len(mesh.vertices) / dem.size:>10.2f}{len(mesh.faces):>12}{actual:>10.3f}"
+                  + ''.join(f"{size:>8.1f}" for size in sizes))
+
+
+def git_revision():
+    """(commit, has uncommitted changes) of the working tree, or (None, None) outside git."""
+    root = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def suite_case(size, seed, formats, repeat, params, tmp):
+    """
+    Process synthetic terrain of one size `repeat` times.
+
+    Returns:
+        Case record: total seconds and per-stage metrics (the best of the
+        repeats, metric by metric) plus the largest stage memory growth
+    """
+    from synthetic_terrain import synthetic_image
+
+    start = time.perf_counter()
+    image, _ = synthetic_image(size, seed=seed)
+    input_path = os.path.join(tmp, f"terrain_{size}_{seed}.png")
+    cv2.imwrite(input_path, image)
+    del image
+    generate_seconds = time.perf_counter() - start
+
+    totals = []
+    stages = {}
+    for run in range(repeat):
+        job_id = f"bench_{size}_{run}"
+        start = time.perf_counter()
+        result = DEMProcessor().process_image(input_path, tmp, job_id, formats=formats, **params)
+        totals.append(time.perf_counter() - start)
+        if result['status'] != 'success':
+            raise RuntimeError(f"{size}x{size}: {result['error']}")
+        for name, metrics in result['metrics'].items():
+            best = stages.setdefault(name, dict(metrics))
+            for key, value in metrics.items():
+                best[key] = min(best[key], value)
+        for name in os.listdir(tmp):
+            if name.startswith(job_id):
+                os.remove(os.path.join(tmp, name))
+    os.remove(input_path)
+
+    return {
+        'size': size,
+        'generate_seconds': round(generate_seconds, 4),
+        'seconds': round(min(totals), 4),
+        'peak_rss_delta_bytes': max(metrics['peak_rss_delta_bytes'] for metrics in stages.values()),
+        'stages': stages,
+    }
+
+
+def compare_results(baseline, current, threshold=REGRESSION_THRESHOLD, min_seconds=MIN_REGRESSION_SECONDS,
+                    min_bytes=MIN_REGRESSION_BYTES):
+    """
+    Compare two suite results case by case.
+
+    Total time and the wall time of every stage present in both results are
+    compared, as is the peak memory growth of each case.
+
+    Returns:
+        List of (case, metric, baseline value, current value, regressed) rows
+    """
+    rows = []
+    for case, current_case in current['cases'].items():
+        baseline_case = baseline['cases'].get(case)
+        if baseline_case is None:
+            continue
+        pairs = [('total seconds', baseline_case['seconds'], current_case['seconds'], min_seconds)]
+        pairs += [(f"{stage} seconds", baseline_case['stages'][stage]['wall_seconds'], metrics['wall_seconds'],
+                   min_seconds)
+                  for stage, metrics in current_case['stages'].items() if stage in baseline_case['stages']]
+        pairs.append(('peak memory growth', baseline_case['peak_rss_delta_bytes'],
+                      current_case['peak_rss_delta_bytes'], min_bytes))
+        for metric, old, new, noise in pairs:
+            regressed = new > old * (1 + threshold) and new - old > noise
+            rows.append((case, metric, old, new, regressed))
+    return rows
+
+
+def print_comparison(rows):
+    """Print compare_results() rows; returns the number of regressions."""
+    print(f"{'case':<8}{'metric':<34}{'baseline':>14}{'current':>14}{'change':>10}")
+    for case, metric, old, new, regressed in rows:
+        change = f"{100 * (new - old) / old:+.1f}%" if old else 'n/a'
+        if metric.endswith('seconds'):
+            values = f"{old:>14.3f}{new:>14.3f}"
+        else:
+            values = f"{old / 1024 / 1024:>12.1f}MB{new / 1024 / 1024:>12.1f}MB"
+        print(f"{case:<8}{metric:<34}{values}{change:>10}{'  REGRESSION' if regressed else ''}")
+    regressions = sum(row[-1] for row in rows)
+    print(f"{regressions} regression(s) in {len(rows)} comparisons")
+    return regressions
+
+
+def bench_suite(args):
+    """Per-stage time and memory of the whole pipeline on synthetic terrain, saved as JSON."""
+    from artifacts import parse_formats
+
+    formats = parse_formats(args.formats)
+    params = {'scale_factor': 1.0, 'smoothing': args.smoothing, 'elevation_range': 255.0, 'workers': args.workers}
+    commit, dirty = git_revision()
+    results = {
+        'meta': {
+            'commit': commit,
+            'dirty': dirty,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'formats': list(formats),
+            'parameters': params,
+        },
+        'cases': {},
+    }
+
+    print(f"Commit {(commit or 'unknown')[:10]}{' (modified)' if dirty else ''}, {os.cpu_count()} CPUs, "
+          f"formats {','.join(formats)}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            case = suite_case(size, args.seed, formats, args.repeat, params, tmp)
+            results['cases'][str(size)] = case
+            print(f"\n{size}x{size}: {case['seconds']:.3f}s total, peak memory growth "
+                  f"{case['peak_rss_delta_bytes'] / 1024 / 1024:.0f} MB (input generated in "
+                  f"{case['generate_seconds']:.1f}s)")
+            print(f"  {'stage':<22}{'wall s':>10}{'cpu s':>10}{'peak MB':>10}{'written MB':>12}")
+            for stage, metrics in case['stages'].items():
+                print(f"  {stage:<22}{metrics['wall_seconds']:>10.3f}{metrics['cpu_seconds']:>10.3f}"
+                      f"{metrics['peak_rss_delta_bytes'] / 1024 / 1024:>10.1f}"
+                      f"{metrics['bytes_written'] / 1024 / 1024:>12.1f}")
+
+    output = args.output or f"benchmark-{(commit or 'worktree')[:10]}.json"
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\nCompared with {args.compare} (commit {(baseline['meta'].get('commit') or 'unknown')[:10]}, "
+              f"threshold {100 * args.threshold:.0f}%):")
+        if print_comparison(compare_results(baseline, results, args.threshold)):
+            return 1
+    return 0
+
+
+def bench_compare(args):
+    """Compare two saved suite results; exits with status 1 on regressions."""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    return 1 if print_comparison(compare_results(baseline, current, args.threshold)) else 0
+
+
+# Run in a fresh interpreter by bench_startup: boot a web or worker process and
+# report its boot time, RSS and (for workers) the latency of its first job
+STARTUP_PROBE = r"""
+import json, os, sys, time
+mode, workdir, input_path = sys.argv[1:4]
+
+def rss_mb():
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) / 1024 for line in f if line.startswith('VmRSS'))
+
+start = time.perf_counter()
+if mode.startswith('web'):
+    import app
+else:
+    import worker
+    if mode == 'worker-warm':
+        worker.warm_up_process()
+result = {'boot_seconds': time.perf_counter() - start, 'boot_rss_mb': rss_mb()}
+result['modules'] = [name for name in ('cv2', 'scipy.ndimage', 'PIL.Image', 'matplotlib', 'dem_processor')
+                     if name in sys.modules]
+if mode.startswith('worker'):
+    for run, key in enumerate(('first_job_seconds', 'second_job_seconds')):
+        # Separate output folders, so the second job does not hit the stage cache
+        output = os.path.join(workdir, str(run))
+        os.makedirs(output)
+        start = time.perf_counter()
+        job = worker.run_processing_job(input_path, output, 'startup', {'formats': 'dem,dem_image'})
+        assert job['status'] == 'success', job.get('error')
+        result[key] = time.perf_counter() - start
+    result['job_rss_mb'] = rss_mb()
+print(json.dumps(result))
+"""
+
+
+def bench_startup(args):
+    """Boot time, RSS and first-job latency of web and worker processes, cold and warmed up."""
+    from synthetic_terrain import synthetic_image
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    modes = [('web', {}), ('web-preload', {'DEM_PRELOAD': '1'}), ('worker-cold', {}), ('worker-warm', {})]
+    print(f"{'process':<14}{'boot s':>9}{'boot MB':>9}{'1st job s':>11}{'2nd job s':>11}{'job MB':>9}"
+          f"  modules loaded at boot")
+    with tempfile.TemporaryDirectory() as tmp:
+        input_path = os.path.join(tmp, 'input.png')
+        cv2.imwrite(input_path, synthetic_image(args.size, seed=0)[0])
+        for mode, extra_env in modes:
+            env = dict(os.environ, PYTHONPATH=root, DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'startup.db')}",
+                       LOG_LEVEL='WARNING', **extra_env)
+            runs = []
+            for run in range(args.repeat):
+                workdir = os.path.join(tmp, f"{mode}-{run}")
+                os.makedirs(workdir)
+                probe = subprocess.run([sys.executable, '-c', STARTUP_PROBE, mode, workdir, input_path], cwd=workdir,
+                                       env=env, capture_output=True, text=True)
+                if probe.returncode != 0:
+                    raise RuntimeError(f"{mode} probe failed:\n{probe.stderr}")
+                runs.append(json.loads(probe.stdout.splitlines()[-1]))
+            best = {key: min(run[key] for run in runs) for key in runs[0] if key != 'modules'}
+            job = (f"{best['first_job_seconds']:>11.3f}{best['second_job_seconds']:>11.3f}{best['job_rss_mb']:>9.0f}"
+                   if 'first_job_seconds' in best else f"{'-':>11}{'-':>11}{'-':>9}")
+            print(f"{mode:<14}{best['boot_seconds']:>9.3f}{best['boot_rss_mb']:>9.0f}{job}  "
+                  f"{', '.join(runs[0]['modules']) or '-'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    parallel = subparsers.add_parser('parallel', help=bench_parallel.__doc__)
+    parallel.add_argument('--size', type=int, default=4096)
+    parallel.add_argument('--smoothing', type=int, default=3)
+    parallel.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, os.cpu_count() or 1])
+    parallel.add_argument('--executor', choices=['thread', 'process'], default='thread')
+    parallel.add_argument('--repeat', type=int, default=3)
+    parallel.set_defaults(func=bench_parallel)
+
+    kernel = subparsers.add_parser('kernel', help=bench_kernel.__doc__)
+    kernel.add_argument('--size', type=int, default=8192)
+    kernel.add_argument('--smoothing', type=int, default=3)
+    kernel.add_argument('--precision', choices=['float32', 'float64'], default='float32')
+    kernel.add_argument('--repeat', type=int, default=1)
+    kernel.set_defaults(func=bench_kernel)
+
+    ascii_grid = subparsers.add_parser('ascii', help=bench_ascii.__doc__)
+    ascii_grid.add_argument('--size', type=int, default=2048)
+    ascii_grid.add_argument('--repeat', type=int, default=1)
+    ascii_grid.set_defaults(func=bench_ascii)
+
+    geotiff = subparsers.add_parser('geotiff', help=bench_geotiff.__doc__)
+    geotiff.add_argument('--size', type=int, default=4096)
+    geotiff.add_argument('--dtype', choices=['float32', 'float64'], default='float32')
+    geotiff.add_argument('--compression', nargs='+', default=['deflate', 'lzw', 'zstd'])
+    geotiff.add_argument('--repeat', type=int, default=1)
+    geotiff.set_defaults(func=bench_geotiff)
+
+    render = subparsers.add_parser('render', help=bench_render.__doc__)
+    render.add_argument('--size', type=int, default=4096)
+    render.add_argument('--repeat', type=int, default=1)
+    render.set_defaults(func=bench_render)
+
+    mesh = subparsers.add_parser('mesh', help=bench_mesh.__doc__)
+    mesh.add_argument('--size', type=int, default=8192)
+    mesh.add_argument('--elevation-range', type=float, default=255.0)
+    mesh.add_argument('--max-error', type=float, nargs='+', default=[0.5, 1.0, 2.0, 5.0])
+    mesh.add_argument('--repeat', type=int, default=1)
+    mesh.set_defaults(func=bench_mesh)
+
+    suite = subparsers.add_parser('suite', help=bench_suite.__doc__)
+    suite.add_argument('--sizes', type=int, nargs='+', default=list(SUITE_SIZES),
+                       help='Terrain edge lengths, e.g. 512 4096 16384')
+    suite.add_argument('--seed', type=int, default=0)
+    suite.add_argument('--smoothing', type=int, default=3)
+    suite.add_argument('--workers', type=int, default=1)
+    suite.add_argument('--formats', default=SUITE_FORMATS, help='Output writers to time')
+    suite.add_argument('--repeat', type=int, default=1, help='Runs per size; the best is kept')
+    suite.add_argument('--output', help='Results file (default: benchmark-<commit>.json)')
+    suite.add_argument('--compare', help='Earlier results to check for regressions')
+    suite.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    suite.set_defaults(func=bench_suite)
+
+    compare = subparsers.add_parser('compare', help=bench_compare.__doc__)
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    compare.set_defaults(func=bench_compare)
+
+    startup = subparsers.add_parser('startup', help=bench_startup.__doc__)
+    startup.add_argument('--size', type=int, default=512, help='Edge length of the first job\'s image')
+    startup.add_argument('--repeat', type=int, default=3)
+    startup.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,21 +1,143 @@
 import cv2
 import numpy as np
 import os
+import gzip
+import hashlib
 import logging
-from PIL import Image, ImageEnhance
 import json
-import plotly.graph_objects as go
-import plotly.offline as pyo
-from scipy import ndimage
-from scipy.interpolate import griddata
+from tiling import TiledHeightFromShading, needs_tiling
+from stage_cache import STAGES, stage_key
+from artifacts import dem_array_path, dem_stats_path, ensure_artifact, parse_formats, remove_job_outputs
+from profiling import JobProfile, StageProfiler, measure
+from dem_stats import save_statistics
+# scipy, Pillow and the output writers are imported where they are used, so
+# importing this module stays cheap (see warmup.py for loading them ahead of time)
+
+# Sigma of the final artifact-reduction filter in _height_from_shading
+POST_SMOOTH_SIGMA = 0.5
+
+# Height estimators: the heuristic intensity/gradient blend, or the physically
+# based shape-from-shading solver of sfs_solver.py
+SOLVERS = ('heuristic', 'sfs')
+
+# Default illumination of the shape-from-shading solver (degrees; azimuth
+# clockwise from image up, so 315 is light from the top-left)
+DEFAULT_SUN_AZIMUTH = 315.0
+DEFAULT_SUN_ELEVATION = 30.0
+
+# Working precision of the height-from-shading kernels ('float32' or 'float64')
+DEFAULT_PRECISION = os.environ.get('DEM_PRECISION', 'float32')
+
+# Preview renderer: 'lut' (lookup table + Pillow) or 'matplotlib'
+DEM_RENDERER = os.environ.get('DEM_RENDERER', 'lut')
+
+# Digits after the decimal point in ASCII Grid output
+ASCII_DECIMALS = int(os.environ.get('DEM_ASCII_DECIMALS', 6))
+
+# Values formatted per write call by the ASCII Grid writer
+ASCII_BLOCK_VALUES = 1 << 20
+
+# zlib level of .asc.gz output; level 1 compresses the digit text to about half
+# its size at several times the speed of gzip.open's default level 9
+ASCII_GZIP_LEVEL = int(os.environ.get('DEM_ASCII_GZIP_LEVEL', 1))
+
+def to_grayscale(image):
+    """Convert a decoded BGR (or already grayscale) image to 8-bit grayscale."""
+    if len(image.shape) == 3:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
+
+class KernelScratch:
+    """Reusable work buffers for the height-from-shading kernels."""
+    
+    def __init__(self, dtype):
+        self.dtype = np.dtype(dtype)
+        self._buffers = None
+    
+    def buffers(self, shape):
+        """Return four C-contiguous buffers of `shape`, reallocating only on shape change."""
+        if self._buffers is None or self._buffers[0].shape != shape:
+            self._buffers = [np.empty(shape, dtype=self.dtype) for _ in range(4)]
+        return self._buffers
+
+def format_fixed_rows(block, decimals=6):
+    """
+    Format a 2D block as space-separated fixed-point rows, like '%.{decimals}f'.
+    
+    float32 values times 10**decimals (decimals <= 12) are exact in float64, so
+    rounding them half-to-even to integers gives the same digits as Python's
+    correctly rounded formatting. The digits are then assembled column by
+    column into a byte matrix. Other inputs, including values whose scaled
+    magnitude does not fit in an integer (2**63), fall back to one %-format
+    call per block.
+    
+    Returns:
+        ASCII bytes, one line per row
+    """
+    height, width = block.shape
+    if (block.dtype != np.float32 or decimals > 12 or not np.isfinite(block).all()
+            or (block.size and float(np.abs(block).max()) * 10.0 ** decimals >= 2 ** 63)):
+        row_format = ' '.join([f'%.{decimals}f'] * width) + '\n'
+        return ((row_format * height) % tuple(block.ravel().tolist())).encode('ascii')
+    
+    values = block.ravel()
+    digits_left = np.abs(np.rint(values.astype(np.float64) * 10.0 ** decimals)).astype(np.uint64)
+    int_digits = max(len(str(int(digits_left.max()) // 10 ** decimals)) if values.size else 1, 1)
+    
+    # One fixed-width cell per value: sign, integer digits, point, decimals, separator
+    cell = 1 + int_digits + (1 if decimals else 0) + decimals + 1
+    chars = np.zeros((values.size, cell), dtype=np.uint8)
+    column = cell - 2
+    for _ in range(decimals):
+        chars[:, column] = ord('0') + digits_left % 10
+        digits_left //= 10
+        column -= 1
+    if decimals:
+        chars[:, column] = ord('.')
+        column -= 1
+    
+    # Integer part, dropping leading zeros (the units digit is always written)
+    width_so_far = np.zeros(values.size, dtype=np.intp)
+    for position in range(int_digits):
+        present = (digits_left > 0) | (position == 0)
+        chars[:, column] = np.where(present, ord('0') + digits_left % 10, 0)
+        width_so_far += present
+        digits_left //= 10
+        column -= 1
+    
+    # '-' goes right before the first digit; signbit keeps '-0.000000'
+    negative = np.flatnonzero(np.signbit(values))
+    chars[negative, cell - 2 - (decimals + 1 if decimals else 0) - width_so_far[negative]] = ord('-')
+    
+    separators = np.full((height, width), ord(' '), dtype=np.uint8)
+    separators[:, -1] = ord('\n')
+    chars[:, -1] = separators.ravel()
+    
+    flat = chars.ravel()
+    return flat[flat != 0].tobytes()
 
 class DEMProcessor:
     """Digital Elevation Model processor using height-from-shading techniques."""
     
-    def __init__(self):
+    def __init__(self, precision=None, stage_cache=None):
+        """
+        Args:
+            precision: Floating point type of the DEM kernels, 'float32' (default) or 'float64'
+            stage_cache: Optional StageCache used to memoize intermediate stages
+        """
         self.logger = logging.getLogger(__name__)
+        self.stage_cache = stage_cache
+        self.profiler = None  # StageProfiler of the job being processed
+        self.dtype = np.dtype(precision or DEFAULT_PRECISION)
+        self._terrain_mesh = None  # (dem_data, max_error, mesh) of the last _save_terrain_mesh
+        self._statistics = None  # (dem_data, DEMStatistics) shared by the writers
+        if self.dtype not in (np.float32, np.float64):
+            raise ValueError(f"Unsupported precision: {precision}")
     
-    def process_image(self, input_path, output_folder, job_id, scale_factor=1.0, smoothing=3, elevation_range=255.0):
+    def process_image(self, input_path, output_folder, job_id, scale_factor=1.0, smoothing=3, elevation_range=255.0,
+                      tile_budget=None, workers=1, content_hash=None, formats=None, mesh_max_error=None, image=None,
+                      solver='heuristic', sun_azimuth=DEFAULT_SUN_AZIMUTH, sun_elevation=DEFAULT_SUN_ELEVATION,
+                      reflectance='lambert'):
         """
         Process a 2D image to generate a Digital Elevation Model.
         
@@ -26,77 +148,176 @@ class DEMProcessor:
             scale_factor: Scaling factor for elevation values
             smoothing: Gaussian blur kernel size for smoothing
             elevation_range: Maximum elevation value in meters
+            tile_budget: Per-tile memory budget in bytes; forces the tiled
+                out-of-core engine (used automatically for very large images)
+            workers: Number of tiles processed in parallel; values above 1 use
+                the tiled engine with a thread pool
+            content_hash: SHA-256 of the input file, the root key of the stage
+                cache (computed when a stage cache is configured and it is missing)
+            formats: Download types (keys of artifacts.ARTIFACTS) to generate now;
+                the others are rendered from the saved DEM when first requested
+            mesh_max_error: Vertical error bound in meters of the terrain mesh
+                downloads (defaults to DEM_MESH_MAX_ERROR)
+            image: Already decoded 8-bit grayscale input; input_path is then
+                not read (it still names the input in the stage cache)
+            solver: Height estimator, one of SOLVERS; 'sfs' inverts a
+                reflectance model (see sfs_solver.py) and always runs in memory
+            sun_azimuth: Sun azimuth in degrees clockwise from image up ('sfs' only)
+            sun_elevation: Sun elevation above the horizon in degrees ('sfs' only)
+            reflectance: Reflectance model of 'sfs', 'lambert' or 'lunar_lambert'
         
         Returns:
-            Dictionary with processing results and output file paths
+            Dictionary with processing results, output file paths and per-stage
+            metrics (see profiling.py)
         """
+        log_messages = []
+        self.profiler = StageProfiler()
+        job_profile = JobProfile(output_folder, job_id).start()
         try:
-            log_messages = []
             log_messages.append("Starting DEM processing...")
             
-            # Load and preprocess image
-            log_messages.append("Loading image...")
-            image = cv2.imread(input_path)
-            if image is None:
-                raise ValueError("Could not load image file")
+            # Files of an earlier run under this job id (e.g. a batch rerun into
+            # the same folder) would otherwise shadow the new results
+            removed = remove_job_outputs(output_folder, job_id)
+            if removed:
+                log_messages.append(f"Removed {len(removed)} output file(s) of a previous run")
             
-            # Convert to grayscale
-            if len(image.shape) == 3:
-                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            else:
-                gray = image
+            # Intermediate stages are memoized by upstream key (see stage_cache.py)
+            stages = {}
+            if self.stage_cache is not None and content_hash is None:
+                from result_cache import file_sha256
+                content_hash = file_sha256(input_path) if image is None else self._pixels_sha256(image)
             
-            log_messages.append(f"Image loaded: {gray.shape[1]}x{gray.shape[0]} pixels")
+            # Load and preprocess image (decoding is skipped when CLAHE is cached)
+            log_messages.append("Loading image...")
+            gray_key = stage_key('grayscale', content_hash)
+            load_gray = lambda: self._run_stage('grayscale', gray_key, stages,
+                                                lambda: self._load_grayscale(input_path) if image is None else image)
             
-            # Enhance contrast for better height estimation
-            log_messages.append("Enhancing image contrast...")
-            enhanced = self._enhance_contrast(gray)
+            if solver not in SOLVERS:
+                raise ValueError(f"Unknown solver: {solver}")
+            if solver == 'sfs':
+                # Shape-from-shading needs the original radiometry, which CLAHE would distort
+                source_key = gray_key
+                enhanced = load_gray()
+                solver_params = {'solver': solver, 'sun_azimuth': sun_azimuth, 'sun_elevation': sun_elevation,
+                                 'reflectance': reflectance}
+            else:
+                # Enhance contrast for better height estimation
+                log_messages.append("Enhancing image contrast...")
+                source_key = stage_key('clahe', gray_key, clip_limit=2.0, tile_grid=8)
+                enhanced = self._run_stage('clahe', source_key, stages, lambda: self._enhance_contrast(load_gray()))
+                solver_params = {}
+            stages['decode'] = stages.get('grayscale', 'skipped')
             
-            # Apply height-from-shading algorithm
-            log_messages.append("Applying height-from-shading algorithm...")
-            dem_data = self._height_from_shading(enhanced, scale_factor, smoothing, elevation_range)
+            log_messages.append(f"Image loaded: {enhanced.shape[1]}x{enhanced.shape[0]} pixels")
             
             # Generate output files
             output_files = {}
             
-            # Save DEM as visual image (colorized height map)
-            log_messages.append("Generating DEM visualization image...")
-            dem_image_path = os.path.join(output_folder, f"{job_id}_dem_image.png")
-            self._save_dem_image(dem_data, dem_image_path)
-            output_files['dem_image'] = f"{job_id}_dem_image.png"
+            # Each stage only runs when its own result is not cached
+            smoothed_key = stage_key('smoothed', source_key, smoothing=smoothing)
+            normalized_key = stage_key('normalized_dem', smoothed_key, precision=self.dtype.name, **solver_params)
+            scaled_key = stage_key('scaled_dem', normalized_key, scale_factor=scale_factor,
+                                   elevation_range=elevation_range)
+            height_scale = elevation_range * scale_factor
+            dem_array_file = dem_array_path(output_folder, job_id)
+            tiled = solver != 'sfs' and bool(tile_budget or workers > 1 or needs_tiling(enhanced.shape))
             
-            # Save DEM as GeoTIFF
-            log_messages.append("Saving DEM as GeoTIFF...")
-            dem_tiff_path = os.path.join(output_folder, f"{job_id}_dem.tif")
-            self._save_geotiff(dem_data, dem_tiff_path)
-            output_files['dem_tiff'] = f"{job_id}_dem.tif"
+            if solver == 'sfs':
+                log_messages.append(f"Solving shape-from-shading ({reflectance} reflectance, sun azimuth "
+                                    f"{sun_azimuth:g}, elevation {sun_elevation:g} degrees)...")
+                load_smoothed = lambda: self._run_stage('smoothed', smoothed_key, stages,
+                                                        lambda: self._normalize_intensity(enhanced, smoothing))
+                load_normalized = lambda: self._run_stage('normalized_dem', normalized_key, stages,
+                                                          lambda: self._solved_height(load_smoothed(), sun_azimuth,
+                                                                                      sun_elevation, reflectance))
+                dem_data = self._run_stage('scaled_dem', scaled_key, stages,
+                                           lambda: self._scale_dem(load_normalized(), height_scale))
+            elif tiled:
+                log_messages.append("Applying height-from-shading algorithm...")
+                # Large rasters are processed block-wise into memory-mapped DEMs;
+                # smoothing is fused into the tiles and never materialized
+                log_messages.append(f"Using tiled engine with {workers} worker(s)...")
+                engine = TiledHeightFromShading(self, tile_budget=tile_budget, workers=workers)
+                normalized_path = os.path.join(output_folder, f"{job_id}_normalized.npy")
+                load_normalized = lambda: self._run_stage(
+                    'normalized_dem', normalized_key, stages,
+                    lambda: engine.run(enhanced, normalized_path, smoothing), written_to=normalized_path
+                )
+                try:
+                    dem_data = self._run_stage(
+                        'scaled_dem', scaled_key, stages,
+                        lambda: self._scale_dem_to_file(load_normalized(), height_scale, dem_array_file),
+                        written_to=dem_array_file
+                    )
+                finally:
+                    if os.path.exists(normalized_path):
+                        os.remove(normalized_path)
+                if stages['scaled_dem'] == 'reused':
+                    # Give the job its own link to the cached array
+                    self.stage_cache.link(scaled_key, dem_array_file)
+                else:
+                    stages['smoothed'] = 'fused'
+            else:
+                log_messages.append("Applying height-from-shading algorithm...")
+                load_smoothed = lambda: self._run_stage('smoothed', smoothed_key, stages,
+                                                        lambda: self._normalize_intensity(enhanced, smoothing))
+                load_normalized = lambda: self._run_stage('normalized_dem', normalized_key, stages,
+                                                          lambda: self._normalized_height(load_smoothed()))
+                dem_data = self._run_stage('scaled_dem', scaled_key, stages,
+                                           lambda: self._scale_dem(load_normalized(), height_scale))
             
-            # Save DEM as ASCII Grid
-            log_messages.append("Saving DEM as ASCII Grid...")
-            dem_ascii_path = os.path.join(output_folder, f"{job_id}_dem.asc")
-            self._save_ascii_grid(dem_data, dem_ascii_path)
-            output_files['dem_ascii'] = f"{job_id}_dem.asc"
+            # Persist the core DEM (the tiled engine has already written or linked
+            # it); download formats are rendered from it on demand
+            if not tiled:
+                if stages['scaled_dem'] == 'reused':
+                    self.stage_cache.link(scaled_key, dem_array_file)
+                else:
+                    with measure(self.profiler, 'save_dem'):
+                        np.save(dem_array_file, dem_data)
+            output_files['dem_array'] = os.path.basename(dem_array_file)
             
-            # Generate 3D visualization
-            log_messages.append("Generating 3D visualization...")
-            viz_path = os.path.join(output_folder, f"{job_id}_3d_plot.html")
-            self._create_3d_visualization(dem_data, viz_path, job_id)
-            output_files['visualization'] = f"{job_id}_3d_plot.html"
+            reused = [name for name in STAGES if stages.get(name) == 'reused']
+            if reused:
+                log_messages.append(f"Reused cached stages: {', '.join(reused)}")
             
-            # Generate statistics
+            # Statistics are computed once and shared by the writers, now and
+            # when formats are rendered later from the saved DEM
             log_messages.append("Computing DEM statistics...")
-            stats = self._compute_statistics(dem_data)
+            with measure(self.profiler, 'statistics'):
+                stats = self._compute_statistics(dem_data)
+                save_statistics(self.dem_statistics(dem_data), dem_stats_path(output_folder, job_id))
             log_messages.extend([
                 f"Elevation range: {stats['min_elevation']:.2f} - {stats['max_elevation']:.2f} m",
                 f"Mean elevation: {stats['mean_elevation']:.2f} m",
                 f"Standard deviation: {stats['std_elevation']:.2f} m"
             ])
             
+            # Pre-generate the formats requested for this job
+            formats = parse_formats(formats)
+            for file_type in formats:
+                log_messages.append(f"Generating {file_type} output...")
+                output_files.update(ensure_artifact(output_folder, job_id, file_type, processor=self, dem_data=dem_data,
+                                                    options={'max_error': mesh_max_error}, profiler=self.profiler))
+            stages['outputs'] = 'computed' if formats else 'deferred'
+            
+            # Slope, curvature and roughness summaries share one pass over the DEM
+            log_messages.append("Computing terrain derivatives...")
+            from terrain_derivatives import compute_derivatives
+            with measure(self.profiler, 'derivatives'):
+                stats['derivatives'] = compute_derivatives(dem_data)
+            slope = stats['derivatives']['slope']
+            log_messages.append(f"Slope: mean {slope['mean']:.1f}, max {slope['max']:.1f} degrees")
+            
             log_messages.append("DEM processing completed successfully!")
+            self._finish_profile(job_profile, log_messages)
             
             return {
                 'status': 'success',
                 'output_files': json.dumps(output_files),
+                'stages': {name: stages.get(name, 'skipped') for name in STAGES},
+                'metrics': self.profiler.report(),
                 'statistics': stats,
                 'log': '\n'.join(log_messages)
             }
@@ -104,11 +325,66 @@ class DEMProcessor:
         except Exception as e:
             error_msg = f"Processing failed: {str(e)}"
             self.logger.error(error_msg)
+            self._finish_profile(job_profile, log_messages)
             return {
                 'status': 'error',
                 'error': error_msg,
+                'metrics': self.profiler.report(),
                 'log': '\n'.join(log_messages + [error_msg])
             }
+        finally:
+            self.profiler = None
+    
+    def _finish_profile(self, job_profile, log_messages):
+        """Write the job's DEM_PROFILE dump, if profiling is enabled."""
+        path = job_profile.stop()
+        if path:
+            log_messages.append(f"Profile written to {os.path.basename(path)}")
+    
+    def _run_stage(self, name, key, stages, compute, written_to=None):
+        """
+        Return a stage result from the stage cache, or compute and memoize it.
+        
+        Args:
+            name: Stage name recorded in `stages` as 'reused' or 'computed'
+            key: Stage cache key
+            stages: Dictionary collecting the per-stage outcome
+            compute: Callable producing the stage result
+            written_to: Path of the .npy file `compute` writes, adopted by the
+                cache instead of saving another copy
+        """
+        with measure(self.profiler, name, written_to=written_to):
+            if self.stage_cache is not None and key is not None:
+                cached = self.stage_cache.load(key)
+                if cached is not None:
+                    stages[name] = 'reused'
+                    return cached
+            
+            result = compute()
+            stages[name] = 'computed'
+            if self.stage_cache is not None and key is not None:
+                try:
+                    if written_to is not None:
+                        self.stage_cache.adopt(key, written_to)
+                    else:
+                        self.stage_cache.save(key, result)
+                except OSError as e:
+                    self.logger.warning(f"Could not cache stage {name}: {str(e)}")
+            return result
+    
+    @staticmethod
+    def _pixels_sha256(image):
+        """Stage cache root key of a decoded image that has no file digest."""
+        digest = hashlib.sha256(str(image.shape).encode('ascii'))
+        digest.update(np.ascontiguousarray(image).data)
+        return f"pixels:{digest.hexdigest()}"
+    
+    def _load_grayscale(self, input_path):
+        """Decode an image file and convert it to 8-bit grayscale."""
+        image = cv2.imread(input_path)
+        if image is None:
+            raise ValueError("Could not load image file")
+        return to_grayscale(image)
     
     def _enhance_contrast(self, image):
         """Enhance image contrast using adaptive histogram equalization."""
@@ -125,75 +401,199 @@ class DEMProcessor:
         - Direct intensity-to-height mapping with shading analysis
         - Preserves original surface features and patterns
         - Uses lighting assumptions to enhance terrain details
+        
+        The individual steps are split into kernels that the tiled engine in
+        tiling.py reuses, so both paths agree up to rounding: less than 1e-6
+        of the elevation range with the spatial blur, up to 2e-2 once
+        smoothing is large enough for the FFT blur (see tiling.tolerance()).
+        The kernels work in self.dtype and reuse four scratch buffers instead
+        of allocating a new array per arithmetic step.
         """
-        # Normalize image to 0-1 range
-        img_norm = image.astype(np.float32) / 255.0
+        img_norm = self._normalize_intensity(image, smoothing)
+        return self._scale_dem(self._normalized_height(img_norm), elevation_range * scale_factor)
+    
+    def _normalized_height(self, img_norm):
+        """Height estimate of a smoothed, normalized image, rescaled to 0-1 and post-smoothed."""
+        with measure(self.profiler, 'sobel'):
+            gradients = self._surface_gradients(img_norm)
+        with measure(self.profiler, 'shading'):
+            dem_estimate = self._shaded_estimate(img_norm, gradients, float(gradients[-1].max()))
+            dem_estimate = self._normalize_estimate(dem_estimate, dem_estimate.min(), dem_estimate.max())
+        with measure(self.profiler, 'post_smooth'):
+            return self._post_smooth(dem_estimate)
+    
+    def _solved_height(self, img_norm, sun_azimuth, sun_elevation, reflectance):
+        """Shape-from-shading height of a smoothed, normalized image, rescaled to 0-1."""
+        from sfs_solver import solve_height
+        with measure(self.profiler, 'sfs_solver'):
+            height = solve_height(img_norm, sun_azimuth, sun_elevation, model=reflectance)
+        height = height.astype(self.dtype, copy=False)
+        return self._normalize_estimate(height, height.min(), height.max())
+    
+    def _scale_dem(self, normalized, height_scale):
+        """Scale a 0-1 DEM to elevations (the post-smoothing filter is linear, so it commutes)."""
+        return normalized * height_scale
+    
+    def _scale_dem_to_file(self, normalized, height_scale, output_path, rows_per_block=1024):
+        """Block-wise _scale_dem of a memory-mapped DEM into a new .npy file, gathering its statistics."""
+        from dem_stats import DEMStatistics
+        statistics = DEMStatistics()
+        dem = np.lib.format.open_memmap(output_path, mode='w+', dtype=normalized.dtype, shape=normalized.shape)
+        for row in range(0, normalized.shape[0], rows_per_block):
+            block = self._scale_dem(normalized[row:row + rows_per_block], height_scale)
+            dem[row:row + rows_per_block] = block
+            statistics.update(block)
+        dem.flush()
+        del dem
+        dem = np.load(output_path, mmap_mode='r')
+        self.share_statistics(dem, statistics)
+        return dem
+    
+    def dem_statistics(self, dem_data):
+        """
+        DEMStatistics of a DEM (see dem_stats.py), computed on first use.
+        
+        The result is kept for the array it was computed from, so every writer
+        of that DEM normalises with the same values without rescanning it.
+        """
+        if self._statistics is None or self._statistics[0] is not dem_data:
+            from dem_stats import compute_statistics
+            self._statistics = (dem_data, compute_statistics(dem_data))
+        return self._statistics[1]
+    
+    def share_statistics(self, dem_data, statistics):
+        """Use already known statistics (e.g. saved with the job) for `dem_data`."""
+        self._statistics = (dem_data, statistics)
+    
+    def _normalize_intensity(self, image, smoothing):
+        """Normalize image to 0-1 range and apply the user-selected smoothing."""
+        img_norm = image.astype(np.float32)
+        img_norm /= 255.0
         
-        # Apply gentle smoothing to reduce noise while preserving details
+        # Apply gentle smoothing to reduce noise while preserving details; large
+        # (regional) kernels are convolved through FFTs
         if smoothing > 0:
-            img_norm = cv2.GaussianBlur(img_norm, (smoothing*2+1, smoothing*2+1), 0)
+            from filters import gaussian_blur
+            img_norm = gaussian_blur(img_norm, smoothing*2+1)
+        
+        return img_norm
+    
+    def _surface_gradients(self, img_norm, scratch=None):
+        """
+        Compute Sobel gradients in the working precision.
+        
+        Args:
+            img_norm: Normalized float32 image
+            scratch: Optional KernelScratch whose buffers are reused across calls
         
-        # Method 1: Direct intensity mapping (base height)
-        # Lighter areas = higher elevation, darker = lower
-        base_height = img_norm.copy()
+        Returns:
+            Tuple (sobel_x, sobel_y, squared magnitude, magnitude) of scratch buffers
+        """
+        scratch = scratch or KernelScratch(self.dtype)
+        sobel_x, sobel_y, gradient_sq, gradient_magnitude = scratch.buffers(img_norm.shape)
+        
+        ddepth = cv2.CV_32F if self.dtype == np.float32 else cv2.CV_64F
+        cv2.Sobel(img_norm, ddepth, 1, 0, dst=sobel_x, ksize=3)
+        cv2.Sobel(img_norm, ddepth, 0, 1, dst=sobel_y, ksize=3)
+        
+        np.multiply(sobel_x, sobel_x, out=gradient_sq)
+        np.multiply(sobel_y, sobel_y, out=gradient_magnitude)
+        gradient_sq += gradient_magnitude
+        np.sqrt(gradient_sq, out=gradient_magnitude)
+        return sobel_x, sobel_y, gradient_sq, gradient_magnitude
+    
+    def _shaded_estimate(self, img_norm, gradients, gradient_max):
+        """
+        Combine intensity, gradient and shading cues into a 0-1 height estimate.
         
-        # Method 2: Enhance with gradient information for surface details
-        sobel_x = cv2.Sobel(img_norm, cv2.CV_64F, 1, 0, ksize=3) 
-        sobel_y = cv2.Sobel(img_norm, cv2.CV_64F, 0, 1, ksize=3)
-        gradient_magnitude = np.sqrt(sobel_x**2 + sobel_y**2)
+        Works in place: the gradient buffers are consumed and the returned
+        estimate is one of them.
         
-        # Normalize gradients
-        gradient_magnitude = gradient_magnitude / (gradient_magnitude.max() + 1e-8)
+        Args:
+            gradients: Buffers returned by _surface_gradients
+            gradient_max: Maximum gradient magnitude over the whole image
+        """
+        sobel_x, sobel_y, gradient_sq, dem_estimate = gradients
         
-        # Combine base height with gradient details (weighted combination)
+        # Weights of the intensity and gradient cues
         # This preserves the original image appearance while adding surface detail
         alpha = 0.7  # Weight for base intensity
         beta = 0.3   # Weight for gradient details
         
-        dem_estimate = alpha * base_height + beta * gradient_magnitude
+        # Shape-from-shading enhancement with light from the top-left, direction (-1, -1).
+        # For the surface normal (-gx, -gy, 1) / |n| the shading term
+        # max(0, -(n . light)) reduces to max(0, -(gx + gy) / |n|).
+        gradient_sq += 1.0
+        normal_length = np.sqrt(gradient_sq, out=gradient_sq)
+        normal_length += 1e-8
+        shading = np.add(sobel_x, sobel_y, out=sobel_x)
+        np.negative(shading, out=shading)
+        shading /= normal_length
+        np.maximum(shading, 0, out=shading)
         
-        # Method 3: Apply shape-from-shading enhancement
-        # Assume light source from top-left (standard assumption)
-        light_direction = np.array([-1, -1])  # Top-left lighting
+        # Gradient details normalized by the global maximum
+        dem_estimate *= beta / (gradient_max + 1e-8)
         
-        # Calculate surface normals from gradients
-        normal_x = -sobel_x
-        normal_y = -sobel_y
-        normal_z = np.ones_like(sobel_x)
-        
-        # Normalize surface normals
-        normal_length = np.sqrt(normal_x**2 + normal_y**2 + normal_z**2)
-        normal_x /= normal_length + 1e-8
-        normal_y /= normal_length + 1e-8
-        normal_z /= normal_length + 1e-8
-        
-        # Compute shading based on light direction
-        shading = np.maximum(0, -(normal_x * light_direction[0] + normal_y * light_direction[1]))
+        # Direct intensity mapping (lighter areas = higher elevation)
+        dem_estimate += np.multiply(img_norm, alpha, out=sobel_y)
         
         # Enhance the DEM with shading information
-        dem_estimate = dem_estimate + 0.2 * shading
-        
-        # Final processing: normalize and scale
-        dem_estimate = np.clip(dem_estimate, 0, 1)
-        dem_estimate = (dem_estimate - dem_estimate.min()) / (dem_estimate.max() - dem_estimate.min() + 1e-8)
-        dem_estimate = dem_estimate * elevation_range * scale_factor
-        
-        # Light smoothing to reduce artifacts while preserving features
-        dem_estimate = ndimage.gaussian_filter(dem_estimate, sigma=0.5)
+        shading *= 0.2
+        dem_estimate += shading
         
+        return np.clip(dem_estimate, 0, 1, out=dem_estimate)
+    
+    def _normalize_estimate(self, dem_estimate, estimate_min, estimate_max):
+        """Rescale the estimate in place to 0-1 using the global min/max."""
+        dem_estimate -= estimate_min
+        dem_estimate *= 1.0 / (estimate_max - estimate_min + 1e-8)
         return dem_estimate
     
+    def _post_smooth(self, dem_estimate):
+        """Light smoothing to reduce artifacts while preserving features."""
+        from scipy import ndimage
+        return ndimage.gaussian_filter(dem_estimate, sigma=POST_SMOOTH_SIGMA)
+    
     def _save_dem_image(self, dem_data, output_path):
-        """Save DEM data as a top-view visualization image."""
+        """
+        Save DEM data as top-view visualization images.
+        
+        Writes the two-panel analysis image to `output_path`, plus
+        ``*_topview.png`` and ``*_grayscale.png`` next to it. The default
+        renderer colourises through a lookup table (see rendering.py); set
+        DEM_RENDERER=matplotlib for the slower matplotlib figures.
+        """
+        if DEM_RENDERER == 'matplotlib':
+            return self._save_dem_image_matplotlib(dem_data, output_path)
+        
+        from PIL import Image
+        from rendering import encode_png, render_analysis, render_topview
+        statistics = self.dem_statistics(dem_data)
+        vmin, vmax = statistics.min, statistics.max
+        with open(output_path, 'wb') as f:
+            f.write(encode_png(render_analysis(dem_data, vmin, vmax)))
+        with open(output_path.replace('.png', '_topview.png'), 'wb') as f:
+            f.write(encode_png(render_topview(dem_data, vmin, vmax)))
+        
+        # Full-resolution grayscale height map
+        grayscale_path = output_path.replace('.png', '_grayscale.png')
+        dem_gray = ((dem_data - vmin) / (vmax - vmin) * 255).astype(np.uint8)
+        Image.fromarray(dem_gray).save(grayscale_path)
+    
+    def _save_dem_image_matplotlib(self, dem_data, output_path):
+        """Save DEM data as top-view visualization images rendered with matplotlib."""
         import matplotlib.pyplot as plt
         import matplotlib.cm as cm
         from matplotlib.colors import Normalize
+        from PIL import Image
+        statistics = self.dem_statistics(dem_data)
+        vmin, vmax = statistics.min, statistics.max
         
         # Create figure for top-view DEM
         fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(16, 8), dpi=150)
         
         # Left plot: Colorized elevation map (top view)
-        norm = Normalize(vmin=dem_data.min(), vmax=dem_data.max())
+        norm = Normalize(vmin=vmin, vmax=vmax)
         im1 = ax1.imshow(dem_data, cmap='terrain', norm=norm, aspect='equal', origin='upper')
         ax1.set_title('DEM - Top View (Colorized)', fontsize=14, fontweight='bold')
         ax1.set_xlabel('X Coordinate', fontsize=11)
@@ -204,7 +604,7 @@ class DEMProcessor:
         cbar1.set_label('Elevation (m)', rotation=270, labelpad=15, fontsize=10)
         
         # Right plot: Grayscale height map (top view)
-        dem_normalized = (dem_data - dem_data.min()) / (dem_data.max() - dem_data.min())
+        dem_normalized = (dem_data - vmin) / (vmax - vmin)
         im2 = ax2.imshow(dem_normalized, cmap='gray', aspect='equal', origin='upper')
         ax2.set_title('DEM - Top View (Grayscale)', fontsize=14, fontweight='bold')
         ax2.set_xlabel('X Coordinate', fontsize=11)
@@ -253,41 +653,30 @@ class DEMProcessor:
         
         # Also save a simple grayscale version
         grayscale_path = output_path.replace('.png', '_grayscale.png')
-        dem_gray = ((dem_data - dem_data.min()) / (dem_data.max() - dem_data.min()) * 255).astype(np.uint8)
+        dem_gray = ((dem_data - vmin) / (vmax - vmin) * 255).astype(np.uint8)
         Image.fromarray(dem_gray).save(grayscale_path)
     
     def _save_geotiff(self, dem_data, output_path):
-        """Save DEM data as GeoTIFF format."""
-        try:
-            import rasterio
-            from rasterio.transform import from_bounds
-            from rasterio.crs import CRS
-            
-            # Create a simple transform (could be georeferenced in real applications)
-            height, width = dem_data.shape
-            transform = from_bounds(0, 0, width, height, width, height)
-            
-            with rasterio.open(
-                output_path,
-                'w',
-                driver='GTiff',
-                height=height,
-                width=width,
-                count=1,
-                dtype=dem_data.dtype,
-                crs=CRS.from_epsg(4326),  # WGS84
-                transform=transform,
-            ) as dst:
-                dst.write(dem_data, 1)
-                
-        except ImportError:
-            # Fallback: save as regular TIFF using PIL
-            dem_scaled = ((dem_data - dem_data.min()) / (dem_data.max() - dem_data.min()) * 65535).astype(np.uint16)
-            Image.fromarray(dem_scaled).save(output_path)
-    
-    def _save_ascii_grid(self, dem_data, output_path):
-        """Save DEM data as ASCII Grid format."""
+        """Save DEM data as a tiled, compressed GeoTIFF with overviews and band statistics (see geotiff.py)."""
+        from geotiff import write_geotiff
+        backend = write_geotiff(dem_data, output_path, statistics=self.dem_statistics(dem_data).summary())
+        self.logger.debug(f"GeoTIFF written with {backend}: {output_path}")
+    
+    def _save_ascii_grid(self, dem_data, output_path, decimals=None):
+        """
+        Save DEM data as ASCII Grid format.
+        
+        Rows are formatted in blocks by format_fixed_rows, which produces the
+        same bytes as formatting every value with f'{val:.6f}'. Paths ending
+        in .gz are written as a gzip stream.
+        
+        Args:
+            dem_data: 2D DEM array (may be a memory map)
+            output_path: Destination .asc or .asc.gz file
+            decimals: Digits after the decimal point (defaults to ASCII_DECIMALS)
+        """
         height, width = dem_data.shape
+        decimals = ASCII_DECIMALS if decimals is None else int(decimals)
         
         # ASCII Grid header
         header = f"""ncols {width}
@@ -298,103 +687,101 @@ cellsize 1.0
 NODATA_value -9999
 """
         
+        rows_per_block = max(ASCII_BLOCK_VALUES // max(width, 1), 1)
+        
         # Write file
-        with open(output_path, 'w') as f:
-            f.write(header)
-            for row in dem_data:
-                row_str = ' '.join([f'{val:.6f}' for val in row])
-                f.write(row_str + '\n')
+        if output_path.endswith('.gz'):
+            f = gzip.open(output_path, 'wb', compresslevel=ASCII_GZIP_LEVEL)
+        else:
+            f = open(output_path, 'wb')
+        with f:
+            f.write(header.encode('ascii'))
+            for start in range(0, height, rows_per_block):
+                f.write(format_fixed_rows(np.asarray(dem_data[start:start + rows_per_block]), decimals))
     
     def _create_3d_visualization(self, dem_data, output_path, job_id):
-        """Create interactive 3D visualization using Plotly."""
+        """
+        Create the interactive 3D viewer page.
+        
+        The page loads the shared plotly bundle and fetches the surface as a
+        binary mesh from /mesh/<job_id> (see mesh.py); the URL is filled in
+        when the page is served, so cached pages work for every job sharing
+        them. The default level of detail is written next to it so the first
+        view needs no resampling.
+        """
+        from mesh import DEFAULT_MESH_SIZE, ensure_mesh, viewer_html
+        ensure_mesh(os.path.dirname(output_path), job_id, DEFAULT_MESH_SIZE, dem_data)
+        with open(output_path, 'w') as f:
+            f.write(viewer_html())
+    
+    def _save_terrain_mesh(self, dem_data, output_path, max_error=None):
+        """
+        Save an error-bounded triangle mesh of the DEM (see terrain_mesh.py).
+        
+        The format follows the extension: .obj, .ply or .glb. The mesh is kept
+        for the DEM it was built from, so writing several formats builds it once.
+        
+        Args:
+            dem_data: 2D DEM array (may be a memory map)
+            output_path: Destination file
+            max_error: Largest vertical deviation in meters (defaults to DEM_MESH_MAX_ERROR)
+        """
+        from terrain_mesh import build_terrain_mesh, write_mesh
+        cached = self._terrain_mesh
+        if cached is not None and cached[0] is dem_data and cached[1] == max_error:
+            mesh = cached[2]
+        else:
+            mesh = build_terrain_mesh(dem_data, max_error)
+            self._terrain_mesh = (dem_data, max_error, mesh)
+        write_mesh(mesh, output_path)
+        self.logger.debug(f"Terrain mesh with {len(mesh.vertices)} vertices and {len(mesh.faces)} faces "
+                          f"(max error {mesh.max_error:g} m): {output_path}")
+    
+    def _save_terrain_derivatives(self, dem_data, output_path):
+        """
+        Save slope, aspect, curvature and roughness GeoTIFFs, a hillshade PNG
+        and the derivative statistics as JSON, all from one pass over the DEM.
+        
+        Args:
+            dem_data: 2D DEM array (may be a memory map)
+            output_path: Path of the slope GeoTIFF (``*_slope.tif``); the other
+                files are written next to it with their own suffixes
+        """
+        from geotiff import write_geotiff
+        from terrain_derivatives import compute_derivatives
+        prefix = output_path[:-len('_slope.tif')]
+        scratch = {name: f"{prefix}_{name}.npy" for name in ('slope', 'aspect', 'curvature', 'roughness', 'hillshade')}
         try:
-            # Downsample for performance if image is too large
-            height, width = dem_data.shape
-            max_size = 150  # Reduced for better performance
-            
-            if height > max_size or width > max_size:
-                scale_factor = min(max_size / height, max_size / width)
-                new_height = int(height * scale_factor)
-                new_width = int(width * scale_factor)
-                dem_viz = cv2.resize(dem_data, (new_width, new_height))
-            else:
-                dem_viz = dem_data
-            
-            # Create coordinate grids
-            y_coords, x_coords = np.mgrid[0:dem_viz.shape[0], 0:dem_viz.shape[1]]
-            
-            # Create 3D surface plot with terrain color mapping for elevation
-            # Use standard DEM colorscale that clearly shows elevation differences
-            
-            fig = go.Figure(data=[
-                go.Surface(
-                    z=dem_viz,
-                    x=x_coords,
-                    y=y_coords,
-                    colorscale='earth',  # Earth colorscale for elevation mapping
-                    colorbar=dict(title="Elevation (m)"),
-                    contours=dict(
-                        z=dict(show=True, usecolormap=True, project_z=True, size=5)
-                    ),
-                    lighting=dict(ambient=0.4, diffuse=0.8, fresnel=0.1, specular=0.05, roughness=0.05)
-                )
-            ])
-            
-            fig.update_layout(
-                title=dict(
-                    text=f'3D Digital Elevation Model',
-                    x=0.5,
-                    font=dict(size=16)
-                ),
-                scene=dict(
-                    xaxis_title='X Coordinate (pixels)',
-                    yaxis_title='Y Coordinate (pixels)', 
-                    zaxis_title='Elevation (meters)',
-                    camera=dict(eye=dict(x=1.5, y=1.5, z=1.2)),
-                    bgcolor='rgba(0,0,0,0)',
-                    xaxis=dict(backgroundcolor='rgba(0,0,0,0)', gridcolor='lightgray'),
-                    yaxis=dict(backgroundcolor='rgba(0,0,0,0)', gridcolor='lightgray'),
-                    zaxis=dict(backgroundcolor='rgba(0,0,0,0)', gridcolor='lightgray')
-                ),
-                width=800,
-                height=600,
-                margin=dict(l=0, r=0, t=40, b=0),
-                paper_bgcolor='white',
-                plot_bgcolor='white'
-            )
-            
-            # Save as standalone HTML file
-            html_string = fig.to_html(include_plotlyjs=True, div_id="dem-3d-plot")
-            with open(output_path, 'w') as f:
-                f.write(html_string)
-                
-        except Exception as e:
-            self.logger.error(f"Error creating 3D visualization: {str(e)}")
-            # Create a simple fallback HTML file
-            fallback_html = f"""
-            <!DOCTYPE html>
-            <html>
-            <head><title>3D DEM Visualization</title></head>
-            <body>
-                <div style="text-align: center; padding: 50px;">
-                    <h2>3D Visualization Not Available</h2>
-                    <p>Error creating 3D model: {str(e)}</p>
-                    <p>Please download the GeoTIFF file for analysis in GIS software.</p>
-                </div>
-            </body>
-            </html>
-            """
-            with open(output_path, 'w') as f:
-                f.write(fallback_html)
+            outputs = {
+                name: np.lib.format.open_memmap(path, mode='w+', shape=dem_data.shape,
+                                                dtype=np.uint8 if name == 'hillshade' else np.float32)
+                for name, path in scratch.items()
+            }
+            stats = compute_derivatives(dem_data, outputs=outputs)
+            for name, raster in outputs.items():
+                raster.flush()
+                if name == 'hillshade':
+                    cv2.imwrite(f"{prefix}_hillshade.png", raster)
+                else:
+                    write_geotiff(raster, f"{prefix}_{name}.tif")
+            del outputs, raster
+        finally:
+            for path in scratch.values():
+                if os.path.exists(path):
+                    os.remove(path)
+        with open(f"{prefix}_derivatives.json", 'w') as f:
+            json.dump(stats, f, indent=2)
     
     def _compute_statistics(self, dem_data):
-        """Compute basic statistics for the DEM."""
-        flat_data = dem_data.flatten()
+        """Compute basic statistics and elevation percentiles for the DEM in one pass (see dem_stats.py)."""
+        summary = self.dem_statistics(dem_data).summary()
         
         return {
-            'min_elevation': float(np.min(flat_data)),
-            'max_elevation': float(np.max(flat_data)),
-            'mean_elevation': float(np.mean(flat_data)),
-            'std_elevation': float(np.std(flat_data)),
-            'total_pixels': int(len(flat_data))
+            'min_elevation': summary['min'],
+            'max_elevation': summary['max'],
+            'mean_elevation': summary['mean'],
+            'std_elevation': summary['std'],
+            'total_pixels': summary['count'] + summary['nodata'],
+            'nodata_pixels': summary['nodata'],
+            'percentiles': summary['percentiles'],
         }
@@ -0,0 +1,252 @@
+"""
+Single-pass summary statistics of DEMs.
+
+DEMStatistics accumulates the count, minimum, maximum, mean and variance of a
+DEM block by block. Partial results, such as those of separate tiles, are
+combined with the parallel update of Chan et al. A chunked pass over a
+memory-mapped DEM and per-tile statistics therefore use the same code and
+never copy the whole array. Non-finite values and NODATA_VALUE count as
+nodata and are left out of everything else.
+
+Percentiles come from a histogram of DEM_STATS_BINS equal-width bins. The
+bins cover the values seen so far. When a block falls outside them, the bin
+width doubles (pairs of neighbouring bins merge) until it fits, so the range
+does not have to be known in advance. Percentiles are interpolated within a
+bin and are accurate to about (max - min) / DEM_STATS_BINS.
+
+process_image computes the statistics of a DEM once and keeps them next to
+the DEM array (``<job_id>_dem_stats.json``, see artifacts.py). Writers that
+normalise by the elevation range take them from there instead of scanning
+the DEM again.
+"""
+import os
+import json
+
+import numpy as np
+import cv2
+
+# Histogram bins behind the percentiles (even; 0 keeps only the moments)
+STATS_BINS = int(os.environ.get('DEM_STATS_BINS', 4096))
+
+# Rows summarized at once by compute_statistics
+STATS_ROWS = int(os.environ.get('DEM_STATS_ROWS', 1024))
+
+# Elevation marking missing data (the NODATA_value of the ASCII grid)
+NODATA_VALUE = -9999.0
+
+# Percentiles included in summary()
+PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+
+
+class DEMStatistics:
+    """Mergeable running statistics and histogram of DEM values."""
+
+    def __init__(self, bins=None):
+        """
+        Args:
+            bins: Histogram bins (defaults to DEM_STATS_BINS; 0 for moments only)
+        """
+        self.bins = STATS_BINS if bins is None else int(bins)
+        if self.bins % 2:
+            raise ValueError("The number of histogram bins must be even")
+        self.count = 0
+        self.nodata = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # Sum of squared deviations from the mean
+        self.min = np.inf
+        self.max = -np.inf
+        self.origin = None  # Lower edge of the first bin
+        self.width = None
+        self.counts = np.zeros(self.bins, dtype=np.int64)
+
+    def update(self, block):
+        """Add the values of an array (any shape; may be a memory map slice)."""
+        values = np.asarray(block)
+        if values.dtype not in (np.float32, np.float64):
+            values = values.astype(np.float32)
+        if values.size == 0:
+            return self
+        low, high = float(values.min()), float(values.max())
+        # NaN propagates into min/max, so clean blocks skip building a mask
+        if not (np.isfinite(low) and np.isfinite(high)) or low <= NODATA_VALUE <= high:
+            valid = np.isfinite(values)
+            valid &= values != NODATA_VALUE
+            self.nodata += int(values.size - np.count_nonzero(valid))
+            values = values[valid]
+            if values.size == 0:
+                return self
+            low, high = float(values.min()), float(values.max())
+
+        count = values.size
+        mean = float(values.sum(dtype=np.float64)) / count
+        deviations = values - values.dtype.type(mean)
+        np.square(deviations, out=deviations)
+        m2 = float(deviations.sum(dtype=np.float64))
+        del deviations
+        self._merge_moments(count, mean, m2, low, high)
+
+        if self.bins:
+            self._cover(low, high)
+            top = self.origin + self.bins * self.width
+            if values.dtype == np.float32:
+                # Several times faster than np.histogram; the range end is exclusive in both
+                counts = cv2.calcHist([np.ascontiguousarray(values.reshape(-1, 1))], [0], None, [self.bins],
+                                      [self.origin, top]).ravel()
+            else:
+                counts = np.histogram(values, bins=self.bins, range=(self.origin, top))[0]
+            self.counts += counts.astype(np.int64)
+        return self
+
+    def merge(self, other):
+        """
+        Add the values summarized by another DEMStatistics (e.g. of another tile).
+
+        Moments merge exactly. Histograms add bin by bin when both share the
+        same grid; otherwise the other histogram is re-binned by bin centre,
+        which moves values by at most one bin.
+        """
+        self.nodata += other.nodata
+        if not other.count:
+            return self
+        self._merge_moments(other.count, other.mean, other.m2, other.min, other.max)
+        if self.bins and other.bins:
+            other_top = other.origin + other.bins * other.width
+            self._cover(other.origin, other_top - other.width * 1e-9)
+            while self.width < other.width:
+                self._double(upward=True)
+            if self.width == other.width and self.origin == other.origin and self.bins == other.bins:
+                self.counts += other.counts
+            else:
+                centres = other.origin + (np.arange(other.bins) + 0.5) * other.width
+                index = np.clip(((centres - self.origin) // self.width).astype(np.int64), 0, self.bins - 1)
+                np.add.at(self.counts, index, other.counts)
+        return self
+
+    def _merge_moments(self, count, mean, m2, low, high):
+        """Chan et al.'s update of count, mean and M2 with another batch of values."""
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+        self.min = min(self.min, low)
+        self.max = max(self.max, high)
+
+    def _cover(self, low, high):
+        """Widen the histogram grid until it contains [low, high]."""
+        if self.origin is None:
+            span = high - low
+            # A constant first block still needs a positive bin width
+            self.width = span / (self.bins - 1) if span > 0 else max(abs(low), 1.0) * 2.0 ** -20
+            self.origin = low
+        while low < self.origin or high >= self.origin + self.bins * self.width:
+            self._double(upward=high >= self.origin + self.bins * self.width)
+
+    def _double(self, upward):
+        """Merge neighbouring bins into the lower (upward) or upper half of a grid twice as wide."""
+        merged = self.counts.reshape(-1, 2).sum(axis=1)
+        empty = np.zeros_like(merged)
+        if upward:
+            self.counts = np.concatenate((merged, empty))
+        else:
+            self.counts = np.concatenate((empty, merged))
+            self.origin -= self.bins * self.width
+        self.width *= 2
+
+    @property
+    def variance(self):
+        """Population variance, like np.var."""
+        return self.m2 / self.count if self.count else None
+
+    @property
+    def std(self):
+        return float(np.sqrt(self.variance)) if self.count else None
+
+    def percentile(self, q):
+        """
+        Approximate q-th percentile (0-100) from the histogram.
+
+        Returns:
+            Value within [min, max], or None without data or histogram
+        """
+        if not self.count or not self.bins:
+            return None
+        cumulative = np.cumsum(self.counts)
+        rank = q / 100.0 * cumulative[-1]
+        index = min(int(np.searchsorted(cumulative, rank, side='left')), self.bins - 1)
+        before = cumulative[index - 1] if index else 0
+        inside = self.counts[index]
+        fraction = (rank - before) / inside if inside else 0.0
+        value = self.origin + (index + fraction) * self.width
+        return float(min(max(value, self.min), self.max))
+
+    def summary(self):
+        """JSON-friendly count, nodata, min, max, mean, std and PERCENTILES of the values."""
+        empty = not self.count
+        return {
+            'count': self.count,
+            'nodata': self.nodata,
+            'min': None if empty else self.min,
+            'max': None if empty else self.max,
+            'mean': None if empty else self.mean,
+            'std': self.std,
+            'percentiles': {f'p{q}': self.percentile(q) for q in PERCENTILES} if self.bins else {},
+        }
+
+    def to_dict(self):
+        """Complete state, for save() and from_dict()."""
+        return {
+            'count': self.count, 'nodata': self.nodata, 'mean': self.mean, 'm2': self.m2,
+            'min': self.min if self.count else None, 'max': self.max if self.count else None,
+            'bins': self.bins, 'origin': self.origin, 'width': self.width,
+            'counts': self.counts.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        statistics = cls(bins=state['bins'])
+        statistics.count = state['count']
+        statistics.nodata = state['nodata']
+        statistics.mean = state['mean']
+        statistics.m2 = state['m2']
+        if statistics.count:
+            statistics.min, statistics.max = state['min'], state['max']
+        statistics.origin, statistics.width = state['origin'], state['width']
+        statistics.counts = np.asarray(state['counts'], dtype=np.int64)
+        return statistics
+
+
+def compute_statistics(dem_data, rows_per_block=None, bins=None):
+    """
+    Statistics of a whole DEM in one pass over blocks of rows.
+
+    Args:
+        dem_data: 2D elevation array (may be a memory map)
+        rows_per_block: Rows read at once (defaults to DEM_STATS_ROWS)
+        bins: Histogram bins (defaults to DEM_STATS_BINS)
+
+    Returns:
+        DEMStatistics
+    """
+    statistics = DEMStatistics(bins)
+    rows = rows_per_block or STATS_ROWS
+    for start in range(0, dem_data.shape[0], rows):
+        statistics.update(dem_data[start:start + rows])
+    return statistics
+
+
+def save_statistics(statistics, path):
+    """Write DEMStatistics to a JSON file (atomically, as concurrent renders may read it)."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(statistics.to_dict(), f)
+    os.replace(tmp_path, path)
+
+
+def load_statistics(path):
+    """DEMStatistics saved by save_statistics, or None if the file does not exist."""
+    try:
+        with open(path) as f:
+            return DEMStatistics.from_dict(json.load(f))
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,204 @@
+"""
+Point, profile and window queries on the DEMs of finished jobs.
+
+Every completed job keeps its DEM as ``<job_id>_dem.npy``. DEMStore opens
+these files as read-only memory maps and keeps the DEM_STORE_SIZE most
+recently used ones open, so repeated queries on a hot job skip the file
+open and header parse. An entry is reopened when its file is replaced
+(different inode or modification time).
+
+Coordinates are pixel positions: x is the column and y the row of the DEM
+array, so (0, 0) is the centre of the top-left pixel. Fractional positions
+are interpolated bilinearly between the four surrounding pixels.
+
+- sample(): elevations at any number of points
+- profile(): elevations along a polyline, sampled at a fixed spacing
+- window(): a rectangular, optionally decimated, slice of the memory map,
+  returned as a view without copying
+"""
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from artifacts import dem_array_path
+from metrics import CACHE_REQUESTS
+
+# Memory-mapped DEMs kept open per process
+DEM_STORE_SIZE = int(os.environ.get('DEM_STORE_SIZE', 32))
+
+# Largest number of values of one window or profile
+MAX_QUERY_VALUES = int(os.environ.get('DEM_QUERY_MAX_VALUES', 1 << 24))
+
+# Largest number of values of one JSON response; each one becomes a Python
+# float (about a second and 100 MB per million), so larger queries must use .npy
+MAX_JSON_VALUES = int(os.environ.get('DEM_QUERY_MAX_JSON_VALUES', 1 << 20))
+
+
+class DEMStore:
+    """LRU of read-only memory maps of job DEMs."""
+
+    def __init__(self, max_open=None):
+        """
+        Args:
+            max_open: Memory maps kept open (defaults to DEM_STORE_SIZE)
+        """
+        self.max_open = max_open or DEM_STORE_SIZE
+        self.logger = logging.getLogger(__name__)
+        self._maps = OrderedDict()  # path -> (file signature, memory map)
+        self._lock = threading.Lock()
+
+    def open(self, output_folder, job_id):
+        """
+        Read-only memory map of a job's DEM.
+
+        Raises:
+            FileNotFoundError: If the job has no DEM array
+        """
+        path = os.path.abspath(dem_array_path(output_folder, job_id))
+        info = os.stat(path)
+        signature = (info.st_ino, info.st_mtime_ns, info.st_size)
+        with self._lock:
+            entry = self._maps.get(path)
+            if entry is not None and entry[0] == signature:
+                self._maps.move_to_end(path)
+                CACHE_REQUESTS.inc(cache='dem_store', outcome='hit')
+                return entry[1]
+        CACHE_REQUESTS.inc(cache='dem_store', outcome='miss')
+
+        dem = np.load(path, mmap_mode='r')
+        with self._lock:
+            self._maps[path] = (signature, dem)
+            self._maps.move_to_end(path)
+            while len(self._maps) > self.max_open:
+                # Closed once the last query still slicing it is done
+                self._maps.popitem(last=False)
+        self.logger.debug(f"Opened DEM of job {job_id} ({dem.shape[1]}x{dem.shape[0]})")
+        return dem
+
+    def evict(self, output_folder, job_id):
+        """Forget a job's memory map (e.g. before its files are deleted)."""
+        with self._lock:
+            self._maps.pop(os.path.abspath(dem_array_path(output_folder, job_id)), None)
+
+
+def sample(dem, xs, ys):
+    """
+    Bilinearly interpolated elevations at pixel positions.
+
+    Args:
+        dem: 2D elevation array (may be a memory map)
+        xs, ys: Column and row positions (sequences of equal length)
+
+    Returns:
+        float64 array of elevations
+
+    Raises:
+        ValueError: If a position lies outside the DEM
+    """
+    height, width = dem.shape
+    xs = np.asarray(xs, dtype=np.float64).ravel()
+    ys = np.asarray(ys, dtype=np.float64).ravel()
+    if xs.shape != ys.shape:
+        raise ValueError("x and y must have the same number of values")
+    if not (np.isfinite(xs).all() and np.isfinite(ys).all()):
+        raise ValueError("Coordinates must be finite")
+    if xs.size and (xs.min() < 0 or ys.min() < 0 or xs.max() > width - 1 or ys.max() > height - 1):
+        raise ValueError(f"Coordinates must lie within 0-{width - 1} (x) and 0-{height - 1} (y)")
+
+    # Upper-left neighbour; the last row and column interpolate from the one before
+    x0 = np.minimum(np.floor(xs).astype(np.intp), max(width - 2, 0))
+    y0 = np.minimum(np.floor(ys).astype(np.intp), max(height - 2, 0))
+    x1 = np.minimum(x0 + 1, width - 1)
+    y1 = np.minimum(y0 + 1, height - 1)
+    fx = xs - x0
+    fy = ys - y0
+    # Fancy indexing reads just these pixels from a memory map
+    top = dem[y0, x0] * (1 - fx) + dem[y0, x1] * fx
+    bottom = dem[y1, x0] * (1 - fx) + dem[y1, x1] * fx
+    return top * (1 - fy) + bottom * fy
+
+
+def profile(dem, points, spacing=1.0, max_samples=None):
+    """
+    Elevations along a polyline.
+
+    Samples are `spacing` pixels apart along the line, starting at the first
+    vertex; the last vertex is always included.
+
+    Args:
+        dem: 2D elevation array (may be a memory map)
+        points: Sequence of at least two (x, y) vertices
+        spacing: Distance between samples in pixels
+        max_samples: Largest number of samples (defaults to MAX_QUERY_VALUES)
+
+    Returns:
+        Tuple (distance, x, y, elevation) of float64 arrays; distance is in
+        pixels from the first vertex
+
+    Raises:
+        ValueError: On fewer than two vertices, a non-positive spacing, too
+            many samples or vertices outside the DEM
+    """
+    vertices = np.asarray(points, dtype=np.float64)
+    if vertices.ndim != 2 or vertices.shape[1] != 2 or len(vertices) < 2:
+        raise ValueError("A profile needs at least two (x, y) points")
+    if not spacing > 0:
+        raise ValueError("Spacing must be positive")
+    lengths = np.hypot(*np.diff(vertices, axis=0).T)
+    cumulative = np.concatenate(([0.0], np.cumsum(lengths)))
+    total = cumulative[-1]
+    max_samples = max_samples or MAX_QUERY_VALUES
+    if total / spacing + 2 > max_samples:
+        raise ValueError(f"A profile may have at most {max_samples} samples; increase the spacing"
+                         + (" or use format=npy" if max_samples < MAX_QUERY_VALUES else ""))
+
+    distance = np.arange(0.0, total, spacing)
+    distance = np.append(distance, total) if distance.size == 0 or distance[-1] < total else distance
+    xs = np.interp(distance, cumulative, vertices[:, 0])
+    ys = np.interp(distance, cumulative, vertices[:, 1])
+    return distance, xs, ys, sample(dem, xs, ys)
+
+
+def window(dem, x0, y0, x1, y1, step=1):
+    """
+    Rectangular slice dem[y0:y1:step, x0:x1:step], as a view of the memory map.
+
+    Raises:
+        ValueError: If the window is empty, leaves the DEM or has more than
+            MAX_QUERY_VALUES values
+    """
+    height, width = dem.shape
+    if step < 1:
+        raise ValueError("Step must be at least 1")
+    if not (0 <= x0 < x1 <= width and 0 <= y0 < y1 <= height):
+        raise ValueError(f"Window must satisfy 0 <= x0 < x1 <= {width} and 0 <= y0 < y1 <= {height}")
+    view = dem[y0:y1:step, x0:x1:step]
+    if view.size > MAX_QUERY_VALUES:
+        raise ValueError(f"A window may have at most {MAX_QUERY_VALUES} values; use a larger step")
+    return view
+
+
+def json_values(values):
+    """(Nested) lists of an array for JSON, with None for non-finite values."""
+    values = np.asarray(values, dtype=np.float64)
+    if np.isfinite(values).all():
+        return values.tolist()
+    return np.where(np.isfinite(values), values, None).tolist()
+
+
+def npy_chunks(array, rows_per_chunk=256):
+    """
+    Stream an array as a .npy file without materialising it.
+
+    Yields:
+        The header, then the data in blocks of rows
+    """
+    import io
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, np.lib.format.header_data_from_array_1_0(array))
+    yield header.getvalue()
+    for start in range(0, array.shape[0], rows_per_chunk):
+        yield np.ascontiguousarray(array[start:start + rows_per_chunk]).tobytes()
@@ -0,0 +1,132 @@
+"""
+Separable image filters with a spatial and an FFT backend.
+
+OpenCV's separable convolution costs a fraction of a nanosecond per pixel
+and kernel tap, so the regional smoothing kernels of large `smoothing` values
+(hundreds of taps) take seconds on a 4096 x 4096 DEM (3.1 s at 201 taps). An
+FFT convolution costs the same for every kernel size (0.9 s). The functions
+below pick the backend per call:
+
+- 'spatial': cv2.sepFilter2D / cv2.GaussianBlur, exactly as before
+- 'fft': the image is padded by the kernel radius with the same mirrored
+  border (BORDER_REFLECT_101), transformed once with real FFTs
+  (scipy.fft.rfft2 on DEM_FFT_WORKERS threads), multiplied by the kernel
+  spectra and transformed back
+- 'auto': 'fft' for kernels of at least FFT_MIN_KERNEL taps, 'spatial' otherwise
+
+Both backends compute the same correlation; they agree to floating point
+rounding. A SpectralFilterBank keeps the transform of one image, so several
+filters of the same image only cost one inverse transform each.
+"""
+import os
+
+import numpy as np
+import cv2
+
+# Kernel size (taps along one axis) from which 'auto' uses the FFT backend;
+# about where the two cost the same on one core
+FFT_MIN_KERNEL = int(os.environ.get('DEM_FFT_MIN_KERNEL', 129))
+
+# Threads of scipy.fft (-1 for one per CPU)
+FFT_WORKERS = int(os.environ.get('DEM_FFT_WORKERS', -1))
+
+BACKENDS = ('auto', 'spatial', 'fft')
+
+
+def gaussian_kernel(ksize, sigma=0):
+    """1D Gaussian of cv2.GaussianBlur (sigma 0 derives it from ksize like OpenCV does)."""
+    return cv2.getGaussianKernel(ksize, sigma, cv2.CV_64F).ravel()
+
+
+def resolve_backend(backend, kernel_size):
+    """Backend ('spatial' or 'fft') that `backend` selects for a kernel of `kernel_size` taps."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown filter backend: {backend}")
+    if backend == 'auto':
+        return 'fft' if kernel_size >= FFT_MIN_KERNEL else 'spatial'
+    return backend
+
+
+class SpectralFilterBank:
+    """Real-FFT spectrum of one padded image, reused by any number of separable filters."""
+
+    def __init__(self, image, radius, workers=None):
+        """
+        Args:
+            image: 2D float array
+            radius: Largest kernel radius the bank will apply
+            workers: scipy.fft threads (defaults to DEM_FFT_WORKERS)
+        """
+        from scipy import fft
+        self.shape = image.shape
+        self.dtype = image.dtype if image.dtype in (np.float32, np.float64) else np.dtype(np.float32)
+        self.radius = radius
+        self.workers = FFT_WORKERS if workers is None else workers
+        height, width = self.shape
+        # Pad by the radius with OpenCV's default border, then up to sizes with fast transforms
+        self.padded_shape = (fft.next_fast_len(height + 2 * radius, real=True),
+                             fft.next_fast_len(width + 2 * radius, real=True))
+        padded = np.asarray(image, dtype=self.dtype)
+        for axis, (size, padded_size) in enumerate(zip(self.shape, self.padded_shape)):
+            widths = [(0, 0), (0, 0)]
+            widths[axis] = (radius, padded_size - size - radius)
+            # A single pixel has nothing to mirror; OpenCV repeats it
+            padded = np.pad(padded, widths, mode='reflect' if size > 1 else 'edge')
+        self.spectrum = fft.rfft2(padded, workers=self.workers)
+
+    def _kernel_spectrum(self, kernel, length, real):
+        """Spectrum of a correlation kernel centred on index 0 of a `length` signal."""
+        from scipy import fft
+        kernel = np.asarray(kernel, dtype=np.float64)
+        radius = len(kernel) // 2
+        if radius > self.radius:
+            raise ValueError(f"Kernel radius {radius} exceeds the padding of {self.radius}")
+        signal = np.zeros(length)
+        # Correlation with w is convolution with w reversed: tap o lands on index -o
+        signal[-np.arange(-radius, radius + 1) % length] = kernel
+        spectrum = fft.rfft(signal) if real else fft.fft(signal)
+        return spectrum.astype(self.spectrum.dtype)
+
+    def apply(self, kernel_y, kernel_x):
+        """Correlate the image with the separable kernel kernel_y x kernel_x (odd lengths)."""
+        from scipy import fft
+        rows, cols = self.padded_shape
+        spectrum = self.spectrum * self._kernel_spectrum(kernel_y, rows, real=False)[:, None]
+        spectrum *= self._kernel_spectrum(kernel_x, cols, real=True)[None, :]
+        filtered = fft.irfft2(spectrum, s=self.padded_shape, workers=self.workers)
+        del spectrum
+        height, width = self.shape
+        return np.ascontiguousarray(filtered[self.radius:self.radius + height, self.radius:self.radius + width])
+
+
+def separable_filter(image, kernel_y, kernel_x, backend='auto'):
+    """
+    Correlate a 2D float image with a separable kernel, like cv2.sepFilter2D.
+
+    Args:
+        image: 2D float32 or float64 array
+        kernel_y, kernel_x: Odd-length 1D kernels along rows and columns
+        backend: 'auto', 'spatial' or 'fft'
+
+    Returns:
+        Filtered array of the image's shape and dtype
+    """
+    size = max(len(kernel_y), len(kernel_x))
+    if resolve_backend(backend, size) == 'spatial':
+        return cv2.sepFilter2D(image, -1, np.asarray(kernel_x), np.asarray(kernel_y),
+                               borderType=cv2.BORDER_REFLECT_101)
+    return SpectralFilterBank(image, size // 2).apply(kernel_y, kernel_x)
+
+
+def gaussian_blur(image, ksize, sigma=0, backend='auto'):
+    """
+    cv2.GaussianBlur(image, (ksize, ksize), sigma) on either backend.
+
+    The spatial backend is cv2.GaussianBlur itself, so small kernels give
+    exactly the results they always did.
+    """
+    if resolve_backend(backend, ksize) == 'spatial':
+        return cv2.GaussianBlur(image, (ksize, ksize), sigma)
+    kernel = gaussian_kernel(ksize, sigma)
+    return SpectralFilterBank(image, ksize // 2).apply(kernel, kernel)
+
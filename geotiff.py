@@ -0,0 +1,354 @@
+"""
+Cloud-Optimized-GeoTIFF-style writer for DEMs.
+
+Output is internally tiled, compressed with the floating-point predictor and
+carries a pyramid of 2x-averaged overviews, so GIS clients can open large DEMs
+without reading the whole file. rasterio (GDAL) is used when installed, then
+tifffile; otherwise a built-in writer produces a tiled, DEFLATE-compressed
+TIFF with GeoTIFF tags. All paths keep the elevation values lossless in the
+chosen float type. Band statistics computed by the caller (see dem_stats.py)
+are stored as GDAL metadata, so GIS clients do not scan the raster for them.
+"""
+import os
+import zlib
+import struct
+import logging
+
+import numpy as np
+
+# Sample type of the GeoTIFF ('float32' or 'float64')
+GEOTIFF_DTYPE = os.environ.get('DEM_GEOTIFF_DTYPE', 'float32')
+
+# Compression: 'deflate', 'lzw', 'zstd' or 'none' (the built-in writer supports deflate and none)
+GEOTIFF_COMPRESSION = os.environ.get('DEM_GEOTIFF_COMPRESSION', 'deflate')
+
+# Edge length of the internal tiles (multiple of 16, as required by TIFF)
+GEOTIFF_TILE_SIZE = 256
+
+# zlib level of DEFLATE tiles in the built-in writer
+DEFLATE_LEVEL = 6
+
+# Raw data size above which the fallback writers switch to BigTIFF (64-bit
+# offsets); the margin covers headers and incompressible tiles
+BIGTIFF_THRESHOLD = 2 ** 32 - 2 ** 26
+
+# EPSG code written into the GeoKeys (the DEM is not georeferenced; this
+# mirrors the WGS84 placeholder of the original writer)
+DEFAULT_EPSG = 4326
+
+# TIFF tag numbers and field types used by the built-in writer
+_NEW_SUBFILE_TYPE, _IMAGE_WIDTH, _IMAGE_LENGTH, _BITS_PER_SAMPLE = 254, 256, 257, 258
+_COMPRESSION, _PHOTOMETRIC, _SAMPLES_PER_PIXEL, _PLANAR_CONFIG = 259, 262, 277, 284
+_PREDICTOR, _TILE_WIDTH, _TILE_LENGTH, _TILE_OFFSETS, _TILE_BYTE_COUNTS = 317, 322, 323, 324, 325
+_SAMPLE_FORMAT, _MODEL_PIXEL_SCALE, _MODEL_TIEPOINT, _GEO_KEY_DIRECTORY = 339, 33550, 33922, 34735
+_GDAL_METADATA = 42112
+_ASCII, _SHORT, _LONG, _DOUBLE, _LONG8 = 2, 3, 4, 12, 16
+_TYPE_FORMATS = {_SHORT: 'H', _LONG: 'I', _DOUBLE: 'd', _LONG8: 'Q'}
+
+_TIFF_COMPRESSION_CODES = {'none': 1, 'deflate': 8}
+
+
+def overview_factors(shape, tile_size=GEOTIFF_TILE_SIZE):
+    """Decimation factors (2, 4, 8, ...) until the overview fits in one tile."""
+    factors = []
+    factor = 2
+    while max(shape) / (factor // 2) > tile_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def downsample_mean(data, rows_per_block=1024, out=None):
+    """
+    Halve a raster by averaging 2x2 blocks (edge pixels average what is available).
+
+    Args:
+        data: 2D array (may be a memory map), read in blocks of rows
+        out: Optional destination array of shape ((h + 1) // 2, (w + 1) // 2),
+            e.g. a memory map; a float64 array is allocated otherwise
+    """
+    height, width = data.shape
+    if out is None:
+        out = np.empty(((height + 1) // 2, (width + 1) // 2), dtype=np.float64)
+    rows_per_block -= rows_per_block % 2
+    for start in range(0, height, rows_per_block):
+        block = np.asarray(data[start:start + rows_per_block], dtype=np.float64)
+        if block.shape[0] % 2:
+            block = np.vstack([block, block[-1:]])
+        if block.shape[1] % 2:
+            block = np.hstack([block, block[:, -1:]])
+        out[start // 2:start // 2 + block.shape[0] // 2] = (
+            block[0::2, 0::2] + block[1::2, 0::2] + block[0::2, 1::2] + block[1::2, 1::2]
+        ) / 4
+    return out
+
+
+def write_geotiff(dem_data, output_path, dtype=None, compression=None, tile_size=GEOTIFF_TILE_SIZE,
+                  overviews=True, epsg=DEFAULT_EPSG, statistics=None):
+    """
+    Write a DEM as a tiled, compressed GeoTIFF with internal overviews.
+
+    Args:
+        dem_data: 2D elevation array (may be a memory map)
+        output_path: Destination .tif file
+        dtype: Sample type, 'float32' or 'float64' (defaults to GEOTIFF_DTYPE)
+        compression: 'deflate', 'lzw', 'zstd' or 'none' (defaults to GEOTIFF_COMPRESSION)
+        tile_size: Internal tile edge length
+        overviews: Whether to add 2x-averaged overview levels
+        statistics: Optional dictionary with the 'min', 'max', 'mean' and
+            'std' of the DEM, written as GDAL band statistics
+
+    Returns:
+        Name of the backend that wrote the file
+    """
+    dtype = np.dtype(dtype or GEOTIFF_DTYPE)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError(f"Unsupported GeoTIFF sample type: {dtype}")
+    compression = (compression or GEOTIFF_COMPRESSION).lower()
+    factors = overview_factors(dem_data.shape, tile_size) if overviews else []
+    items = _statistics_items(statistics)
+
+    try:
+        import rasterio  # noqa: F401
+    except ImportError:
+        pass
+    else:
+        _write_rasterio(dem_data, output_path, dtype, compression, tile_size, factors, epsg, items)
+        return 'rasterio'
+
+    try:
+        import tifffile  # noqa: F401
+        if compression != 'none':
+            import imagecodecs  # noqa: F401  (tifffile's codecs and floating-point predictor)
+    except ImportError:
+        pass
+    else:
+        _write_tifffile(dem_data, output_path, dtype, compression, tile_size, factors, epsg, items)
+        return 'tifffile'
+
+    if compression not in _TIFF_COMPRESSION_CODES:
+        logging.getLogger(__name__).warning(f"{compression} needs rasterio or tifffile; using deflate")
+        compression = 'deflate'
+    _write_builtin(dem_data, output_path, dtype, compression, tile_size, factors, epsg, items)
+    return 'builtin'
+
+
+def _statistics_items(statistics):
+    """GDAL band statistics items (name -> text) of a statistics dictionary; empty without one."""
+    if not statistics or statistics.get('min') is None:
+        return {}
+    return {f'STATISTICS_{name}': repr(float(statistics[key]))
+            for name, key in (('MINIMUM', 'min'), ('MAXIMUM', 'max'), ('MEAN', 'mean'), ('STDDEV', 'std'))}
+
+
+def _gdal_metadata(items):
+    """GDAL_METADATA tag text with band 1 items."""
+    body = ''.join(f'<Item name="{name}" sample="0">{value}</Item>' for name, value in items.items())
+    return f'<GDALMetadata>{body}</GDALMetadata>'
+
+
+def _write_rasterio(dem_data, output_path, dtype, compression, tile_size, factors, epsg, items):
+    import rasterio
+    from rasterio.crs import CRS
+    from rasterio.enums import Resampling
+    from rasterio.transform import from_bounds
+    from rasterio.windows import Window
+
+    height, width = dem_data.shape
+    profile = dict(
+        driver='GTiff',
+        height=height,
+        width=width,
+        count=1,
+        dtype=dtype.name,
+        crs=CRS.from_epsg(epsg),
+        transform=from_bounds(0, 0, width, height, width, height),
+        tiled=True,
+        blockxsize=tile_size,
+        blockysize=tile_size,
+        BIGTIFF='IF_SAFER',
+    )
+    if compression != 'none':
+        profile.update(compress=compression, predictor=3)
+
+    with rasterio.open(output_path, 'w', **profile) as dst:
+        # Stream one row of tiles at a time so memory-mapped DEMs stay on disk
+        for start in range(0, height, tile_size):
+            rows = np.asarray(dem_data[start:start + tile_size], dtype=dtype)
+            dst.write(rows, 1, window=Window(0, start, width, rows.shape[0]))
+        if items:
+            dst.update_tags(1, **items)
+        if factors:
+            dst.build_overviews(factors, Resampling.average)
+            dst.update_tags(ns='rio_overview', resampling='average')
+
+
+def _geo_tags(height, width, epsg):
+    """ModelPixelScale, ModelTiepoint and GeoKeyDirectory values of a pixel-grid raster."""
+    pixel_scale = (1.0, 1.0, 0.0)
+    tiepoint = (0.0, 0.0, 0.0, 0.0, float(height), 0.0)
+    # Version 1.1.0 with three keys: geographic model, pixel-is-area, EPSG datum
+    geo_keys = (1, 1, 0, 3,
+                1024, 0, 1, 2,
+                1025, 0, 1, 1,
+                2048, 0, 1, epsg)
+    return pixel_scale, tiepoint, geo_keys
+
+
+def _write_tifffile(dem_data, output_path, dtype, compression, tile_size, factors, epsg, items):
+    import tifffile
+
+    height, width = dem_data.shape
+    pixel_scale, tiepoint, geo_keys = _geo_tags(height, width, epsg)
+    codec = {'deflate': 'zlib', 'none': None}.get(compression, compression)
+    options = dict(tile=(tile_size, tile_size), compression=codec, predictor=3 if codec else None,
+                   photometric='minisblack', metadata=None)
+
+    extratags = [
+        (_MODEL_PIXEL_SCALE, 'd', 3, pixel_scale, True),
+        (_MODEL_TIEPOINT, 'd', 6, tiepoint, True),
+        (_GEO_KEY_DIRECTORY, 'H', len(geo_keys), geo_keys, True),
+    ]
+    if items:
+        extratags.append((_GDAL_METADATA, 's', 0, _gdal_metadata(items), True))
+
+    with tifffile.TiffWriter(output_path, bigtiff=dem_data.size * dtype.itemsize > BIGTIFF_THRESHOLD) as tif:
+        tif.write(np.asarray(dem_data, dtype=dtype), subfiletype=0, extratags=extratags, **options)
+        level = dem_data
+        for _ in factors:
+            level = downsample_mean(level)
+            tif.write(level.astype(dtype), subfiletype=1, **options)
+
+
+def _predict_float(tile, dtype):
+    """TIFF floating-point predictor (3): byte planes per row, then horizontal differencing."""
+    rows, width = tile.shape
+    planes = tile.astype(dtype.newbyteorder('>')).view(np.uint8)
+    planes = planes.reshape(rows, width, dtype.itemsize).transpose(0, 2, 1).reshape(rows, -1)
+    predicted = planes.copy()
+    predicted[:, 1:] -= planes[:, :-1]
+    return predicted
+
+
+def _ifd_bytes(tags, ifd_offset, next_offset, big):
+    """
+    Serialise one IFD with its out-of-line values placed right after it.
+
+    Args:
+        tags: List of (tag, type, values) sorted by tag; ASCII values are
+            NUL-terminated bytes
+        ifd_offset: File offset the IFD will be written at
+        next_offset: Offset of the next IFD (0 for the last)
+        big: Whether to use the BigTIFF layout
+    """
+    count_format, offset_format, inline = ('Q', 'Q', 8) if big else ('H', 'I', 4)
+    entry_size = 20 if big else 12
+    header = struct.pack(f'<{count_format}', len(tags))
+    extra_offset = ifd_offset + len(header) + len(tags) * entry_size + struct.calcsize(offset_format)
+
+    entries, extra = [], []
+    for tag, field_type, values in tags:
+        if field_type == _ASCII:
+            payload = values
+        else:
+            payload = struct.pack(f'<{len(values)}{_TYPE_FORMATS[field_type]}', *values)
+        if len(payload) <= inline:
+            value = payload.ljust(inline, b'\0')
+        else:
+            value = struct.pack(f'<{offset_format}', extra_offset)
+            payload += b'\0' * (len(payload) % 2)  # Keep values word-aligned
+            extra.append(payload)
+            extra_offset += len(payload)
+        entries.append(struct.pack(f'<HH{offset_format}', tag, field_type, len(values)) + value)
+
+    return header + b''.join(entries) + struct.pack(f'<{offset_format}', next_offset) + b''.join(extra)
+
+
+def _write_builtin(dem_data, output_path, dtype, compression, tile_size, factors, epsg, items):
+    height, width = dem_data.shape
+    levels = [dem_data]
+    for _ in factors:
+        levels.append(downsample_mean(levels[-1]))
+
+    big = sum(level.size for level in levels) * dtype.itemsize > BIGTIFF_THRESHOLD
+    offset_type = _LONG8 if big else _LONG
+    code = _TIFF_COMPRESSION_CODES[compression]
+    pixel_scale, tiepoint, geo_keys = _geo_tags(height, width, epsg)
+
+    def level_tags(index, offsets, byte_counts):
+        level_height, level_width = levels[index].shape
+        tags = [
+            (_NEW_SUBFILE_TYPE, _LONG, (1 if index else 0,)),
+            (_IMAGE_WIDTH, _LONG, (level_width,)),
+            (_IMAGE_LENGTH, _LONG, (level_height,)),
+            (_BITS_PER_SAMPLE, _SHORT, (dtype.itemsize * 8,)),
+            (_COMPRESSION, _SHORT, (code,)),
+            (_PHOTOMETRIC, _SHORT, (1,)),
+            (_SAMPLES_PER_PIXEL, _SHORT, (1,)),
+            (_PLANAR_CONFIG, _SHORT, (1,)),
+        ]
+        if code != 1:
+            tags.append((_PREDICTOR, _SHORT, (3,)))
+        tags += [
+            (_TILE_WIDTH, _SHORT, (tile_size,)),
+            (_TILE_LENGTH, _SHORT, (tile_size,)),
+            (_TILE_OFFSETS, offset_type, offsets),
+            (_TILE_BYTE_COUNTS, offset_type, byte_counts),
+            (_SAMPLE_FORMAT, _SHORT, (3,)),
+        ]
+        if index == 0:
+            tags += [
+                (_MODEL_PIXEL_SCALE, _DOUBLE, pixel_scale),
+                (_MODEL_TIEPOINT, _DOUBLE, tiepoint),
+                (_GEO_KEY_DIRECTORY, _SHORT, geo_keys),
+            ]
+            if items:
+                tags.append((_GDAL_METADATA, _ASCII, _gdal_metadata(items).encode('ascii') + b'\0'))
+        return tags
+
+    def tile_counts(level):
+        return -(-level.shape[0] // tile_size) * -(-level.shape[1] // tile_size)
+
+    def ifd_block(offsets_per_level, counts_per_level):
+        """All IFDs, laid out back to back after the file header."""
+        position = 16 if big else 8
+        blobs = []
+        sizes = [len(_ifd_bytes(level_tags(i, offsets_per_level[i], counts_per_level[i]), 0, 0, big))
+                 for i in range(len(levels))]
+        for i in range(len(levels)):
+            next_offset = position + sizes[i] if i + 1 < len(levels) else 0
+            blobs.append(_ifd_bytes(level_tags(i, offsets_per_level[i], counts_per_level[i]),
+                                    position, next_offset, big))
+            position += sizes[i]
+        return b''.join(blobs)
+
+    placeholder = [[0] * tile_counts(level) for level in levels]
+    offsets, byte_counts = [None] * len(levels), [None] * len(levels)
+    header = (b'II' + struct.pack('<HHHQ', 43, 8, 0, 16)) if big else (b'II' + struct.pack('<HI', 42, 8))
+
+    with open(output_path, 'wb') as f:
+        # IFDs first (COG layout), patched with the real tile offsets at the end
+        f.write(header)
+        f.write(ifd_block(placeholder, placeholder))
+
+        # Smallest overview first, full resolution last
+        for index in reversed(range(len(levels))):
+            level = levels[index]
+            level_offsets, level_counts = [], []
+            for y0 in range(0, level.shape[0], tile_size):
+                rows = np.asarray(level[y0:y0 + tile_size], dtype=dtype)
+                for x0 in range(0, level.shape[1], tile_size):
+                    tile = np.zeros((tile_size, tile_size), dtype=dtype)
+                    block = rows[:, x0:x0 + tile_size]
+                    tile[:block.shape[0], :block.shape[1]] = block
+                    if code == 1:
+                        data = tile.astype(dtype.newbyteorder('<')).tobytes()
+                    else:
+                        data = zlib.compress(_predict_float(tile, dtype).tobytes(), DEFLATE_LEVEL)
+                    level_offsets.append(f.tell())
+                    level_counts.append(len(data))
+                    f.write(data)
+            offsets[index], byte_counts[index] = level_offsets, level_counts
+
+        f.seek(len(header))
+        f.write(ifd_block(offsets, byte_counts))
@@ -0,0 +1,212 @@
+"""
+Compact binary height meshes for the interactive 3D viewer.
+
+Instead of embedding plotly.js and the surface as JSON text in every job's
+HTML, the viewer page loads one shared plotly bundle and fetches the surface
+from /mesh/<job_id> as quantised uint16 heights. Several levels of detail are
+available; each is resampled from the DEM array once and cached next to it.
+
+Payload layout (little-endian):
+    4s  magic b'DEMM'
+    H   format version
+    H   reserved
+    I   mesh width, I mesh height
+    I   source DEM width, I source DEM height
+    f   minimum elevation, f maximum elevation
+    H[height * width] heights, 0..65535 mapped linearly onto [min, max]
+"""
+import os
+import struct
+
+import numpy as np
+
+from rendering import preview_array
+
+MESH_MAGIC = b'DEMM'
+MESH_VERSION = 1
+MESH_HEADER = struct.Struct('<4sHHIIIIff')
+
+# Longest side of each level of detail, and the one the viewer loads first
+MESH_LOD_SIZES = (128, 256, 512, 1024)
+DEFAULT_MESH_SIZE = 256
+
+# Root-relative URL of the plotly bundle used by the viewer page
+PLOTLY_BUNDLE_URL = '/assets/plotly.min.js'
+
+# Left in the saved viewer page and replaced with the job's mesh URL when it is
+# served, as cache hits share the page of the job that computed the result
+MESH_URL_PLACEHOLDER = '{{MESH_URL}}'
+
+
+def plotly_bundle_path():
+    """Path of the plotly.js bundle shipped with the plotly Python package."""
+    import plotly
+    return os.path.join(os.path.dirname(plotly.__file__), 'package_data', 'plotly.min.js')
+
+
+def lod_size(requested):
+    """Largest level of detail not above `requested` (the smallest one at least)."""
+    fitting = [size for size in MESH_LOD_SIZES if size <= requested]
+    return fitting[-1] if fitting else MESH_LOD_SIZES[0]
+
+
+def encode_mesh(dem_data, max_side):
+    """Resample a DEM to at most `max_side` pixels per side and pack it as a mesh payload."""
+    heights = preview_array(dem_data, max_side)
+    zmin, zmax = float(heights.min()), float(heights.max())
+    span = zmax - zmin if zmax > zmin else 1.0
+    quantised = np.rint((heights - zmin) * (65535 / span)).astype('<u2')
+    header = MESH_HEADER.pack(MESH_MAGIC, MESH_VERSION, 0, heights.shape[1], heights.shape[0],
+                              dem_data.shape[1], dem_data.shape[0], zmin, zmax)
+    return header + quantised.tobytes()
+
+
+def decode_mesh(payload):
+    """Inverse of encode_mesh: (heights as float32, source shape)."""
+    magic, version, _, width, height, source_width, source_height, zmin, zmax = MESH_HEADER.unpack_from(payload)
+    if magic != MESH_MAGIC or version != MESH_VERSION:
+        raise ValueError("Not a DEM mesh payload")
+    quantised = np.frombuffer(payload, dtype='<u2', offset=MESH_HEADER.size).reshape(height, width)
+    heights = zmin + quantised.astype(np.float32) * np.float32((zmax - zmin) / 65535)
+    return heights, (source_height, source_width)
+
+
+def mesh_path(output_folder, job_id, size):
+    return os.path.join(output_folder, f"{job_id}_mesh_{size}.bin")
+
+
+def ensure_mesh(output_folder, job_id, size, dem_data=None):
+    """
+    Path of a job's mesh at a level of detail, building it from the DEM if needed.
+
+    Raises:
+        FileNotFoundError: If the job has no DEM array
+    """
+    from artifacts import dem_array_path
+
+    path = mesh_path(output_folder, job_id, size)
+    if os.path.exists(path):
+        return path
+    if dem_data is None:
+        dem_data = np.load(dem_array_path(output_folder, job_id), mmap_mode='r')
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(encode_mesh(dem_data, size))
+    os.replace(tmp_path, path)
+    return path
+
+
+def viewer_html():
+    """
+    Small page that draws a mesh with the shared plotly bundle.
+
+    The page is the same for every job; fill_viewer() sets the mesh URL.
+    """
+    return VIEWER_TEMPLATE.replace('{{PLOTLY_URL}}', PLOTLY_BUNDLE_URL) \
+                          .replace('{{LOD_SIZES}}', ','.join(str(size) for size in MESH_LOD_SIZES)) \
+                          .replace('{{DEFAULT_SIZE}}', str(DEFAULT_MESH_SIZE))
+
+
+def fill_viewer(html, mesh_url):
+    """Viewer page from viewer_html() pointed at a job's mesh URL."""
+    return html.replace(MESH_URL_PLACEHOLDER, mesh_url)
+
+
+VIEWER_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <title>3D DEM Visualization</title>
+    <script src="{{PLOTLY_URL}}"></script>
+    <style>
+        body { margin: 0; font-family: sans-serif; background: white; }
+        #controls { position: absolute; top: 8px; left: 8px; z-index: 10; }
+        #dem-3d-plot { width: 100vw; height: 100vh; }
+    </style>
+</head>
+<body>
+    <div id="controls">
+        Detail: <select id="lod"></select>
+        <span id="status"></span>
+    </div>
+    <div id="dem-3d-plot"></div>
+    <script>
+    const meshUrl = "{{MESH_URL}}";
+    const sizes = [{{LOD_SIZES}}];
+    const select = document.getElementById('lod');
+    sizes.forEach(function(size) {
+        const option = document.createElement('option');
+        option.value = size;
+        option.textContent = size + ' px';
+        option.selected = size === {{DEFAULT_SIZE}};
+        select.appendChild(option);
+    });
+
+    function decodeMesh(buffer) {
+        const view = new DataView(buffer);
+        const magic = String.fromCharCode(view.getUint8(0), view.getUint8(1), view.getUint8(2), view.getUint8(3));
+        if (magic !== 'DEMM') throw new Error('Invalid mesh payload');
+        const width = view.getUint32(8, true), height = view.getUint32(12, true);
+        const sourceWidth = view.getUint32(16, true), sourceHeight = view.getUint32(20, true);
+        const zmin = view.getFloat32(24, true), zmax = view.getFloat32(28, true);
+        const quantised = new Uint16Array(buffer, 32, width * height);
+        const step = (zmax - zmin) / 65535;
+        const z = [];
+        for (let row = 0; row < height; row++) {
+            const values = new Float32Array(width);
+            for (let col = 0; col < width; col++) values[col] = zmin + quantised[row * width + col] * step;
+            z.push(values);
+        }
+        const axis = function(count, extent) {
+            const coords = new Float32Array(count);
+            for (let i = 0; i < count; i++) coords[i] = count > 1 ? i * (extent - 1) / (count - 1) : 0;
+            return coords;
+        };
+        return {z: z, x: axis(width, sourceWidth), y: axis(height, sourceHeight)};
+    }
+
+    function load(size) {
+        document.getElementById('status').textContent = 'Loading...';
+        fetch(meshUrl + '?size=' + size)
+            .then(function(response) {
+                if (!response.ok) throw new Error('HTTP ' + response.status);
+                return response.arrayBuffer();
+            })
+            .then(function(buffer) {
+                const mesh = decodeMesh(buffer);
+                Plotly.react('dem-3d-plot', [{
+                    type: 'surface',
+                    z: mesh.z,
+                    x: mesh.x,
+                    y: mesh.y,
+                    colorscale: 'Earth',
+                    colorbar: {title: {text: 'Elevation (m)'}},
+                    contours: {z: {show: true, usecolormap: true, project: {z: true}, size: 5}},
+                    lighting: {ambient: 0.4, diffuse: 0.8, fresnel: 0.1, specular: 0.05, roughness: 0.05}
+                }], {
+                    title: {text: '3D Digital Elevation Model', x: 0.5, font: {size: 16}},
+                    scene: {
+                        xaxis: {title: {text: 'X Coordinate (pixels)'}, backgroundcolor: 'rgba(0,0,0,0)', gridcolor: 'lightgray'},
+                        yaxis: {title: {text: 'Y Coordinate (pixels)'}, backgroundcolor: 'rgba(0,0,0,0)', gridcolor: 'lightgray'},
+                        zaxis: {title: {text: 'Elevation (meters)'}, backgroundcolor: 'rgba(0,0,0,0)', gridcolor: 'lightgray'},
+                        camera: {eye: {x: 1.5, y: 1.5, z: 1.2}},
+                        bgcolor: 'rgba(0,0,0,0)'
+                    },
+                    margin: {l: 0, r: 0, t: 40, b: 0},
+                    paper_bgcolor: 'white',
+                    plot_bgcolor: 'white'
+                });
+                document.getElementById('status').textContent = '';
+            })
+            .catch(function(error) {
+                document.getElementById('status').textContent = '3D model not available: ' + error.message;
+            });
+    }
+
+    select.addEventListener('change', function() { load(parseInt(select.value, 10)); });
+    load({{DEFAULT_SIZE}});
+    </script>
+</body>
+</html>
+"""
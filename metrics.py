@@ -0,0 +1,293 @@
+"""
+Prometheus metrics of the web application and the job worker pool.
+
+Metrics live in process memory and are exported in the Prometheus text format
+(version 0.0.4) by GET /metrics (see app.py), so no client library is needed.
+Updating a metric takes a lock and a dictionary update. Values that would be
+expensive to compute on every scrape (job counts from the database, disk
+usage of the upload and output folders) come from collectors that are
+refreshed at most once per DEM_METRICS_REFRESH seconds.
+
+Every process exports its own counters. With several gunicorn workers, scrape
+each one (or run one web worker). A standalone ``python worker.py`` serves
+its own job metrics on DEM_WORKER_METRICS_PORT.
+"""
+import os
+import math
+import time
+import logging
+import threading
+
+# Minimum seconds between refreshes of the database and disk usage collectors
+REFRESH_INTERVAL = float(os.environ.get('DEM_METRICS_REFRESH', 30))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Histogram buckets: seconds for pipeline stages, seconds for whole jobs, bytes for uploads
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+JOB_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+SIZE_BUCKETS = tuple(float(4 ** n * 1024) for n in range(3, 12))  # 64 KiB ... 4 GiB
+
+logger = logging.getLogger(__name__)
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Registry:
+    """Metrics exported together by render()."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add a metric; one registered earlier under the same name is replaced."""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def render(self):
+        """All metrics in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                # A failing collector must not take the whole endpoint down
+                logger.warning(f"Could not collect metric {metric.name}: {str(e)}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        """
+        Args:
+            name: Metric name, e.g. 'dem_jobs_total'
+            documentation: HELP text
+            labelnames: Names of the labels every update must provide
+            registry: Registry exporting the metric (None for none)
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name, _format_labels(self.labelnames, key), value) for key, value in values]
+
+
+class Counter(_Metric):
+    """Monotonically increasing count."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, either set directly or read from a function at scrape time."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, function=None):
+        """
+        Args:
+            function: Optional callable returning the current value, or a dict
+                of {label value tuple: value} for labelled gauges
+        """
+        self.function = function
+        super().__init__(name, documentation, labelnames, registry)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(self.name, _format_labels(self.labelnames, key), value)
+                for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, buckets=STAGE_BUCKETS):
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][index] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, dict(state, counts=list(state['counts']))) for key, state in self._values.items())
+        samples = []
+        for key, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state['counts']):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                samples.append((f"{self.name}_bucket", labels, cumulative))
+            labels = _format_labels(self.labelnames, key, [('le', '+Inf')])
+            samples.append((f"{self.name}_bucket", labels, state['count']))
+            samples.append((f"{self.name}_sum", _format_labels(self.labelnames, key), state['sum']))
+            samples.append((f"{self.name}_count", _format_labels(self.labelnames, key), state['count']))
+        return samples
+
+
+def throttled(function, interval=None):
+    """
+    Wrap a collector so it runs at most once per `interval` seconds.
+
+    Scrapes in between get the previous result. Concurrent scrapes do not
+    recompute it twice.
+    """
+    interval = REFRESH_INTERVAL if interval is None else interval
+    lock = threading.Lock()
+    state = {'at': None, 'value': None}
+
+    def collect():
+        with lock:
+            now = time.monotonic()
+            if state['at'] is None or now - state['at'] >= interval:
+                state['value'] = function()
+                state['at'] = now
+            return state['value']
+    return collect
+
+
+def directory_size(path):
+    """Bytes used by the files below `path`, counting hard-linked files once."""
+    total = 0
+    seen = set()
+    pending = [path]
+    while pending:
+        try:
+            entries = list(os.scandir(pending.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    if stat.st_nlink > 1:
+                        if (stat.st_dev, stat.st_ino) in seen:
+                            continue
+                        seen.add((stat.st_dev, stat.st_ino))
+                    total += stat.st_size
+            except OSError:
+                # Files come and go while jobs run
+                continue
+    return total
+
+
+def serve(port, host='0.0.0.0', registry=REGISTRY):
+    """Serve `registry` on http://host:port/metrics from a daemon thread (for processes without Flask)."""
+    from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    def application(environ, start_response):
+        if environ.get('PATH_INFO') != '/metrics':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not found']
+        start_response('200 OK', [('Content-Type', CONTENT_TYPE)])
+        return [registry.render().encode('utf-8')]
+
+    server = make_server(host, port, application, handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever, name='dem-metrics', daemon=True).start()
+    logger.info(f"Serving metrics on port {port}")
+    return server
+
+
+# Metrics of the processing pipeline, updated by app.py and worker.py
+JOBS = Counter('dem_jobs_total', 'Job state transitions: queued, cached, completed, failed, retried', ['status'])
+JOB_DURATION = Histogram('dem_job_duration_seconds', 'Processing time of finished jobs', ['status'],
+                         buckets=JOB_BUCKETS)
+JOB_QUEUE_WAIT = Histogram('dem_job_queue_wait_seconds', 'Time jobs waited in the queue before a worker started them',
+                           buckets=JOB_BUCKETS)
+STAGE_DURATION = Histogram('dem_stage_duration_seconds', 'Wall time of pipeline stages and output writers',
+                           ['stage'], buckets=STAGE_BUCKETS)
+UPLOAD_BYTES = Histogram('dem_upload_bytes', 'Size of accepted uploads', buckets=SIZE_BUCKETS)
+UPLOADS_REJECTED = Counter('dem_uploads_rejected_total', 'Uploads rejected as invalid, too large or undecodable')
+CACHE_REQUESTS = Counter('dem_cache_requests_total', 'Cache lookups by cache (result, stage, artifact, dem_store) and outcome',
+                         ['cache', 'outcome'])
+JOBS_IN_FLIGHT = Gauge('dem_worker_jobs_in_flight', 'Jobs currently running on this process\'s worker pool')
+
+
+def observe_stage_metrics(stage_metrics):
+    """Add the wall times of a StageProfiler report to STAGE_DURATION."""
+    for stage, values in (stage_metrics or {}).items():
+        STAGE_DURATION.observe(values['wall_seconds'], stage=stage)
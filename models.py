@@ -1,4 +1,5 @@
 from app import db
+import json
 from datetime import datetime
 
 class ProcessingJob(db.Model):
@@ -6,14 +7,65 @@ class ProcessingJob(db.Model):
     id = db.Column(db.String(36), primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
     filepath = db.Column(db.String(255), nullable=False)
-    status = db.Column(db.String(50), nullable=False, default='pending')  # pending, processing, completed, failed
+    status = db.Column(db.String(50), nullable=False, default='pending', index=True)  # pending, processing, completed, failed
     scale_factor = db.Column(db.Float, default=1.0)
     smoothing = db.Column(db.Integer, default=3)
     elevation_range = db.Column(db.Float, default=255.0)
-    output_files = db.Column(db.Text)  # JSON string of output file paths
+    workers = db.Column(db.Integer, default=1)  # Parallel tile workers for this job
+    eager_formats = db.Column(db.String(255))  # Comma-separated download types generated by the worker
+    mesh_max_error = db.Column(db.Float)  # Vertical error bound (m) of terrain mesh downloads
+    solver = db.Column(db.String(20), default='heuristic')  # Height estimator: heuristic or sfs (shape-from-shading)
+    sun_azimuth = db.Column(db.Float)  # Illumination of the sfs solver (degrees clockwise from image up)
+    sun_elevation = db.Column(db.Float)  # Sun elevation above the horizon (degrees)
+    reflectance = db.Column(db.String(20))  # Reflectance model of the sfs solver: lambert or lunar_lambert
+    content_hash = db.Column(db.String(64))  # SHA-256 of the uploaded bytes
+    batch_id = db.Column(db.String(36), index=True)  # Batch submitted through POST /batch, if any
+    cache_key = db.Column(db.String(64), index=True)  # Result cache key (content hash + parameters)
+    output_files = db.Column(db.Text)  # JSON string of generated output files
     processing_log = db.Column(db.Text)
+    stage_report = db.Column(db.Text)  # JSON map of pipeline stage to reused/computed
+    stage_metrics = db.Column(db.Text)  # JSON map of stage to timing/memory/IO metrics (see profiling.py)
+    statistics = db.Column(db.Text)  # JSON elevation and terrain derivative statistics (see terrain_derivatives.py)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     completed_at = db.Column(db.DateTime)
     
+    # Worker bookkeeping (see worker.py)
+    worker_id = db.Column(db.String(64))  # Worker that claimed the job
+    attempts = db.Column(db.Integer, default=0)  # Number of times the job was claimed
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)  # Refreshed while a worker owns the job
+    
+    @property
+    def stages(self):
+        """Decoded stage_report as an ordered list of (stage, outcome) pairs."""
+        from stage_cache import STAGES
+        report = json.loads(self.stage_report) if self.stage_report else {}
+        return [(name, report[name]) for name in STAGES if name in report]
+    
+    @property
+    def metrics(self):
+        """Decoded stage_metrics as a list of (stage, metrics) pairs in execution order."""
+        return list(json.loads(self.stage_metrics).items()) if self.stage_metrics else []
+    
+    @property
+    def stats(self):
+        """Decoded statistics (empty for jobs that have none)."""
+        return json.loads(self.statistics) if self.statistics else {}
+    
     def __repr__(self):
         return f'<ProcessingJob {self.id}: {self.filename}>'
+
+class CacheEntry(db.Model):
+    """Cached artifacts of a finished job, shared by later identical uploads."""
+    key = db.Column(db.String(64), primary_key=True)
+    source_job_id = db.Column(db.String(36))  # Job that produced the artifacts
+    output_files = db.Column(db.Text)  # JSON map of artifact name to file suffix
+    processing_log = db.Column(db.Text)
+    statistics = db.Column(db.Text)  # JSON statistics of the source job
+    size_bytes = db.Column(db.BigInteger, default=0)
+    hits = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<CacheEntry {self.key}: {self.size_bytes} bytes>'
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Seamless mosaics of adjacent image tiles.
+
+Converting the tiles of one strip separately gives every tile its own elevation
+scale (_height_from_shading normalizes by the image's own gradient maximum and
+min/max), its own contrast enhancement and mirrored borders, so neighbouring
+DEMs do not join. The mosaic builder instead treats the grid as one raster
+that is never held in memory:
+
+1. Decode every tile and add it into a memory-mapped grayscale mosaic. Adjacent
+   tiles may overlap by a fixed number of pixels; in the overlaps the weights
+   ramp linearly from one tile to the next and always sum to one.
+2. Contrast-enhance the mosaic block by block (mosaic_clahe). CLAHE works on
+   a grid of cells; every block is read with one cell of its neighbours, so the
+   result equals CLAHE of the whole mosaic with the cell size the tiles would
+   have on their own.
+3. Run the tiled engine of tiling.py on the enhanced mosaic. It reads every
+   tile with a halo of real neighbouring pixels for the smoothing, Sobel and
+   post-smoothing kernels, and takes the gradient maximum and estimate
+   min/max over the whole mosaic.
+
+The DEM therefore has no seams at tile borders: for a grid cut from one image
+whose tile sides are multiples of 8, it matches converting the whole image
+with a CLAHE grid of 8 cells per tile.
+
+Command line:
+
+    python mosaic.py strip/*.png --columns 8 --overlap 64 --output dems/ --name strip_0412 --formats dem
+"""
+import argparse
+import functools
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+import numpy as np
+
+# Default overlap in pixels between adjacent tiles
+DEFAULT_MOSAIC_OVERLAP = int(os.environ.get('DEM_MOSAIC_OVERLAP', 0))
+
+
+def grid_from_paths(paths, columns):
+    """Arrange tile paths given in row-major order into rows of `columns` tiles."""
+    if columns < 1 or len(paths) % columns:
+        raise ValueError(f"{len(paths)} tiles do not form rows of {columns}")
+    return [list(paths[start:start + columns]) for start in range(0, len(paths), columns)]
+
+
+def feather_weights(length, overlap_before, overlap_after, dtype=np.float32):
+    """
+    Blending weights of a tile along one axis.
+
+    The weights ramp up from 0 over the overlap with the previous tile and down
+    to 0 over the overlap with the next one, at pixel centres, so that the
+    weights of two neighbours sum to exactly one across their overlap.
+
+    Args:
+        length: Tile size along the axis
+        overlap_before: Pixels shared with the previous tile (0 at the mosaic edge)
+        overlap_after: Pixels shared with the next tile (0 at the mosaic edge)
+    """
+    weights = np.ones(length, dtype=np.float64)
+    if overlap_before:
+        weights[:overlap_before] = (np.arange(overlap_before) + 0.5) / overlap_before
+    if overlap_after:
+        weights[length - overlap_after:] = 1.0 - (np.arange(overlap_after) + 0.5) / overlap_after
+    return weights.astype(dtype)
+
+
+def grid_offsets(sizes, overlap):
+    """Start of every tile along one axis of the mosaic, and the mosaic size."""
+    offsets = np.concatenate(([0], np.cumsum(sizes[:-1]) - overlap * np.arange(1, len(sizes))))
+    return offsets.astype(int).tolist(), int(sum(sizes) - overlap * (len(sizes) - 1))
+
+
+# Contrast enhancement of DEMProcessor._enhance_contrast: clip limit, and
+# cells per side of a single image
+CLAHE_CLIP_LIMIT = 2.0
+CLAHE_GRID = 8
+
+# Approximate side in pixels of the blocks enhanced at once by mosaic_clahe
+CLAHE_BLOCK = 2048
+
+
+def mosaic_clahe(source, destination, cell, clip_limit=CLAHE_CLIP_LIMIT, map_blocks=map):
+    """
+    CLAHE of a large uint8 raster with a fixed cell size, block by block.
+
+    Each block of whole cells is enhanced together with one cell of halo on
+    every side, which holds all the cells its pixels interpolate between. The
+    raster is padded to whole cells (BORDER_REFLECT_101, like OpenCV), so the
+    result equals cv2 CLAHE of the padded raster.
+
+    Args:
+        source: 2D uint8 array-like (e.g. np.memmap)
+        destination: Writable array of the same shape
+        cell: (height, width) of a CLAHE cell in pixels
+        map_blocks: map-like callable used to process the blocks (e.g. a pool's map)
+    """
+    import cv2
+    height, width = source.shape
+    cell_h, cell_w = cell
+    step_y = max(CLAHE_BLOCK // cell_h, 1) * cell_h
+    step_x = max(CLAHE_BLOCK // cell_w, 1) * cell_w
+
+    def enhance(origin):
+        y0, x0 = origin
+        y1, x1 = min(y0 + step_y, height), min(x0 + step_x, width)
+        wy0, wx0 = max(y0 - cell_h, 0), max(x0 - cell_w, 0)
+        wy1, wx1 = min(y1 + cell_h, height), min(x1 + cell_w, width)
+        window = np.asarray(source[wy0:wy1, wx0:wx1])
+        # Only windows at the bottom or right edge can end inside a cell
+        pad_y, pad_x = -window.shape[0] % cell_h, -window.shape[1] % cell_w
+        if pad_y or pad_x:
+            window = cv2.copyMakeBorder(window, 0, pad_y, 0, pad_x, cv2.BORDER_REFLECT_101)
+        grid = (window.shape[1] // cell_w, window.shape[0] // cell_h)
+        enhanced = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=grid).apply(window)
+        destination[y0:y1, x0:x1] = enhanced[y0 - wy0:y1 - wy0, x0 - wx0:x1 - wx0]
+
+    list(map_blocks(enhance, [(y0, x0) for y0 in range(0, height, step_y) for x0 in range(0, width, step_x)]))
+
+
+class MosaicBuilder:
+    """Globally normalized DEM of a grid of image tiles, computed as one raster."""
+
+    def __init__(self, processor=None, workers=1, scratch_dir=None, tile_budget=None):
+        """
+        Args:
+            processor: DEMProcessor whose kernels are applied to the mosaic
+            workers: Number of tiles and blocks processed concurrently (threads)
+            scratch_dir: Directory for intermediate files (defaults to the
+                output's directory)
+            tile_budget: Working-set budget per block of the tiled engine in bytes
+        """
+        if processor is None:
+            from dem_processor import DEMProcessor
+            processor = DEMProcessor()
+        self.processor = processor
+        self.workers = max(int(workers or 1), 1)
+        self.scratch_dir = scratch_dir
+        self.tile_budget = tile_budget
+        self.logger = logging.getLogger(__name__)
+        self._accumulate_lock = threading.Lock()
+
+    def build(self, grid, output_path, overlap=None, scale_factor=1.0, smoothing=3, elevation_range=255.0):
+        """
+        Build the mosaic DEM and write it to `output_path` as a .npy file.
+
+        Args:
+            grid: Rows of tile image paths; tiles of a row share their height and
+                tiles of a column their width
+            output_path: Destination .npy file of the mosaic DEM
+            overlap: Pixels shared by adjacent tiles (defaults to DEM_MOSAIC_OVERLAP)
+            scale_factor: Scaling factor for elevation values
+            smoothing: Gaussian blur kernel size for smoothing
+            elevation_range: Maximum elevation value in meters
+
+        Returns:
+            Read-only memory map of the mosaic DEM
+
+        Raises:
+            ValueError: If the grid is not rectangular or the tile sizes do not line up
+        """
+        from tiling import TiledHeightFromShading
+        overlap = DEFAULT_MOSAIC_OVERLAP if overlap is None else int(overlap)
+        if not grid or not grid[0] or any(len(row) != len(grid[0]) for row in grid):
+            raise ValueError("Mosaic grid must be a non-empty rectangle of tiles")
+        if overlap < 0:
+            raise ValueError("Overlap must not be negative")
+        cells = [(row, col) for row in range(len(grid)) for col in range(len(grid[0]))]
+
+        scratch = tempfile.mkdtemp(prefix='.mosaic-', dir=self.scratch_dir or os.path.dirname(
+            os.path.abspath(output_path)))
+        pool = self._create_pool()
+        try:
+            ctx = {'grid': grid, 'scratch': scratch}
+
+            # Pass 1: decode every tile once and check that the grid lines up
+            shapes = dict(zip(cells, self._map(pool, self._decode_tile, ctx, cells)))
+            heights, widths = self._grid_sizes(grid, shapes, overlap)
+            row_offsets, height = grid_offsets(heights, overlap)
+            col_offsets, width = grid_offsets(widths, overlap)
+            self.logger.info(f"Mosaic of {len(grid)}x{len(grid[0])} tiles, {overlap}px overlap: "
+                             f"{width}x{height} pixels")
+
+            # Pass 2: feather the tiles into one grayscale raster
+            gray_path = os.path.join(scratch, 'gray.npy')
+            ctx.update({
+                'gray': gray_path,
+                'row_offsets': row_offsets,
+                'col_offsets': col_offsets,
+                'row_weights': [feather_weights(size, overlap if row else 0,
+                                                overlap if row < len(heights) - 1 else 0)
+                                for row, size in enumerate(heights)],
+                'col_weights': [feather_weights(size, overlap if col else 0,
+                                                overlap if col < len(widths) - 1 else 0)
+                                for col, size in enumerate(widths)],
+            })
+            np.lib.format.open_memmap(gray_path, mode='w+', dtype=np.float32, shape=(height, width)).flush()
+            self._map(pool, self._place_tile, ctx, cells)
+            gray = np.load(gray_path, mmap_mode='r')
+            levels = np.lib.format.open_memmap(os.path.join(scratch, 'levels.npy'), mode='w+', dtype=np.uint8,
+                                               shape=(height, width))
+            for start in range(0, height, CLAHE_BLOCK):
+                levels[start:start + CLAHE_BLOCK] = np.rint(gray[start:start + CLAHE_BLOCK])
+            del gray
+            os.remove(gray_path)
+
+            # Pass 3: contrast enhancement with the cell size of a single tile
+            cell = (-(-min(heights) // CLAHE_GRID), -(-min(widths) // CLAHE_GRID))
+            enhanced = np.lib.format.open_memmap(os.path.join(scratch, 'enhanced.npy'), mode='w+',
+                                                 dtype=np.uint8, shape=(height, width))
+            mosaic_clahe(levels, enhanced, cell, map_blocks=pool.map if pool is not None else map)
+            enhanced.flush()
+            del levels
+
+            # Pass 4: height-from-shading over the whole mosaic with halos and global reductions
+            engine = TiledHeightFromShading(self.processor, tile_budget=self.tile_budget, scratch_dir=scratch,
+                                            workers=self.workers)
+            normalized_path = os.path.join(scratch, 'normalized.npy')
+            normalized = engine.run(enhanced, normalized_path, smoothing)
+            self.processor._scale_dem_to_file(normalized, elevation_range * scale_factor, output_path)
+            del normalized, enhanced
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            shutil.rmtree(scratch, ignore_errors=True)
+
+        return np.load(output_path, mmap_mode='r')
+
+    def _decode_tile(self, ctx, cell):
+        """Pass 1: decode a tile to grayscale into scratch; returns its shape."""
+        row, col = cell
+        image = self.processor._load_grayscale(ctx['grid'][row][col])
+        np.save(self._scratch_path(ctx, cell, 'gray'), image)
+        return image.shape
+
+    def _place_tile(self, ctx, cell):
+        """Pass 2: add a tile into the grayscale mosaic with its feathering weights."""
+        row, col = cell
+        tile_path = self._scratch_path(ctx, cell, 'gray')
+        tile = np.load(tile_path).astype(np.float32)
+        os.remove(tile_path)
+        tile *= ctx['row_weights'][row][:, None]
+        tile *= ctx['col_weights'][col][None, :]
+
+        y0, x0 = ctx['row_offsets'][row], ctx['col_offsets'][col]
+        region = (slice(y0, y0 + tile.shape[0]), slice(x0, x0 + tile.shape[1]))
+        with self._accumulate_lock:
+            gray = np.load(ctx['gray'], mmap_mode='r+')
+            gray[region] += tile
+            gray.flush()
+            del gray
+
+    def _grid_sizes(self, grid, shapes, overlap):
+        """Row heights and column widths of the grid, checking that the tiles line up."""
+        heights = [shapes[(row, 0)][0] for row in range(len(grid))]
+        widths = [shapes[(0, col)][1] for col in range(len(grid[0]))]
+        for (row, col), shape in shapes.items():
+            if shape[:2] != (heights[row], widths[col]):
+                raise ValueError(f"Tile {grid[row][col]} is {shape[1]}x{shape[0]}; tiles in its row must be "
+                                 f"{heights[row]} high and tiles in its column {widths[col]} wide")
+        if 2 * overlap > min(heights + widths):
+            raise ValueError(f"Overlap of {overlap}px exceeds half the smallest tile dimension")
+        return heights, widths
+
+    def _scratch_path(self, ctx, cell, name):
+        return os.path.join(ctx['scratch'], f"{cell[0]}_{cell[1]}_{name}.npy")
+
+    def _create_pool(self):
+        if self.workers <= 1:
+            return None
+        from concurrent.futures import ThreadPoolExecutor
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='dem-mosaic')
+
+    def _map(self, pool, task, ctx, cells):
+        if pool is None:
+            return [task(ctx, cell) for cell in cells]
+        return list(pool.map(functools.partial(task, ctx), cells))
+
+
+def main(argv=None):
+    from batch import collect_inputs, read_manifest
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('tiles', nargs='*', help='Tile images (or a directory of them) in row-major order')
+    parser.add_argument('--manifest', help='File listing the tiles in row-major order, one per line')
+    parser.add_argument('--columns', type=int, required=True, help='Tiles per grid row')
+    parser.add_argument('--overlap', type=int, default=None, help='Pixels shared by adjacent tiles')
+    parser.add_argument('--output', required=True, help='Output directory')
+    parser.add_argument('--name', default='mosaic', help='Name of the output files')
+    parser.add_argument('--scale-factor', type=float, default=1.0)
+    parser.add_argument('--smoothing', type=int, default=3)
+    parser.add_argument('--elevation-range', type=float, default=255.0)
+    parser.add_argument('--mesh-max-error', type=float, help='Vertical error bound (m) of mesh formats')
+    parser.add_argument('--formats', default='dem', help='Comma-separated download types to write')
+    parser.add_argument('--workers', type=int, default=1, help='Tiles processed concurrently')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    from artifacts import dem_array_path, ensure_artifact, parse_formats
+    paths = list(args.tiles)
+    if args.manifest:
+        paths.extend(read_manifest(args.manifest))
+    try:
+        grid = grid_from_paths(collect_inputs(paths), args.columns)
+        formats = parse_formats(args.formats)
+    except (FileNotFoundError, ValueError) as e:
+        parser.error(str(e))
+
+    os.makedirs(args.output, exist_ok=True)
+    builder = MosaicBuilder(workers=args.workers)
+    try:
+        dem = builder.build(grid, dem_array_path(args.output, args.name), overlap=args.overlap,
+                            scale_factor=args.scale_factor, smoothing=args.smoothing,
+                            elevation_range=args.elevation_range)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"Mosaic of {len(grid)}x{len(grid[0])} tiles: {dem.shape[1]}x{dem.shape[0]} pixels")
+
+    for file_type in formats:
+        ensure_artifact(args.output, args.name, file_type, processor=builder.processor, dem_data=dem,
+                        options={'max_error': args.mesh_max_error})
+        print(f"Wrote {file_type}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+"""
+Per-stage instrumentation of the DEM pipeline.
+
+DEMProcessor measures every pipeline step (decode, CLAHE, Sobel, output
+writers, ...) with a StageProfiler. Each stage records:
+
+- wall_seconds: elapsed time
+- cpu_seconds: process CPU time, including the tiled engine's worker threads
+- peak_rss_delta_bytes: how far the resident set rose above its level at the
+  start of the stage, including anything the stage triggered
+- bytes_written: bytes passed to write calls, plus memory-mapped arrays the
+  stage produced
+
+Stages that trigger other stages (such as CLAHE triggering the decode) report
+time and bytes exclusive of those. The counters are process-wide, so the
+numbers are only exact while one job runs per process, as in the worker pool.
+Peak RSS is read from /proc/self/status, and the peak is reset at every stage
+boundary where the kernel allows it. Elsewhere the growth of getrusage's
+lifetime maximum is reported instead.
+
+DEM_PROFILE=cprofile (or pyinstrument, if installed) additionally dumps a
+profile of every job to ``<job_id>_profile.prof`` (or ``.html``) in the output
+folder.
+"""
+import os
+import time
+import logging
+import resource
+from contextlib import contextmanager
+
+# Deep profiler run around every job: '', 'cprofile' or 'pyinstrument'
+PROFILER = os.environ.get('DEM_PROFILE', '').lower()
+
+METRIC_FIELDS = ('wall_seconds', 'cpu_seconds', 'peak_rss_delta_bytes', 'bytes_written')
+
+logger = logging.getLogger(__name__)
+
+
+def _proc_status_bytes(*fields):
+    """Values in bytes of `fields` (e.g. 'VmRSS') in /proc/self/status, or None."""
+    try:
+        with open('/proc/self/status') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    values = {}
+    for line in lines:
+        key, _, value = line.partition(':')
+        if key in fields:
+            values[key] = int(value.split()[0]) * 1024
+    return tuple(values.get(field) for field in fields)
+
+
+def _bytes_written():
+    """Bytes passed to write calls by this process so far (0 where /proc/self/io is missing)."""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _reset_peak_rss():
+    """Reset the kernel's peak RSS (VmHWM) to the current RSS; False if not supported."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _lifetime_peak_rss():
+    """getrusage maximum resident set size in bytes (KiB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+class StageProfiler:
+    """Collects per-stage metrics of one job."""
+
+    def __init__(self):
+        self.stages = {}  # Stage name -> metrics, in start order
+        self._open = []  # Frames of the stages currently running, innermost last
+        self._mapped = set()  # Memory-mapped outputs already counted by some stage
+        self._resettable = None
+
+    @contextmanager
+    def stage(self, name, written_to=None):
+        """
+        Measure the enclosed block as stage `name` (repeated stages are summed).
+
+        Args:
+            name: Stage name, e.g. 'clahe' or 'output:dem'
+            written_to: Path of a memory-mapped file the stage writes; its size
+                counts as written, since memory-mapped writes bypass write calls
+        """
+        self.stages.setdefault(name, dict.fromkeys(METRIC_FIELDS, 0))
+        rss = self._fold_peak()
+        frame = {
+            'wall': time.perf_counter(),
+            'cpu': time.process_time(),
+            'written': _bytes_written(),
+            'rss': rss,
+            'peak': rss,
+            'lifetime_peak': _lifetime_peak_rss(),
+            'children': dict.fromkeys(('wall', 'cpu', 'written'), 0),
+        }
+        self._open.append(frame)
+        try:
+            yield
+        finally:
+            self._fold_peak()
+            self._open.pop()
+            inclusive = {
+                'wall': time.perf_counter() - frame['wall'],
+                'cpu': time.process_time() - frame['cpu'],
+                'written': _bytes_written() - frame['written'],
+            }
+            if self._open:
+                for key, value in inclusive.items():
+                    self._open[-1]['children'][key] += value
+            # A memory-mapped output counts for the innermost stage reporting it
+            mapped = 0
+            if written_to is not None and os.path.exists(written_to):
+                if os.path.abspath(written_to) not in self._mapped:
+                    self._mapped.add(os.path.abspath(written_to))
+                    mapped = os.path.getsize(written_to)
+
+            if self._resettable:
+                peak_delta = frame['peak'] - frame['rss']
+            else:
+                peak_delta = _lifetime_peak_rss() - frame['lifetime_peak']
+            metrics = self.stages[name]
+            metrics['wall_seconds'] += inclusive['wall'] - frame['children']['wall']
+            metrics['cpu_seconds'] += inclusive['cpu'] - frame['children']['cpu']
+            metrics['bytes_written'] += inclusive['written'] - frame['children']['written'] + mapped
+            metrics['peak_rss_delta_bytes'] = max(metrics['peak_rss_delta_bytes'], max(peak_delta, 0))
+
+    def _fold_peak(self):
+        """Fold the peak RSS since the last stage boundary into the open stages; returns the current RSS."""
+        status = _proc_status_bytes('VmRSS', 'VmHWM')
+        if status is None or None in status:
+            self._resettable = False
+            return 0
+        rss, peak = status
+        for frame in self._open:
+            frame['peak'] = max(frame['peak'], peak)
+        if self._resettable is None:
+            self._resettable = _reset_peak_rss()
+        elif self._resettable:
+            _reset_peak_rss()
+        return rss
+
+    def report(self):
+        """Metrics of every stage, rounded for storage as JSON."""
+        return {
+            name: {
+                'wall_seconds': round(metrics['wall_seconds'], 4),
+                'cpu_seconds': round(metrics['cpu_seconds'], 4),
+                'peak_rss_delta_bytes': int(metrics['peak_rss_delta_bytes']),
+                'bytes_written': int(metrics['bytes_written']),
+            }
+            for name, metrics in self.stages.items()
+        }
+
+
+@contextmanager
+def measure(profiler, name, written_to=None):
+    """profiler.stage(name), or nothing when no profiler is active."""
+    if profiler is None:
+        yield
+    else:
+        with profiler.stage(name, written_to=written_to):
+            yield
+
+
+class JobProfile:
+    """Optional cProfile / pyinstrument run around one job (see DEM_PROFILE)."""
+
+    def __init__(self, output_folder, job_id, profiler=None):
+        """
+        Args:
+            output_folder: Directory receiving the profile dump
+            job_id: Job identifier, the prefix of the dump's file name
+            profiler: 'cprofile' or 'pyinstrument' (defaults to DEM_PROFILE)
+        """
+        self.kind = PROFILER if profiler is None else profiler.lower()
+        self.output_folder = output_folder
+        self.job_id = job_id
+        self.path = None
+        self._profiler = None
+        if self.kind == 'pyinstrument':
+            try:
+                import pyinstrument
+                self._profiler = pyinstrument.Profiler()
+            except ImportError:
+                logger.warning("pyinstrument is not installed; profiling with cProfile")
+                self.kind = 'cprofile'
+        if self.kind == 'cprofile':
+            import cProfile
+            self._profiler = cProfile.Profile()
+        elif self.kind not in ('', 'pyinstrument'):
+            logger.warning(f"Unknown DEM_PROFILE value: {self.kind}")
+
+    def start(self):
+        if self._profiler is not None:
+            self._profiler.enable() if self.kind == 'cprofile' else self._profiler.start()
+        return self
+
+    def stop(self):
+        """Stop profiling and write the dump; returns its path (None when profiling is off)."""
+        if self._profiler is None:
+            return None
+        try:
+            if self.kind == 'cprofile':
+                self._profiler.disable()
+                self.path = os.path.join(self.output_folder, f"{self.job_id}_profile.prof")
+                self._profiler.dump_stats(self.path)
+            else:
+                self._profiler.stop()
+                self.path = os.path.join(self.output_folder, f"{self.job_id}_profile.html")
+                with open(self.path, 'w') as f:
+                    f.write(self._profiler.output_html())
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not write profile of job {self.job_id}: {str(e)}")
+            self.path = None
+        self._profiler = None
+        return self.path
@@ -0,0 +1,239 @@
+"""
+Colormap lookup tables, preview composition and PNG encoding for DEM renderings.
+
+Elevations are mapped through a precomputed 256-entry RGB table instead of
+matplotlib, so colourising a tile or a full preview is a single NumPy gather.
+The 'terrain' table reproduces matplotlib's colormap of the same name. The
+preview images (map, titles, colourbars) are composed with Pillow on top of
+cached colourbar bitmaps and encoded with OpenCV.
+"""
+import functools
+
+import numpy as np
+
+# Number of entries in a lookup table (matches matplotlib's default N)
+LUT_SIZE = 256
+
+# Anchor points of matplotlib's 'terrain' colormap: (position, (r, g, b))
+TERRAIN_ANCHORS = (
+    (0.00, (0.2, 0.2, 0.6)),
+    (0.15, (0.0, 0.6, 1.0)),
+    (0.25, (0.0, 0.8, 0.4)),
+    (0.50, (1.0, 1.0, 0.6)),
+    (0.75, (0.5, 0.36, 0.33)),
+    (1.00, (1.0, 1.0, 1.0)),
+)
+
+GRAY_ANCHORS = (
+    (0.0, (0.0, 0.0, 0.0)),
+    (1.0, (1.0, 1.0, 1.0)),
+)
+
+
+def build_lut(anchors, size=LUT_SIZE):
+    """
+    uint8 RGB table of shape (size, 3) interpolated between colormap anchors.
+    
+    Follows matplotlib's LinearSegmentedColormap sampling and byte conversion,
+    so colours are identical to matplotlib renderings.
+    """
+    positions = np.array([position for position, _ in anchors]) * (size - 1)
+    colors = np.array([color for _, color in anchors], dtype=np.float64)
+    samples = (size - 1) * np.linspace(0, 1, size)
+    upper = np.searchsorted(positions, samples)[1:-1]
+    distance = (samples[1:-1] - positions[upper - 1]) / (positions[upper] - positions[upper - 1])
+    table = np.concatenate([
+        colors[:1],
+        distance[:, None] * (colors[upper] - colors[upper - 1]) + colors[upper - 1],
+        colors[-1:],
+    ])
+    return (np.clip(table, 0.0, 1.0) * 255).astype(np.uint8)
+
+
+TERRAIN_LUT = build_lut(TERRAIN_ANCHORS)
+GRAY_LUT = build_lut(GRAY_ANCHORS)
+
+
+def lut_indices(values, vmin, vmax, size=LUT_SIZE):
+    """
+    Table indices of `values` normalised to [vmin, vmax].
+    
+    float32 input is normalised in float32 and binned like matplotlib's
+    Normalize + Colormap, so results match imshow pixel for pixel.
+    """
+    values = np.asarray(values)
+    dtype = np.float32 if values.dtype == np.float32 else np.float64
+    vmin, vmax = dtype(vmin), dtype(vmax)
+    scaled = values.astype(dtype)
+    scaled -= vmin
+    if vmax > vmin:
+        scaled /= vmax - vmin
+    else:
+        scaled[...] = 0
+    scaled *= size
+    np.clip(scaled, 0, size - 1, out=scaled)
+    return scaled.astype(np.uint8 if size <= 256 else np.intp)
+
+
+def colorize(values, vmin, vmax, lut=TERRAIN_LUT):
+    """Map a 2D array of elevations to an (h, w, 3) uint8 RGB image."""
+    return lut[lut_indices(values, vmin, vmax, len(lut))]
+
+
+def encode_png(image, compression=3):
+    """
+    Encode an RGB or RGBA uint8 image as PNG bytes.
+
+    Args:
+        image: (h, w), (h, w, 3) or (h, w, 4) uint8 array in RGB(A) order
+        compression: zlib level 0-9; low levels keep tile rendering fast
+    """
+    import cv2
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR if image.shape[2] == 3 else cv2.COLOR_RGBA2BGRA)
+    ok, buffer = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, compression])
+    if not ok:
+        raise ValueError("PNG encoding failed")
+    return buffer.tobytes()
+
+
+# Layout of the composed preview images (pixels)
+TOPVIEW_MAP_SIZE = 1000
+ANALYSIS_PANEL_SIZE = 700
+COLORBAR_WIDTH = 24
+MARGIN = 40
+BACKGROUND = (255, 255, 255)
+FOREGROUND = (0, 0, 0)
+
+
+@functools.lru_cache(maxsize=None)
+def _font(size, bold=False):
+    """DejaVu Sans (shipped with most systems and matplotlib), else Pillow's default font."""
+    from PIL import ImageFont
+    try:
+        return ImageFont.truetype('DejaVuSans-Bold.ttf' if bold else 'DejaVuSans.ttf', size)
+    except OSError:
+        try:
+            return ImageFont.load_default(size=size)
+        except TypeError:  # Pillow < 10.1 has no scalable default font
+            return ImageFont.load_default()
+
+
+@functools.lru_cache(maxsize=16)
+def _colorbar_bitmap(lut_bytes, height, width=COLORBAR_WIDTH):
+    """Vertical gradient of a lookup table, high values at the top."""
+    lut = np.frombuffer(lut_bytes, dtype=np.uint8).reshape(-1, 3)
+    rows = np.linspace(len(lut) - 1, 0, height).round().astype(np.intp)
+    return np.repeat(lut[rows][:, None, :], width, axis=1)
+
+
+def nice_ticks(vmin, vmax, count=7):
+    """Round tick values (steps of 1, 2, 2.5 or 5 x 10^k) within [vmin, vmax]."""
+    span = vmax - vmin
+    if not np.isfinite(span) or span <= 0:
+        return [vmin]
+    raw = span / max(count - 1, 1)
+    magnitude = 10 ** np.floor(np.log10(raw))
+    step = next(m * magnitude for m in (1, 2, 2.5, 5, 10) if m * magnitude >= raw)
+    first = np.ceil(vmin / step) * step
+    return [float(t) for t in np.arange(first, vmax + step * 1e-9, step)]
+
+
+def preview_array(dem_data, max_side):
+    """DEM resampled (area-averaged) so its longer side is at most `max_side` pixels."""
+    height, width = dem_data.shape
+    scale = min(max_side / max(height, width), 1.0)
+    if scale >= 1.0:
+        return np.asarray(dem_data, dtype=np.float32)
+    import cv2
+    # Cheap decimation first so INTER_AREA never reads more than ~4x the output
+    step = max(int(1 / scale) // 2, 1)
+    decimated = np.ascontiguousarray(dem_data[::step, ::step], dtype=np.float32)
+    size = (max(int(round(width * scale)), 1), max(int(round(height * scale)), 1))
+    return cv2.resize(decimated, size, interpolation=cv2.INTER_AREA)
+
+
+def _text(draw, position, text, font, anchor='la', fill=FOREGROUND):
+    draw.text(position, text, font=font, fill=fill, anchor=anchor)
+
+
+def _vertical_text(canvas, center, text, font, angle):
+    """Paste `text` rotated by `angle` degrees (counter-clockwise) centred at `center`."""
+    from PIL import Image, ImageDraw
+    left, top, right, bottom = font.getbbox(text)
+    label = Image.new('RGBA', (right - left + 4, bottom - top + 4), (0, 0, 0, 0))
+    ImageDraw.Draw(label).text((2 - left, 2 - top), text, font=font, fill=FOREGROUND + (255,))
+    label = label.rotate(angle, expand=True)
+    canvas.paste(label, (int(center[0] - label.width / 2), int(center[1] - label.height / 2)), label)
+
+
+def _draw_colorbar(canvas, draw, left, top, height, lut, vmin, vmax, label, tick_format):
+    """Gradient strip with ticks and a rotated label; returns the x just right of the label."""
+    from PIL import Image
+    strip = _colorbar_bitmap(lut.tobytes(), height)
+    canvas.paste(Image.fromarray(strip), (left, top))
+    draw.rectangle([left, top, left + COLORBAR_WIDTH - 1, top + height - 1], outline=FOREGROUND)
+
+    font = _font(13)
+    text_right = left + COLORBAR_WIDTH
+    for tick in nice_ticks(vmin, vmax):
+        y = top + (1 - (tick - vmin) / (vmax - vmin)) * (height - 1) if vmax > vmin else top + height - 1
+        draw.line([left + COLORBAR_WIDTH, y, left + COLORBAR_WIDTH + 4, y], fill=FOREGROUND)
+        text = tick_format.format(tick)
+        _text(draw, (left + COLORBAR_WIDTH + 7, y), text, font, anchor='lm')
+        text_right = max(text_right, left + COLORBAR_WIDTH + 7 + int(font.getlength(text)))
+
+    label_font = _font(14)
+    _vertical_text(canvas, (text_right + 16, top + height / 2), label, label_font, 270)
+    return text_right + 32
+
+
+def _panel(canvas, draw, left, top, image, title, lut, vmin, vmax, colorbar_label, tick_format,
+           axis_labels=True, colorbar_shrink=0.7):
+    """Map image with a title above, optional axis labels and a colourbar on the right."""
+    from PIL import Image
+    height, width = image.shape[:2]
+    _text(draw, (left + width / 2, top - 12), title, _font(18, bold=True), anchor='md')
+    canvas.paste(Image.fromarray(image), (left, top))
+    if axis_labels:
+        _text(draw, (left + width / 2, top + height + 10), 'X Coordinate', _font(14), anchor='mt')
+        _vertical_text(canvas, (left - 16, top + height / 2), 'Y Coordinate', _font(14), 90)
+
+    bar_height = int(height * colorbar_shrink)
+    return _draw_colorbar(canvas, draw, left + width + 20, top + (height - bar_height) // 2, bar_height,
+                          lut, vmin, vmax, colorbar_label, tick_format)
+
+
+def render_topview(dem_data, vmin, vmax, max_side=TOPVIEW_MAP_SIZE):
+    """Terrain map with title and elevation colourbar, as an RGB array."""
+    from PIL import Image, ImageDraw
+    terrain = colorize(preview_array(dem_data, max_side), vmin, vmax, TERRAIN_LUT)
+    height, width = terrain.shape[:2]
+
+    canvas = Image.new('RGB', (width + 2 * MARGIN + 180, height + 2 * MARGIN + 40), BACKGROUND)
+    draw = ImageDraw.Draw(canvas)
+    right = _panel(canvas, draw, MARGIN, MARGIN + 40, terrain, 'Digital Elevation Model - Terrain Map',
+                   TERRAIN_LUT, vmin, vmax, 'Elevation (meters)', '{:g}', axis_labels=False,
+                   colorbar_shrink=0.8)
+    return np.asarray(canvas.crop((0, 0, min(right + MARGIN, canvas.width), canvas.height)))
+
+
+def render_analysis(dem_data, vmin, vmax, max_side=ANALYSIS_PANEL_SIZE):
+    """Colourised and grayscale top views side by side, as an RGB array."""
+    from PIL import Image, ImageDraw
+    preview = preview_array(dem_data, max_side)
+    terrain = colorize(preview, vmin, vmax, TERRAIN_LUT)
+    gray = colorize(preview, vmin, vmax, GRAY_LUT)
+    height, width = terrain.shape[:2]
+
+    top = MARGIN + 90
+    canvas = Image.new('RGB', (2 * (width + 2 * MARGIN + 180), height + top + MARGIN + 30), BACKGROUND)
+    draw = ImageDraw.Draw(canvas)
+    right = _panel(canvas, draw, MARGIN + 20, top, terrain, 'DEM - Top View (Colorized)',
+                   TERRAIN_LUT, vmin, vmax, 'Elevation (m)', '{:g}')
+    right = _panel(canvas, draw, right + MARGIN + 20, top, gray, 'DEM - Top View (Grayscale)',
+                   GRAY_LUT, 0.0, 1.0, 'Normalized Height', '{:.1f}')
+    canvas = canvas.crop((0, 0, right + MARGIN, canvas.height))
+    _text(ImageDraw.Draw(canvas), (canvas.width / 2, MARGIN), 'Digital Elevation Model - Top View Analysis',
+          _font(22, bold=True), anchor='mt')
+    return np.asarray(canvas)
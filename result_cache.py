@@ -0,0 +1,248 @@
+"""
+Content-addressed cache of finished DEM results.
+
+Results are keyed by the SHA-256 of the uploaded bytes plus the processing
+parameters that influence the output. A finished job's artifacts are hard-linked
+into ``<cache_folder>/<key>/``; a later upload with the same key gets hard links
+to those files under its own job id instead of being processed again. Entries
+are tracked in the CacheEntry table and evicted least-recently-used first once
+the cache exceeds its size budget.
+
+The budget counts the full size of every entry's files, even while jobs
+still hold hard links to them. Eviction removes only the cache's links, so
+the bytes are freed once the jobs' copies are deleted as well. The disk
+space the cache alone keeps alive (stats()['exclusive_bytes']) is
+therefore at most the budget, while the files shared with jobs count
+toward the outputs folder.
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+from datetime import datetime
+
+from metrics import CACHE_REQUESTS
+
+# Processing parameters that change the generated artifacts
+RESULT_PARAMETERS = ('scale_factor', 'smoothing', 'elevation_range', 'mesh_max_error')
+
+# Parameters of the shape-from-shading solver; heuristic results ignore them and keep their keys
+SOLVER_PARAMETERS = ('solver', 'sun_azimuth', 'sun_elevation', 'reflectance')
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path, chunk_size=HASH_CHUNK_SIZE):
+    """Hex SHA-256 digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(content_hash, params):
+    """Cache key for an input digest and a dict of processing parameters."""
+    from dem_processor import DEFAULT_PRECISION
+    relevant = {name: params[name] for name in RESULT_PARAMETERS}
+    if params.get('solver', 'heuristic') != 'heuristic':
+        relevant.update({name: params[name] for name in SOLVER_PARAMETERS})
+    relevant['precision'] = DEFAULT_PRECISION
+    payload = f"{content_hash}:{json.dumps(relevant, sort_keys=True)}"
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _link_or_copy(source, destination):
+    """Hard-link `source` to `destination`, copying when links are not possible."""
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+class ResultCache:
+    """Size-bounded LRU cache of job artifacts with hit/miss and disk-usage accounting."""
+
+    def __init__(self, cache_folder, max_bytes):
+        """
+        Args:
+            cache_folder: Directory holding one sub-directory per cached result
+            max_bytes: Total artifact size above which old entries are evicted
+                (hard links shared with jobs included, see the module docstring)
+        """
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self.logger = logging.getLogger(__name__)
+        os.makedirs(cache_folder, exist_ok=True)
+
+    def lookup(self, key):
+        """Return the CacheEntry for `key` (refreshing its LRU position) or None."""
+        from app import db
+        from models import CacheEntry
+
+        entry = db.session.get(CacheEntry, key)
+        if entry is not None and not os.path.isdir(self._entry_folder(key)):
+            # Artifacts were removed behind our back; forget the entry
+            db.session.delete(entry)
+            db.session.commit()
+            entry = None
+
+        CACHE_REQUESTS.inc(cache='result', outcome='miss' if entry is None else 'hit')
+        if entry is None:
+            return None
+
+        entry.hits = (entry.hits or 0) + 1
+        entry.last_used_at = datetime.utcnow()
+        db.session.commit()
+        return entry
+
+    def materialize(self, entry, job_id, output_folder):
+        """
+        Link a cached result's artifacts into `output_folder` under `job_id`.
+
+        Returns:
+            JSON string of output files for the new job
+        """
+        folder = self._entry_folder(entry.key)
+        for suffix in os.listdir(folder):
+            _link_or_copy(os.path.join(folder, suffix), os.path.join(output_folder, f"{job_id}{suffix}"))
+
+        output_files = {name: f"{job_id}{suffix}" for name, suffix in json.loads(entry.output_files).items()}
+        return json.dumps(output_files)
+
+    def store(self, key, job_id, output_folder, output_files, processing_log=None, statistics=None):
+        """
+        Add a finished job's artifacts to the cache and evict old entries if needed.
+
+        Args:
+            key: Cache key of the job's input and parameters
+            job_id: Job whose files (named ``<job_id>_*``) are cached
+            output_folder: Directory containing the job's files
+            output_files: JSON string mapping artifact names to file names
+            processing_log: Log of the original run, shown for cache hits
+            statistics: JSON statistics of the original run, copied to cache hits
+        """
+        from app import db
+        from models import CacheEntry
+
+        if db.session.get(CacheEntry, key) is not None:
+            return
+
+        folder = self._entry_folder(key)
+        os.makedirs(folder, exist_ok=True)
+        size_bytes = 0
+        for name in os.listdir(output_folder):
+            if name.startswith(f"{job_id}_"):
+                destination = os.path.join(folder, name[len(job_id):])
+                _link_or_copy(os.path.join(output_folder, name), destination)
+                size_bytes += os.path.getsize(destination)
+
+        suffixes = {name: filename[len(job_id):] for name, filename in json.loads(output_files).items()}
+        now = datetime.utcnow()
+        db.session.add(CacheEntry(
+            key=key,
+            source_job_id=job_id,
+            output_files=json.dumps(suffixes),
+            processing_log=processing_log,
+            statistics=statistics,
+            size_bytes=size_bytes,
+            hits=0,
+            created_at=now,
+            last_used_at=now,
+        ))
+        db.session.commit()
+        self.evict()
+
+    def add_files(self, key, job_id, output_folder, output_files):
+        """
+        Add artifacts generated after the job finished to an existing entry.
+
+        Args:
+            key: Cache key of the job
+            job_id: Job that generated the files
+            output_folder: Directory containing the job's files
+            output_files: Dictionary mapping artifact names to file names
+        """
+        from app import db
+        from models import CacheEntry
+
+        entry = db.session.get(CacheEntry, key)
+        folder = self._entry_folder(key)
+        if entry is None or not os.path.isdir(folder):
+            return
+
+        suffixes = json.loads(entry.output_files) if entry.output_files else {}
+        for name, filename in output_files.items():
+            suffix = filename[len(job_id):]
+            destination = os.path.join(folder, suffix)
+            if not os.path.exists(destination):
+                _link_or_copy(os.path.join(output_folder, filename), destination)
+                entry.size_bytes = (entry.size_bytes or 0) + os.path.getsize(destination)
+            suffixes[name] = suffix
+        entry.output_files = json.dumps(suffixes)
+        db.session.commit()
+        self.evict()
+
+    def evict(self):
+        """Remove least-recently-used entries until the cache fits its budget."""
+        from sqlalchemy import func
+        from app import db
+        from models import CacheEntry
+
+        total = db.session.query(func.coalesce(func.sum(CacheEntry.size_bytes), 0)).scalar()
+        if total <= self.max_bytes:
+            return 0
+
+        evicted = 0
+        for entry in CacheEntry.query.order_by(CacheEntry.last_used_at).all():
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self._entry_folder(entry.key), ignore_errors=True)
+            total -= entry.size_bytes or 0
+            db.session.delete(entry)
+            evicted += 1
+        db.session.commit()
+        self.logger.info(f"Evicted {evicted} cached results")
+        return evicted
+
+    def stats(self):
+        """
+        Lookup counts and disk usage of the cache.
+
+        Hits and misses come from dem_cache_requests_total and cover this
+        process. size_bytes is what the budget counts; exclusive_bytes is the
+        part no job links to any more, i.e. what eviction would free.
+        """
+        from sqlalchemy import func
+        from app import db
+        from models import CacheEntry
+
+        entries, size_bytes = db.session.query(
+            func.count(CacheEntry.key), func.coalesce(func.sum(CacheEntry.size_bytes), 0)
+        ).one()
+        exclusive_bytes = 0
+        for root, _, names in os.walk(self.cache_folder):
+            for name in names:
+                try:
+                    info = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                if info.st_nlink == 1:
+                    exclusive_bytes += info.st_size
+        hits = CACHE_REQUESTS.value(cache='result', outcome='hit')
+        misses = CACHE_REQUESTS.value(cache='result', outcome='miss')
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            'entries': entries,
+            'size_bytes': int(size_bytes),
+            'exclusive_bytes': exclusive_bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+    def _entry_folder(self, key):
+        return os.path.join(self.cache_folder, key)
@@ -0,0 +1,69 @@
+"""
+In-place upgrade of the database schema at startup.
+
+db.create_all() creates missing tables but never changes existing ones, so
+a database created by an older version lacks the columns added to the
+models since (worker bookkeeping, job parameters, statistics, ...).
+upgrade_schema() compares every model table with the database and adds the
+missing columns with ``ALTER TABLE ... ADD COLUMN``. Columns with a constant
+default get it as a server default, so existing rows read as new ones would.
+Missing indexes are created afterwards. The upgrade only adds; columns that
+were renamed or removed in the models stay untouched.
+"""
+import logging
+
+import sqlalchemy as sa
+
+logger = logging.getLogger(__name__)
+
+
+def _column_ddl(column, dialect):
+    """Column definition of ADD COLUMN: name, type and constant default."""
+    ddl = f"{dialect.identifier_preparer.quote(column.name)} {column.type.compile(dialect=dialect)}"
+    default = column.default
+    if default is not None and default.is_scalar:
+        literal = sa.literal(default.arg, type_=column.type)
+        ddl += f" DEFAULT {literal.compile(dialect=dialect, compile_kwargs={'literal_binds': True})}"
+    return ddl
+
+
+def upgrade_schema(db):
+    """
+    Add the model columns and indexes missing from existing tables.
+
+    Call after db.create_all() inside an application context.
+
+    Returns:
+        List of "table.column" names that were added
+    """
+    engine = db.engine
+    preparer = engine.dialect.identifier_preparer
+    inspector = sa.inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    added = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        present = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in present:
+                continue
+            statement = (f"ALTER TABLE {preparer.quote(table.name)} ADD COLUMN "
+                         f"{_column_ddl(column, engine.dialect)}")
+            try:
+                with engine.begin() as connection:
+                    connection.execute(sa.text(statement))
+            except sa.exc.DBAPIError:
+                # Another process (web or worker) starting at the same time may have added it
+                columns = {c['name'] for c in sa.inspect(engine).get_columns(table.name)}
+                if column.name not in columns:
+                    raise
+            else:
+                added.append(f"{table.name}.{column.name}")
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
+    if added:
+        logger.info(f"Added database columns: {', '.join(added)}")
+    return added
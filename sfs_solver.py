@@ -0,0 +1,252 @@
+"""
+Physically-based shape-from-shading.
+
+The default DEM pipeline maps brightness and gradient cues to height
+heuristically. solve_height() instead inverts a reflectance model: given the
+sun azimuth and elevation it looks for the height field whose rendered
+image matches the input. It uses the Horn-style iteration with integrability
+enforced by Frankot-Chellappa:
+
+1. Render the current surface slopes (p, q) with the reflectance model and
+   move every slope along the model's gradient to reduce the brightness
+   residual.
+2. Project the updated slopes onto the closest integrable surface. That is
+   a Poisson equation, which is solved exactly with a discrete cosine
+   transform. This is the Frankot-Chellappa projection with mirrored instead
+   of periodic boundaries, so image edges do not wrap around.
+
+Single-level iterations mostly correct fine detail and would need thousands
+of sweeps to build up large-scale relief. The solver therefore runs coarse
+to fine over an image pyramid. The coarsest level, at most COARSE_SIZE
+pixels across, converges in many cheap iterations. Every finer level starts
+from the upsampled solution and only needs a few sweeps. A 4096 x 4096 image
+takes about ten seconds on one core.
+
+Reflectance models:
+
+- 'lambert': R = albedo * cos(i)
+- 'lunar_lambert': R = albedo * (2 L cos(i) / (cos(i) + cos(e)) + (1 - L) cos(i)),
+  McEwen's blend of Lommel-Seeliger and Lambert. It fits the Moon and other
+  airless bodies better. The camera is assumed to look straight down.
+
+Here i is the incidence angle and e the emission angle. The albedo is
+re-estimated from the mean brightness at every level. Heights are returned in
+pixel units. DEMProcessor rescales them like every other height estimate.
+"""
+import numpy as np
+import cv2
+
+REFLECTANCE_MODELS = ('lambert', 'lunar_lambert')
+
+# Lommel-Seeliger weight L of the lunar-Lambert model (about 0.5 at mid phase angles)
+LUNAR_LAMBERT_WEIGHT = 0.5
+
+# Largest edge length of the coarsest pyramid level
+COARSE_SIZE = 128
+
+# Iterations on the coarsest level and on every finer level
+COARSE_ITERATIONS = 200
+FINE_ITERATIONS = 2
+
+# Width (sigma) of the albedo estimation window as a fraction of the image size;
+# brightness changes broader than this are taken as albedo, not slope (0 for one global albedo)
+ALBEDO_SCALE = 0.1
+
+# Step damping of the slope update; larger values take smaller, safer steps
+DAMPING = 0.05
+
+# Normalized brightness below which a pixel counts as shadowed and gives no constraint
+SHADOW_LEVEL = 0.02
+
+
+def light_vector(sun_azimuth, sun_elevation):
+    """Unit vector towards the sun in image coordinates (x right, y down, z up).
+
+    Args:
+        sun_azimuth: Direction the light comes from, degrees clockwise from north (image up)
+        sun_elevation: Sun elevation above the horizon in degrees
+
+    Returns:
+        Tuple (lx, ly, lz)
+    """
+    azimuth = np.radians(sun_azimuth)
+    elevation = np.radians(sun_elevation)
+    return (float(np.sin(azimuth) * np.cos(elevation)), float(-np.cos(azimuth) * np.cos(elevation)),
+            float(np.sin(elevation)))
+
+
+def reflectance(p, q, light, model='lambert'):
+    """
+    Unit-albedo brightness of surface slopes and its derivatives.
+
+    Args:
+        p, q: Slopes dz/dx and dz/dy (float32 arrays)
+        light: light_vector() of the sun
+        model: One of REFLECTANCE_MODELS
+
+    Returns:
+        Tuple (R, dR/dp, dR/dq); R is clipped at 0 in shadow, where both
+        derivatives are 0
+    """
+    lx, ly, lz = light
+    cos_e = p * p
+    cos_e += q * q
+    cos_e += 1
+    np.sqrt(cos_e, out=cos_e)
+    np.reciprocal(cos_e, out=cos_e)
+    dot = lz - lx * p
+    dot -= ly * q  # cos(i) / cos(e)
+    cos_i = dot * cos_e
+    # d(cos i)/dp = -lx cos(e) - dot p cos(e)^3, d(cos e)/dp = -p cos(e)^3
+    cos_e3 = cos_e * cos_e
+    cos_e3 *= cos_e
+    if model == 'lambert':
+        brightness, d_cos_i, d_cos_e = cos_i, 1.0, None
+    elif model == 'lunar_lambert':
+        weight = LUNAR_LAMBERT_WEIGHT
+        total = cos_i + cos_e
+        np.maximum(total, 1e-6, out=total)
+        brightness = 2 * weight * cos_i / total + (1 - weight) * cos_i
+        total *= total
+        d_cos_i = 2 * weight * cos_e / total + (1 - weight)
+        d_cos_e = -2 * weight * cos_i / total
+    else:
+        raise ValueError(f"Unknown reflectance model: {model}")
+    shadow = cos_i <= 0
+    d_p = d_cos_i * (-lx * cos_e - dot * p * cos_e3)
+    d_q = d_cos_i * (-ly * cos_e - dot * q * cos_e3)
+    if d_cos_e is not None:
+        d_cos_e *= cos_e3
+        d_p -= d_cos_e * p
+        d_q -= d_cos_e * q
+    d_p[shadow] = 0
+    d_q[shadow] = 0
+    return np.maximum(brightness, 0, out=brightness), d_p, d_q
+
+
+def slopes(height):
+    """Central-difference slopes (p, q) of a height field, one-sided at the edges."""
+    p = cv2.Sobel(height, cv2.CV_32F, 1, 0, ksize=1, borderType=cv2.BORDER_REPLICATE)
+    q = cv2.Sobel(height, cv2.CV_32F, 0, 1, ksize=1, borderType=cv2.BORDER_REPLICATE)
+    p *= 0.5
+    q *= 0.5
+    return p, q
+
+
+def integrate_slopes(p, q):
+    """
+    Least-squares surface with slopes (p, q): Frankot-Chellappa with mirrored boundaries.
+
+    Solves the Poisson equation laplacian(z) = dp/dx + dq/dy with Neumann
+    boundaries in the DCT domain. The result has zero mean.
+
+    Args:
+        p, q: float32 slope arrays
+
+    Returns:
+        float32 height field
+    """
+    from scipy import fft
+    height, width = p.shape
+    # Divergence with backward differences (the adjoint of the forward-difference gradient)
+    divergence = np.zeros_like(p)
+    divergence[:, 1:] += p[:, 1:] - p[:, :-1]
+    divergence[:, 0] += p[:, 0]
+    divergence[:, -1] -= p[:, -1]
+    divergence[1:] += q[1:] - q[:-1]
+    divergence[0] += q[0]
+    divergence[-1] -= q[-1]
+    spectrum = fft.dctn(divergence, type=2, norm='ortho', workers=-1)
+    del divergence
+    # Eigenvalues of the Neumann Laplacian
+    wx = 2 * np.cos(np.pi * np.arange(width, dtype=np.float32) / width) - 2
+    wy = 2 * np.cos(np.pi * np.arange(height, dtype=np.float32) / height) - 2
+    denominator = wy[:, None] + wx[None, :]
+    denominator[0, 0] = 1
+    spectrum /= denominator
+    spectrum[0, 0] = 0
+    return fft.idctn(spectrum, type=2, norm='ortho', workers=-1).astype(np.float32, copy=False)
+
+
+def _local_albedo(image, rendered, lit, sigma):
+    """Albedo map: ratio of blurred image to blurred rendering over lit pixels (a constant when sigma is 0)."""
+    if not sigma:
+        return float(image[lit].mean() / max(rendered[lit].mean(), 1e-6)) if lit.any() else 1.0
+    # Blur at reduced resolution; the result is smooth on the scale of sigma anyway
+    height, width = image.shape
+    factor = max(int(sigma / 2), 1)
+    small = (max(width // factor, 1), max(height // factor, 1))
+    weight = lit.astype(np.float32)
+    observed, expected = (cv2.GaussianBlur(cv2.resize(values * weight, small, interpolation=cv2.INTER_AREA),
+                                           (0, 0), sigma / factor, borderType=cv2.BORDER_REFLECT)
+                          for values in (image, rendered))
+    albedo = observed / np.maximum(expected, 1e-3)
+    return cv2.resize(albedo, (width, height), interpolation=cv2.INTER_LINEAR)
+
+
+def _iterate(image, height, light, model, iterations, shadow_mask, albedo_sigma):
+    """Run Horn-style slope updates with integrability projection on one pyramid level."""
+    lit = ~shadow_mask
+    for _ in range(iterations):
+        p, q = slopes(height)
+        rendered, d_p, d_q = reflectance(p, q, light, model)
+        albedo = _local_albedo(image, rendered, lit, albedo_sigma)
+        residual = image - albedo * rendered
+        residual[shadow_mask] = 0
+        # Damped Gauss-Newton step of the one brightness equation per pixel
+        residual *= albedo / (albedo * albedo * (d_p * d_p + d_q * d_q) + DAMPING)
+        step_p = residual * d_p
+        step_q = residual * d_q
+        # Central differences average two forward differences; spreading the step back
+        # onto the forward differences (the adjoint) keeps it a descent direction
+        step_p[:, :-1] += step_p[:, 1:]
+        step_p[:, :-1] *= 0.5
+        step_p[:, -1] = 0
+        step_q[:-1] += step_q[1:]
+        step_q[:-1] *= 0.5
+        step_q[-1] = 0
+        height = height + integrate_slopes(step_p, step_q)
+    return height
+
+
+def solve_height(image, sun_azimuth, sun_elevation, model='lambert', coarse_size=COARSE_SIZE,
+                 coarse_iterations=COARSE_ITERATIONS, fine_iterations=FINE_ITERATIONS,
+                 albedo_scale=ALBEDO_SCALE):
+    """
+    Height field whose shading under the given sun best matches `image`.
+
+    Args:
+        image: 2D brightness array (any scale; normalized by its maximum)
+        sun_azimuth: Direction the light comes from, degrees clockwise from image up
+        sun_elevation: Sun elevation above the horizon in degrees (0-90, exclusive)
+        model: Reflectance model, one of REFLECTANCE_MODELS
+        coarse_size: Largest edge length of the coarsest pyramid level
+        coarse_iterations: Iterations on the coarsest level
+        fine_iterations: Iterations on every finer level
+
+    Returns:
+        float32 height field in pixel units with zero mean
+    """
+    if model not in REFLECTANCE_MODELS:
+        raise ValueError(f"Unknown reflectance model: {model}")
+    if not 0 < sun_elevation < 90:
+        raise ValueError("Sun elevation must be between 0 and 90 degrees")
+    light = light_vector(sun_azimuth, sun_elevation)
+
+    image = np.asarray(image, dtype=np.float32)
+    image = image / max(float(image.max()), 1e-6)
+    pyramid = [image]
+    while max(pyramid[-1].shape) > coarse_size and min(pyramid[-1].shape) >= 4:
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+
+    height = np.zeros_like(pyramid[-1])
+    for level, level_image in reversed(list(enumerate(pyramid))):
+        if level < len(pyramid) - 1:
+            # Heights are in pixel units, which halve in size one level up
+            rows, cols = level_image.shape
+            height = cv2.pyrUp(height, dstsize=(cols, rows))
+            height *= 2
+        iterations = coarse_iterations if level == len(pyramid) - 1 else fine_iterations
+        height = _iterate(level_image, height, light, model, iterations, level_image < SHADOW_LEVEL,
+                          albedo_scale * max(level_image.shape))
+    return height
@@ -0,0 +1,111 @@
+"""
+Persistent memoization of intermediate DEM pipeline stages.
+
+Each stage result (grayscale, CLAHE, smoothed, normalized DEM, scaled DEM) is
+stored as a .npy file named by a key derived from the upstream stage key and
+the parameters of the stage itself. Changing a parameter therefore only
+invalidates the stages downstream of it; earlier stages are memory-mapped back
+from disk. Files are evicted least-recently-used first beyond a size budget.
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+
+import numpy as np
+
+# Default size budget of the stage cache (bytes)
+DEFAULT_STAGE_CACHE_BYTES = int(os.environ.get('DEM_STAGE_CACHE_MB', 4096)) * 1024 * 1024
+
+# Pipeline stages in execution order
+STAGES = ('decode', 'grayscale', 'clahe', 'smoothed', 'normalized_dem', 'scaled_dem', 'outputs')
+
+
+def stage_key(stage, upstream_key, **params):
+    """Key of a stage result given its upstream key and its own parameters."""
+    payload = json.dumps([stage, upstream_key, params], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class StageCache:
+    """Directory of memoized stage arrays with LRU eviction."""
+
+    def __init__(self, folder, max_bytes=None):
+        """
+        Args:
+            folder: Directory for the cached .npy files
+            max_bytes: Size budget; least-recently-used files are removed beyond it
+        """
+        self.folder = folder
+        self.max_bytes = DEFAULT_STAGE_CACHE_BYTES if max_bytes is None else max_bytes
+        self.logger = logging.getLogger(__name__)
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.folder, f"{key}.npy")
+
+    def load(self, key):
+        """Memory-map a cached stage result, or return None."""
+        path = self.path(key)
+        try:
+            array = np.load(path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return None
+        os.utime(path)  # Refresh the LRU position
+        return array
+
+    def save(self, key, array):
+        """Persist a stage result atomically."""
+        fd, tmp_path = tempfile.mkstemp(suffix='.npy', dir=self.folder)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.asarray(array))
+            os.replace(tmp_path, self.path(key))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def adopt(self, key, path):
+        """Add an existing .npy file (e.g. written by the tiled engine) without copying it."""
+        destination = self.path(key)
+        tmp_path = f"{destination}.{os.getpid()}.tmp"
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            self.save(key, np.load(path, mmap_mode='r'))
+            return
+        os.replace(tmp_path, destination)
+        self.evict()
+
+    def link(self, key, destination):
+        """Hard-link (or copy) a cached result to `destination`."""
+        if os.path.exists(destination):
+            os.remove(destination)
+        try:
+            os.link(self.path(key), destination)
+        except OSError:
+            shutil.copy2(self.path(key), destination)
+
+    def evict(self):
+        """Remove least-recently-used files until the cache fits its budget."""
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.npy'):
+                stat = os.stat(os.path.join(self.folder, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.folder, name))
+            total -= size
+            evicted += 1
+        if evicted:
+            self.logger.info(f"Evicted {evicted} cached stage results")
+        return evicted
@@ -0,0 +1,140 @@
+"""
+Terrain derivative products of a DEM: slope, aspect, hillshade, curvature and roughness.
+
+All five rasters come from one fused pass over the DEM. The DEM is read in
+bands of DEM_DERIVATIVE_ROWS rows plus one halo row above and below, so large
+memory-mapped DEMs never load completely. The 3x3 neighbourhood of each band
+is differentiated once, with Horn's method (Sobel weights / 8, as in GDAL), and
+every product is derived from those shared gradients:
+
+- slope: degrees from horizontal
+- aspect: compass direction the slope faces, degrees clockwise from image up
+  (north); -1 on flat cells
+- hillshade: 8-bit Lambertian shading under HILLSHADE_AZIMUTH / HILLSHADE_ALTITUDE
+- curvature: negative Laplacian in 1/100 elevation units per cell (positive
+  is convex, as in ArcGIS)
+- roughness: largest minus smallest elevation in the 3x3 window (as in GDAL)
+
+The same pass accumulates summary statistics, a slope histogram and an
+aspect histogram. The worker stores them on every job, and the rasters are
+download types rendered on first request (see artifacts.py). Pixels are
+DEM_CELL_SIZE elevation units apart (1.0 by default, as in the ASCII grid
+header).
+"""
+import os
+
+import numpy as np
+import cv2
+
+# Ground distance between DEM pixels, in the units of the elevations
+CELL_SIZE = float(os.environ.get('DEM_CELL_SIZE', 1.0))
+
+# Rows differentiated at once (bounds the temporaries of large DEMs)
+DERIVATIVE_ROWS = int(os.environ.get('DEM_DERIVATIVE_ROWS', 1024))
+
+# Illumination of the hillshade (degrees; light from the top-left)
+HILLSHADE_AZIMUTH = 315.0
+HILLSHADE_ALTITUDE = 45.0
+
+PRODUCTS = ('slope', 'aspect', 'hillshade', 'curvature', 'roughness')
+
+# Upper bin edges of the slope histogram (degrees)
+SLOPE_BINS = (0, 2, 5, 10, 15, 20, 25, 30, 35, 45, 60, 90)
+
+# Aspect histogram sectors, 45 degrees wide and centred on the compass directions
+ASPECT_SECTORS = ('N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW')
+
+# Aspect of cells without slope
+FLAT_ASPECT = -1.0
+
+# Histogram edges of the aspect: flat cells, then the sectors, with N split around 0/360
+_ASPECT_EDGES = np.concatenate(([FLAT_ASPECT - 1, 0], np.arange(22.5, 360, 45), [361])).astype(np.float32)
+
+
+def _band_derivatives(band, inner, cell_size, light):
+    """All products of the rows `inner` of a halo-extended band of the DEM (no hillshade without `light`)."""
+    p = cv2.Sobel(band, cv2.CV_32F, 1, 0, ksize=3, borderType=cv2.BORDER_REPLICATE)[inner]
+    q = cv2.Sobel(band, cv2.CV_32F, 0, 1, ksize=3, borderType=cv2.BORDER_REPLICATE)[inner]
+    p *= np.float32(1 / (8 * cell_size))
+    q *= np.float32(1 / (8 * cell_size))
+
+    gradient = np.hypot(p, q)
+    slope = np.degrees(np.arctan(gradient))
+
+    # The downslope direction (-p, -q) as a compass bearing; y points south
+    aspect = np.degrees(np.arctan2(-p, q))
+    aspect %= 360
+    aspect[gradient == 0] = FLAT_ASPECT
+
+    hillshade = None
+    if light is not None:
+        lx, ly, lz = light
+        shade = lz - lx * p - ly * q
+        shade /= np.sqrt(1 + gradient * gradient)
+        np.clip(shade, 0, 1, out=shade)
+        hillshade = (shade * 255 + 0.5).astype(np.uint8)
+
+    curvature = cv2.Laplacian(band, cv2.CV_32F, ksize=1, borderType=cv2.BORDER_REPLICATE)[inner]
+    curvature *= np.float32(-100 / (cell_size * cell_size))
+
+    kernel = np.ones((3, 3), np.uint8)
+    roughness = cv2.dilate(band, kernel)[inner] - cv2.erode(band, kernel)[inner]
+
+    return {'slope': slope, 'aspect': aspect, 'hillshade': hillshade, 'curvature': curvature,
+            'roughness': roughness}
+
+
+def compute_derivatives(dem_data, outputs=None, cell_size=None, sun_azimuth=HILLSHADE_AZIMUTH,
+                        sun_elevation=HILLSHADE_ALTITUDE, rows_per_block=None):
+    """
+    Derive all products of a DEM in one banded pass and summarize them.
+
+    Args:
+        dem_data: 2D elevation array (may be a memory map)
+        outputs: Optional dictionary of product name -> array of the DEM's
+            shape (e.g. a memory map) receiving that raster; float32, except
+            uint8 for the hillshade
+        cell_size: Ground distance between pixels (defaults to DEM_CELL_SIZE)
+        sun_azimuth, sun_elevation: Hillshade illumination in degrees
+        rows_per_block: Rows per band (defaults to DEM_DERIVATIVE_ROWS)
+
+    Returns:
+        Dictionary of summary statistics: min/max/mean/std of slope,
+        curvature and roughness, and histograms of slope and aspect
+    """
+    from dem_stats import DEMStatistics
+    from sfs_solver import light_vector
+    outputs = outputs or {}
+    cell_size = CELL_SIZE if cell_size is None else float(cell_size)
+    rows = rows_per_block or DERIVATIVE_ROWS
+    light = light_vector(sun_azimuth, sun_elevation) if 'hillshade' in outputs else None
+    height, _ = dem_data.shape
+
+    summaries = {name: DEMStatistics(bins=0) for name in ('slope', 'curvature', 'roughness')}
+    slope_counts = np.zeros(len(SLOPE_BINS) - 1, dtype=np.int64)
+    aspect_counts = np.zeros(len(ASPECT_SECTORS), dtype=np.int64)
+    flat = 0
+    for y0 in range(0, height, rows):
+        y1 = min(y0 + rows, height)
+        h0, h1 = max(y0 - 1, 0), min(y1 + 1, height)
+        band = np.ascontiguousarray(dem_data[h0:h1], dtype=np.float32)
+        products = _band_derivatives(band, slice(y0 - h0, y1 - h0), cell_size, light)
+        for name, target in outputs.items():
+            target[y0:y1] = products[name]
+
+        for name, summary in summaries.items():
+            summary.update(products[name])
+        slope_counts += np.histogram(products['slope'], bins=SLOPE_BINS)[0]
+        counts = np.histogram(products['aspect'], bins=_ASPECT_EDGES)[0]
+        flat += int(counts[0])
+        aspect_counts += counts[1:-1]
+        aspect_counts[0] += counts[-1]
+
+    report = {}
+    for name, summary in summaries.items():
+        values = summary.summary()
+        report[name] = {key: values[key] for key in ('min', 'max', 'mean', 'std')}
+    report['cell_size'] = cell_size
+    report['slope_histogram'] = {'bin_edges_degrees': list(SLOPE_BINS), 'counts': slope_counts.tolist()}
+    report['aspect_histogram'] = {'sectors': list(ASPECT_SECTORS), 'counts': aspect_counts.tolist(), 'flat': flat}
+    return report
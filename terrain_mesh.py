@@ -0,0 +1,443 @@
+"""
+Error-bounded triangulated irregular networks (TINs) of a DEM for 3D export.
+
+Meshes are built with a right-triangulated irregular network (RTIN, the
+scheme popularised by Mapbox's Martini): the DEM is padded to a square grid of
+2^k + 1 points that is recursively split into right isosceles triangles.
+Every grid point is the midpoint of some triangle's hypotenuse; its error is
+the vertical distance between its elevation and the hypotenuse's linear
+interpolation, maxed with the errors of all finer triangles below it. A mesh
+for a given maximum error keeps splitting triangles only while the midpoint
+error exceeds it, so flat areas end up with a few large triangles and ridges
+and crater rims keep full resolution. The midpoint metric alone can miss
+deviations inside large triangles, so the result is checked against every
+grid point and refined until it holds the error bound exactly. Triangles
+crossing the raster edge are split down to it and the padding is dropped, so
+vertices sit exactly on DEM pixels.
+
+All passes run level by level on whole arrays: the error passes over strided
+views of the grid (one view per triangle orientation and size), extraction
+over the list of triangles still being split, and the check over groups of
+equally shaped triangles.
+
+Exports: Wavefront OBJ, binary PLY and binary glTF (.glb). OBJ and PLY use
+Z-up coordinates (x east, y north, z elevation, in pixels and meters); glTF
+uses its own Y-up convention. Faces wind counter-clockwise seen from above.
+"""
+import os
+import json
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+from rendering import preview_array
+
+# Default maximum vertical error of exported meshes (meters)
+DEFAULT_MESH_MAX_ERROR = float(os.environ.get('DEM_MESH_MAX_ERROR', 1.0))
+
+# Longest DEM side meshed at full resolution; larger DEMs are downsampled to it
+MAX_RTIN_GRID = int(os.environ.get('DEM_MESH_MAX_GRID', 8193))
+
+TerrainMesh = namedtuple('TerrainMesh', ['vertices', 'faces', 'max_error'])
+TerrainMesh.__doc__ = """
+Triangulated DEM: (n, 3) float32 vertices (x east, y north, z elevation),
+(m, 3) uint32 counter-clockwise faces and the error bound used to build it.
+"""
+
+
+def rtin_grid_size(shape):
+    """Smallest 2^k + 1 with at least as many points as the longer side of `shape`."""
+    return (1 << max((max(shape) - 2).bit_length(), 1)) + 1
+
+
+def rtin_grid(dem_data, max_grid=None):
+    """
+    DEM as a padded square RTIN grid.
+
+    DEMs with more than `max_grid` points per side are area-averaged down to
+    fit first. The padding repeats the edge values, so it stays flat.
+
+    Returns:
+        Tuple (float32 (2^k + 1)-square grid, (rows, cols) of the DEM in it)
+    """
+    max_grid = max_grid or MAX_RTIN_GRID
+    if max(dem_data.shape) > max_grid:
+        dem_data = preview_array(dem_data, max_grid)
+    rows, cols = dem_data.shape
+    size = rtin_grid_size(dem_data.shape)
+    heights = np.empty((size, size), dtype=np.float32)
+    heights[:rows, :cols] = dem_data
+    heights[:rows, cols:] = heights[:rows, cols - 1:cols]
+    heights[rows:] = heights[rows - 1]
+    return heights, (rows, cols)
+
+
+def _view(array, y0, x0, ny, nx, step):
+    """Strided view of `ny` x `nx` grid points starting at (y0, x0), `step` apart."""
+    return array[y0:y0 + (ny - 1) * step + 1:step, x0:x0 + (nx - 1) * step + 1:step]
+
+
+def _raise_to(target, source):
+    np.maximum(target, source, out=target)
+
+
+def rtin_midpoint_errors(heights):
+    """
+    Deviation of every grid point from the hypotenuse it is the midpoint of.
+
+    For a hypotenuse of length s along an axis, the endpoints are s/2 away
+    along that axis. For a square of side s split along a diagonal, the
+    diagonals alternate so that all four quadrants of a square meet at its
+    centre. Grid corners are never midpoints and get 0.
+
+    Args:
+        heights: (2^k + 1, 2^k + 1) float32 grid
+
+    Returns:
+        float32 array of the same shape
+    """
+    size = heights.shape[0]
+    if heights.shape != (size, size) or size < 3 or (size - 1) & (size - 2):
+        raise ValueError(f"RTIN grids must be (2^k + 1) square, got {heights.shape}")
+    last = size - 1
+    errors = np.zeros_like(heights)
+
+    step = 2
+    while step <= last:
+        half, count = step // 2, last // step
+        # Axis-aligned hypotenuses: horizontal, then vertical
+        for rows, cols, end, mid in ((count + 1, count, (0, step), (0, half)),
+                                     (count, count + 1, (step, 0), (half, 0))):
+            interpolated = (_view(heights, 0, 0, rows, cols, step) + _view(heights, *end, rows, cols, step)) * 0.5
+            _view(errors, *mid, rows, cols, step)[...] = np.abs(interpolated - _view(heights, *mid, rows, cols, step))
+
+        # Square diagonals
+        main = (_view(heights, 0, 0, count, count, step) + _view(heights, step, step, count, count, step)) * 0.5
+        anti = (_view(heights, 0, step, count, count, step) + _view(heights, step, 0, count, count, step)) * 0.5
+        parity = np.arange(count) % 2
+        interpolated = np.where(parity[:, None] == parity[None, :], main, anti)
+        _view(errors, half, half, count, count, step)[...] = np.abs(
+            interpolated - _view(heights, half, half, count, count, step))
+        step *= 2
+    return errors
+
+
+def rtin_propagate(errors, first_step=2):
+    """
+    Raise every midpoint error to the errors of the finer triangles below it, in place.
+
+    Sizes are processed finest first. The finer midpoints of an axis-aligned
+    hypotenuse of length s are the square centres s/4 away on both sides; those
+    of a square diagonal are the midpoints of the square's edges. Splitting a
+    triangle therefore always splits its parent, which keeps meshes free of
+    cracks.
+
+    Args:
+        errors: Midpoint errors as returned by rtin_midpoint_errors
+        first_step: Finest hypotenuse length to propagate from; levels below
+            it are left as they are
+
+    Returns:
+        `errors`
+    """
+    last = errors.shape[0] - 1
+    step = first_step
+    while step <= last:
+        half, quarter, count = step // 2, step // 4, last // step
+        if quarter:
+            horizontal = _view(errors, 0, half, count + 1, count, step)
+            vertical = _view(errors, half, 0, count, count + 1, step)
+            for dy in (-quarter, quarter):
+                for dx in (-quarter, quarter):
+                    _raise_to(horizontal[1:] if dy < 0 else horizontal[:-1],
+                              _view(errors, dy % step, half + dx, count, count, step))
+                    _raise_to(vertical[:, 1:] if dx < 0 else vertical[:, :-1],
+                              _view(errors, half + dy, dx % step, count, count, step))
+
+        centre = _view(errors, half, half, count, count, step)
+        for y0, x0 in ((half, 0), (half, step), (0, half), (step, half)):
+            _raise_to(centre, _view(errors, y0, x0, count, count, step))
+        step *= 2
+    return errors
+
+
+def rtin_triangles(errors, max_error):
+    """
+    Triangles of the coarsest RTIN whose midpoint errors are all within `max_error`.
+
+    Returns:
+        (m, 3) int64 array of flat grid indices (row * size + column) of the
+        hypotenuse ends and the right-angle corner
+    """
+    size = errors.shape[0]
+    last = size - 1
+    # Corners (a, b, c) with hypotenuse a-b and right angle at c, as (x, y) pairs
+    ax = np.array([0, last]); ay = np.array([0, last])
+    bx = np.array([last, 0]); by = np.array([last, 0])
+    cx = np.array([last, 0]); cy = np.array([0, last])
+    done = []
+    while len(ax):
+        sx, sy = ax + bx, ay + by
+        mx, my = sx >> 1, sy >> 1
+        split = ((sx & 1) == 0) & ((sy & 1) == 0) & (np.abs(ax - bx) + np.abs(ay - by) > 1)
+        split[split] = errors[my[split], mx[split]] > max_error
+
+        keep = ~split
+        done.append(np.stack([ay[keep] * size + ax[keep], by[keep] * size + bx[keep],
+                              cy[keep] * size + cx[keep]], axis=1))
+
+        # Children (c, a, m) and (b, c, m)
+        ax, ay, bx, by, cx, cy, mx, my = (v[split] for v in (ax, ay, bx, by, cx, cy, mx, my))
+        ax, ay, bx, by, cx, cy = (np.concatenate(pair) for pair in
+                                  ((cx, bx), (cy, by), (ax, cx), (ay, cy), (mx, mx), (my, my)))
+    return np.concatenate(done)
+
+
+def triangle_errors(heights, triangles, block_values=1 << 22):
+    """
+    Largest vertical distance between each triangle's plane and the grid points it covers.
+
+    Triangles of the same shape and orientation are handled together: the
+    grid points inside the shape are enumerated once as offsets from the
+    right-angle corner and gathered for all of them, in blocks of about
+    `block_values` values.
+
+    Args:
+        heights: Square float32 grid
+        triangles: (m, 3) flat grid indices as returned by rtin_triangles
+
+    Returns:
+        float64 array of length m
+    """
+    size = heights.shape[0]
+    flat = heights.ravel()
+    ys, xs = np.divmod(triangles, size)
+    # Legs c->a and c->b packed into one key per shape and orientation
+    span = 2 * size + 1
+    shape_keys = (((ys[:, 0] - ys[:, 2] + size) * span + xs[:, 0] - xs[:, 2] + size) * span
+                  + ys[:, 1] - ys[:, 2] + size) * span + xs[:, 1] - xs[:, 2] + size
+    order = np.argsort(shape_keys, kind='stable')
+    boundaries = np.flatnonzero(np.diff(shape_keys[order])) + 1
+    deviation = np.zeros(len(triangles))
+
+    for members in np.split(order, boundaries):
+        if not len(members):
+            continue
+        first = members[0]
+        uy, ux = ys[first, 0] - ys[first, 2], xs[first, 0] - xs[first, 2]
+        vy, vx = ys[first, 1] - ys[first, 2], xs[first, 1] - xs[first, 2]
+        base = triangles[members, 2]
+        hc = flat[base].astype(np.float64)
+        # Plane gradient from the two legs: [[uy, ux], [vy, vx]] @ (gy, gx) = rises along the legs
+        rise_u = flat[triangles[members, 0]] - hc
+        rise_v = flat[triangles[members, 1]] - hc
+        det = float(uy * vx - ux * vy)
+        gy = (vx * rise_u - ux * rise_v) / det
+        gx = (uy * rise_v - vy * rise_u) / det
+
+        # Offsets from c inside the triangle (c, c + u, c + v), boundary included
+        y_range = np.arange(min(0, uy, vy), max(0, uy, vy) + 1)
+        x_range = np.arange(min(0, ux, vx), max(0, ux, vx) + 1)
+        rows_per_block = max(block_values // (len(x_range) * len(members)), 1)
+        worst = np.zeros(len(members))
+        for start in range(0, len(y_range), rows_per_block):
+            dy, dx = np.meshgrid(y_range[start:start + rows_per_block], x_range, indexing='ij')
+            # Barycentric coordinates along u and v, scaled by det
+            s = dy * vx - dx * vy
+            t = uy * dx - ux * dy
+            if det < 0:
+                s, t = -s, -t
+            inside = (s >= 0) & (t >= 0) & (s + t <= abs(det))
+            dy, dx = dy[inside], dx[inside]
+            if not len(dy):
+                continue
+            offsets = dy * size + dx
+            per_chunk = max(block_values // len(dy), 1)
+            for chunk in range(0, len(members), per_chunk):
+                part = slice(chunk, chunk + per_chunk)
+                values = flat[base[part, None] + offsets]
+                plane = hc[part, None] + gy[part, None] * dy + gx[part, None] * dx
+                np.maximum(worst[part], np.abs(plane - values).max(axis=1), out=worst[part])
+        deviation[members] = worst
+    return deviation
+
+
+def rtin_mesh_triangles(heights, max_error, extent=None):
+    """
+    RTIN triangles covering `extent` with every grid point within `max_error` of the surface.
+
+    Martini's midpoint metric proposes the mesh; every triangle is then
+    checked against all grid points it covers, and those deviating by more
+    than `max_error` are forced to split (with their ancestors, so the mesh
+    stays conforming) until all pass. Triangles that passed are not checked
+    again. Triangles reaching past the extent are split until they lie on
+    either side of its edge, and the outer ones are dropped.
+
+    Args:
+        heights: (2^k + 1)-square float32 grid
+        max_error: Largest allowed vertical deviation
+        extent: (rows, cols) of the area to mesh, from the top-left corner
+            (defaults to the whole grid)
+
+    Returns:
+        (m, 3) int64 array of flat grid indices, as rtin_triangles
+    """
+    size = heights.shape[0]
+    last_row, last_col = (extent[0] - 1, extent[1] - 1) if extent else (size - 1, size - 1)
+    errors = rtin_midpoint_errors(heights)
+    # Grid points just past the edge become vertices, which splits almost every
+    # triangle crossing it in the first pass; the loop below catches the rest
+    errors[:last_row + 2, last_col + 1:last_col + 2] = np.inf
+    errors[last_row + 1:last_row + 2, :last_col + 2] = np.inf
+    rtin_propagate(errors)
+    # The two triangles sharing a hypotenuse midpoint m have their right angles
+    # on opposite sides of it; one bit each marks them as checked
+    checked = np.zeros(size * size, dtype=np.uint8)
+    while True:
+        triangles = rtin_triangles(errors, max_error)
+        ys, xs = np.divmod(triangles, size)
+        outside = (ys.max(axis=1) > last_row) | (xs.max(axis=1) > last_col)
+        crossing = outside & (ys.min(axis=1) < last_row) & (xs.min(axis=1) < last_col)
+        # Triangles without a hypotenuse midpoint only cover their own corners
+        splittable = ((ys[:, 0] + ys[:, 1]) % 2 == 0) & ((xs[:, 0] + xs[:, 1]) % 2 == 0)
+        pending = np.flatnonzero(splittable & ~outside)
+        midpoints = (triangles[pending, 0] + triangles[pending, 1]) // 2
+        sides = (triangles[pending, 2] > midpoints).astype(np.uint8) + 1
+        unchecked = (checked[midpoints] & sides) == 0
+        pending, midpoints, sides = pending[unchecked], midpoints[unchecked], sides[unchecked]
+
+        bad = triangle_errors(heights, triangles[pending]) > max_error
+        np.bitwise_or.at(checked, midpoints[~bad], sides[~bad])
+        split = np.concatenate([pending[bad], np.flatnonzero(crossing & splittable)])
+        if not len(split):
+            return triangles[~outside]
+        # Force the triangles to split, then their ancestors
+        errors.ravel()[(triangles[split, 0] + triangles[split, 1]) // 2] = np.inf
+        legs = np.maximum(np.abs(ys[split, 0] - ys[split, 1]), np.abs(xs[split, 0] - xs[split, 1]))
+        rtin_propagate(errors, int(legs.min()))
+
+
+def build_terrain_mesh(dem_data, max_error=None, max_grid=None):
+    """
+    Simplified triangle mesh of a DEM.
+
+    Args:
+        dem_data: 2D elevation array (may be a memory map)
+        max_error: Largest allowed vertical deviation from the DEM in meters
+            (defaults to DEM_MESH_MAX_ERROR)
+        max_grid: Largest RTIN grid side (defaults to DEM_MESH_MAX_GRID);
+            bigger DEMs are downsampled and the bound holds for the
+            downsampled DEM
+
+    Returns:
+        TerrainMesh with vertex x/y in source pixel units
+    """
+    max_error = DEFAULT_MESH_MAX_ERROR if max_error is None else float(max_error)
+    if max_error < 0:
+        raise ValueError("max_error must not be negative")
+    height, width = dem_data.shape
+    heights, (rows, cols) = rtin_grid(dem_data, max_grid)
+    triangles = rtin_mesh_triangles(heights, max_error, (rows, cols))
+
+    size = heights.shape[0]
+    used, faces = np.unique(triangles, return_inverse=True)
+    faces = faces.reshape(-1, 3).astype(np.uint32)
+    grid_rows, grid_cols = np.divmod(used, size)
+    vertices = np.empty((len(used), 3), dtype=np.float32)
+    vertices[:, 0] = grid_cols * ((width - 1) / max(cols - 1, 1))
+    vertices[:, 1] = (rows - 1 - grid_rows) * ((height - 1) / max(rows - 1, 1))  # north up
+    vertices[:, 2] = heights.ravel()[used]
+
+    # Counter-clockwise seen from +z
+    p0, p1, p2 = (vertices[faces[:, k], :2].astype(np.float64) for k in range(3))
+    cross = (p1[:, 0] - p0[:, 0]) * (p2[:, 1] - p0[:, 1]) - (p1[:, 1] - p0[:, 1]) * (p2[:, 0] - p0[:, 0])
+    faces[cross < 0] = faces[cross < 0][:, ::-1]
+    return TerrainMesh(vertices, faces, max_error)
+
+
+def write_obj(mesh, path):
+    """Wavefront OBJ text (1-based face indices)."""
+    with open(path, 'w') as f:
+        f.write(f"# DEM mesh: {len(mesh.vertices)} vertices, {len(mesh.faces)} faces, "
+                f"max error {mesh.max_error:g} m\n")
+        if len(mesh.vertices):
+            f.write(('v %.3f %.3f %.3f\n' * len(mesh.vertices)) % tuple(mesh.vertices.ravel().tolist()))
+        if len(mesh.faces):
+            f.write(('f %d %d %d\n' * len(mesh.faces)) % tuple((mesh.faces.ravel() + 1).tolist()))
+
+
+def write_ply(mesh, path):
+    """Binary little-endian PLY with float32 vertices and int32 triangle lists."""
+    header = (
+        "ply\nformat binary_little_endian 1.0\n"
+        f"comment DEM mesh, max error {mesh.max_error:g} m\n"
+        f"element vertex {len(mesh.vertices)}\n"
+        "property float x\nproperty float y\nproperty float z\n"
+        f"element face {len(mesh.faces)}\n"
+        "property list uchar int vertex_indices\n"
+        "end_header\n"
+    )
+    faces = np.empty(len(mesh.faces), dtype=[('count', 'u1'), ('indices', '<i4', 3)])
+    faces['count'] = 3
+    faces['indices'] = mesh.faces
+    with open(path, 'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(mesh.vertices.astype('<f4').tobytes())
+        f.write(faces.tobytes())
+
+
+def write_glb(mesh, path):
+    """Binary glTF 2.0 with a single indexed triangle primitive (Y-up)."""
+    # Z-up (x, y, z) to glTF's Y-up (x, z, -y); a rotation, so winding is kept
+    positions = np.ascontiguousarray(mesh.vertices[:, [0, 2, 1]], dtype='<f4')
+    positions[:, 2] *= -1
+    indices = np.ascontiguousarray(mesh.faces, dtype='<u4')
+    position_bytes = positions.tobytes()
+    index_offset = len(position_bytes)
+    binary = position_bytes + indices.tobytes()
+    binary += b'\0' * (-len(binary) % 4)
+
+    has_vertices = len(positions) > 0
+    document = {
+        'asset': {'version': '2.0', 'generator': 'DEM converter'},
+        'scene': 0,
+        'scenes': [{'nodes': [0]}],
+        'nodes': [{'mesh': 0, 'name': 'terrain'}],
+        'meshes': [{'primitives': [{'attributes': {'POSITION': 0}, 'indices': 1, 'mode': 4}]}],
+        'buffers': [{'byteLength': len(binary)}],
+        'bufferViews': [
+            {'buffer': 0, 'byteOffset': 0, 'byteLength': index_offset, 'target': 34962},
+            {'buffer': 0, 'byteOffset': index_offset, 'byteLength': indices.nbytes, 'target': 34963},
+        ],
+        'accessors': [
+            {'bufferView': 0, 'componentType': 5126, 'count': len(positions), 'type': 'VEC3',
+             'min': positions.min(axis=0).tolist() if has_vertices else [0, 0, 0],
+             'max': positions.max(axis=0).tolist() if has_vertices else [0, 0, 0]},
+            {'bufferView': 1, 'componentType': 5125, 'count': indices.size, 'type': 'SCALAR'},
+        ],
+    }
+    json_chunk = json.dumps(document, separators=(',', ':')).encode('utf-8')
+    json_chunk += b' ' * (-len(json_chunk) % 4)
+
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<4sII', b'glTF', 2, 12 + 8 + len(json_chunk) + 8 + len(binary)))
+        f.write(struct.pack('<I4s', len(json_chunk), b'JSON'))
+        f.write(json_chunk)
+        f.write(struct.pack('<I4s', len(binary), b'BIN\0'))
+        f.write(binary)
+
+
+MESH_WRITERS = {
+    '.obj': write_obj,
+    '.ply': write_ply,
+    '.glb': write_glb,
+}
+
+
+def write_mesh(mesh, path):
+    """Write a TerrainMesh in the format given by the file extension."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in MESH_WRITERS:
+        raise ValueError(f"Unsupported mesh format: {extension}")
+    MESH_WRITERS[extension](mesh, path)
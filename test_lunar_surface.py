@@ -34,24 +34,12 @@ def create_test_lunar_surface():
     combined_terrain = terrain1 + terrain2 + terrain3 + noise
     
     # Add some circular crater-like features
-    center_x, center_y = width // 2, height // 2
-    crater_radius = 80
-    for i in range(height):
-        for j in range(width):
-            dist = np.sqrt((i - center_y)**2 + (j - center_x)**2)
-            if dist < crater_radius:
-                crater_depth = (crater_radius - dist) / crater_radius * 0.4
-                combined_terrain[i, j] -= crater_depth
-    
-    # Add a smaller crater
-    center_x2, center_y2 = width // 4, 3 * height // 4
-    crater_radius2 = 40
-    for i in range(height):
-        for j in range(width):
-            dist = np.sqrt((i - center_y2)**2 + (j - center_x2)**2)
-            if dist < crater_radius2:
-                crater_depth = (crater_radius2 - dist) / crater_radius2 * 0.3
-                combined_terrain[i, j] -= crater_depth
+    rows, cols = np.ogrid[:height, :width]
+    for center_x, center_y, crater_radius, crater_scale in ((width // 2, height // 2, 80, 0.4),
+                                                            (width // 4, 3 * height // 4, 40, 0.3)):
+        dist = np.sqrt((rows - center_y)**2 + (cols - center_x)**2)
+        crater_depth = (crater_radius - dist) / crater_radius * crater_scale
+        combined_terrain -= np.where(dist < crater_radius, crater_depth, 0)
     
     # Normalize to 0-255 range
     combined_terrain = (combined_terrain - combined_terrain.min()) / (combined_terrain.max() - combined_terrain.min())
@@ -0,0 +1,146 @@
+"""
+XYZ tile pyramid for interactive DEM previews.
+
+Tiles are 256x256 colourised PNGs rendered straight from the job's DEM array
+with the terrain lookup table (see rendering.py). Zoom level ``max_zoom``
+shows the DEM at full resolution; every level below halves it, down to zoom 0
+where the whole raster fits in one tile. Downsampled levels are built once as
+memory-mapped .npy files, so rendering any tile reads at most 256x256 values.
+Rendered tiles are cached on disk under ``<tiles_folder>/<job_id>/``.
+"""
+import os
+import json
+import math
+import logging
+import tempfile
+import threading
+
+import numpy as np
+
+from artifacts import dem_array_path, dem_stats_path
+from rendering import TERRAIN_LUT, colorize, encode_png
+
+TILE_SIZE = 256
+
+# Striped locks serialising level builds and metadata writes of a job folder
+# (fixed in number, so they do not accumulate as jobs are viewed)
+LOCK_STRIPES = 64
+_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+
+def _job_lock(folder):
+    return _locks[hash(folder) % LOCK_STRIPES]
+
+
+def _atomic_write(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class TilePyramid:
+    """On-demand XYZ tiles of one job's DEM."""
+
+    def __init__(self, output_folder, job_id, tiles_folder=None):
+        """
+        Args:
+            output_folder: Directory holding ``<job_id>_dem.npy``
+            job_id: Job identifier
+            tiles_folder: Root of the tile cache (defaults to ``<output_folder>/tiles``)
+        """
+        self.job_id = job_id
+        self.dem_path = dem_array_path(output_folder, job_id)
+        self.stats_path = dem_stats_path(output_folder, job_id)
+        self.folder = os.path.join(tiles_folder or os.path.join(output_folder, 'tiles'), job_id)
+        self.logger = logging.getLogger(__name__)
+
+    def info(self):
+        """
+        Raster size, zoom range and elevation range, computed once per job.
+
+        The elevation range comes from the statistics saved with the DEM; only
+        DEMs without them are scanned.
+
+        Raises:
+            FileNotFoundError: If the job has no DEM array
+        """
+        meta_path = os.path.join(self.folder, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                return json.load(f)
+
+        dem = np.load(self.dem_path, mmap_mode='r')
+        with _job_lock(self.folder):
+            if os.path.exists(meta_path):
+                with open(meta_path) as f:
+                    return json.load(f)
+            from dem_stats import compute_statistics, load_statistics
+            statistics = load_statistics(self.stats_path) or compute_statistics(dem, bins=0)
+            height, width = dem.shape
+            info = {
+                'width': width,
+                'height': height,
+                'tile_size': TILE_SIZE,
+                'max_zoom': max(math.ceil(math.log2(max(height, width) / TILE_SIZE)), 0),
+                'min_elevation': statistics.min,
+                'max_elevation': statistics.max,
+            }
+            os.makedirs(self.folder, exist_ok=True)
+            _atomic_write(meta_path, json.dumps(info).encode('utf-8'))
+        return info
+
+    def tile_path(self, z, x, y):
+        return os.path.join(self.folder, str(z), str(x), f"{y}.png")
+
+    def render(self, z, x, y):
+        """
+        Path of the PNG for tile (z, x, y), rendering it if it is not cached.
+
+        Returns:
+            File path, or None if the tile lies outside the raster
+        """
+        info = self.info()
+        if not 0 <= z <= info['max_zoom']:
+            return None
+        path = self.tile_path(z, x, y)
+        if os.path.exists(path):
+            return path
+
+        level = self._level(info['max_zoom'] - z)
+        y0, x0 = y * TILE_SIZE, x * TILE_SIZE
+        if x < 0 or y < 0 or y0 >= level.shape[0] or x0 >= level.shape[1]:
+            return None
+
+        # Pixels beyond the raster edge stay transparent
+        block = np.asarray(level[y0:y0 + TILE_SIZE, x0:x0 + TILE_SIZE])
+        tile = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+        tile[:block.shape[0], :block.shape[1], :3] = colorize(
+            block, info['min_elevation'], info['max_elevation'], TERRAIN_LUT
+        )
+        tile[:block.shape[0], :block.shape[1], 3] = 255
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _atomic_write(path, encode_png(tile))
+        return path
+
+    def _level(self, reduction):
+        """DEM downsampled `reduction` times by 2x2 averaging (0 is the DEM itself)."""
+        if reduction == 0:
+            return np.load(self.dem_path, mmap_mode='r')
+
+        path = os.path.join(self.folder, f"level_{reduction}.npy")
+        if not os.path.exists(path):
+            source = self._level(reduction - 1)
+            with _job_lock(self.folder):
+                if not os.path.exists(path):
+                    from geotiff import downsample_mean
+                    self.logger.debug(f"Building tile level {reduction} for job {self.job_id}")
+                    shape = ((source.shape[0] + 1) // 2, (source.shape[1] + 1) // 2)
+                    tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+                    level = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=shape)
+                    downsample_mean(source, out=level)
+                    level.flush()
+                    del level
+                    os.replace(tmp_path, path)
+        return np.load(path, mmap_mode='r')
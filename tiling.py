@@ -0,0 +1,299 @@
+"""
+Tiled, out-of-core execution of the height-from-shading pipeline.
+
+The in-memory path in DEMProcessor._height_from_shading allocates about a dozen
+full-size float temporaries, which does not fit in RAM for large orbital
+mosaics. The engine below runs the same kernels block by block, reading each
+tile plus a halo wide enough for the neighbourhood filters, and writes the DEM
+incrementally into a memory-mapped .npy file. The two global reductions
+(gradient maximum and final min/max rescale) are handled with extra passes, so
+the result matches the in-memory path up to rounding. How close depends on the
+blur backend that filters.py picks for the smoothing kernel (see tolerance()):
+
+- spatial (smoothing below 64 at the default DEM_FFT_MIN_KERNEL): filters
+  evaluated on a tile rather than the whole image can round differently in
+  the last bit, and the DEMs differ by less than SPATIAL_TOLERANCE of the
+  elevation range (about 2e-7 on synthetic terrain), often not at all
+- fft: float32 transforms of a tile and of the whole image have different
+  sizes and round differently, and heavy smoothing flattens the image so the
+  final rescale magnifies that: about 1e-5 to 6e-5 of the range at smoothing
+  64, 1e-3 at 200 and 1e-2 at 500 (the largest the form allows), below
+  FFT_TOLERANCE
+
+`python benchmark.py parallel --smoothing N` checks the bound.
+"""
+import os
+import logging
+import tempfile
+import functools
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+# Default working-set budget for one tile (bytes)
+DEFAULT_TILE_BUDGET = int(os.environ.get('DEM_TILE_BUDGET_MB', 256)) * 1024 * 1024
+
+# Images whose in-memory working set would exceed this are processed tiled
+TILED_THRESHOLD = int(os.environ.get('DEM_TILED_THRESHOLD_MB', 2048)) * 1024 * 1024
+
+# Approximate peak bytes per pixel held by the height-from-shading kernels
+# (four float64 scratch buffers plus image, blur and post-smoothing copies)
+BYTES_PER_PIXEL = 64
+
+# Neighbourhood radii of the kernels (3x3 Sobel, truncate=4.0 Gaussian)
+SOBEL_RADIUS = 1
+MIN_TILE_SIZE = 64
+
+# OpenCV's vectorised filters treat the last (width % lanes) columns of a row
+# with scalar code that rounds differently. Tile windows start on a multiple of
+# this many columns and either end at the raster edge or carry this many spare
+# columns, so every pixel that reaches the output sees the same code path as
+# in a full-image call.
+COLUMN_ALIGNMENT = 64
+
+# Largest difference from the in-memory DEM, as a fraction of the elevation
+# range, per blur backend
+SPATIAL_TOLERANCE = 1e-6
+FFT_TOLERANCE = 2e-2
+
+Tile = namedtuple('Tile', ['core', 'window', 'inner'])
+Tile.__doc__ = """Output region, halo-extended read window and core position inside the window."""
+
+
+def post_smooth_radius(sigma):
+    """Radius of scipy.ndimage.gaussian_filter with its default truncate of 4.0."""
+    return int(4.0 * float(sigma) + 0.5)
+
+
+def tolerance(smoothing):
+    """Bound on |tiled - in-memory| / elevation range for a smoothing value."""
+    from filters import resolve_backend
+    backend = resolve_backend('auto', smoothing * 2 + 1) if smoothing > 0 else 'spatial'
+    return FFT_TOLERANCE if backend == 'fft' else SPATIAL_TOLERANCE
+
+
+def needs_tiling(shape, budget=None):
+    """Whether an image of this shape should go through the tiled engine."""
+    return shape[0] * shape[1] * BYTES_PER_PIXEL > (budget or TILED_THRESHOLD)
+
+
+def tile_size_for_budget(tile_budget, halo):
+    """Largest square core tile whose halo-extended working set fits the budget."""
+    side = int(np.sqrt(tile_budget / BYTES_PER_PIXEL)) - 2 * (halo + COLUMN_ALIGNMENT)
+    return max(side, MIN_TILE_SIZE)
+
+
+def iter_tiles(shape, tile_size, halo, align=1):
+    """
+    Split a raster into square tiles with a halo.
+
+    Args:
+        shape: (height, width) of the raster
+        tile_size: Edge length of the output (core) region of each tile
+        halo: Extra pixels read on every side, clipped at the raster border
+        align: Column alignment of the windows; each window starts on a
+            multiple of `align` and either reaches the raster edge or extends
+            at least `align` columns past the halo
+
+    Yields:
+        Tile tuples of slice pairs
+    """
+    height, width = shape
+    for y0 in range(0, height, tile_size):
+        y1 = min(y0 + tile_size, height)
+        wy0, wy1 = max(y0 - halo, 0), min(y1 + halo, height)
+        for x0 in range(0, width, tile_size):
+            x1 = min(x0 + tile_size, width)
+            wx0 = max(x0 - halo, 0) // align * align
+            wx1 = min(x1 + halo + (align if align > 1 else 0), width)
+            yield Tile(
+                core=(slice(y0, y1), slice(x0, x1)),
+                window=(slice(wy0, wy1), slice(wx0, wx1)),
+                inner=(slice(y0 - wy0, y1 - wy0), slice(x0 - wx0, x1 - wx0)),
+            )
+
+
+def _open_array(ref, mode='r'):
+    """Resolve an array reference: arrays pass through, paths open as memmaps."""
+    if not isinstance(ref, str):
+        return ref
+    key = (ref, mode)
+    if key not in _open_arrays:
+        _open_arrays[key] = np.load(ref, mmap_mode=mode)
+    return _open_arrays[key]
+
+
+# Memory maps opened by pool processes, keyed by (path, mode)
+_open_arrays = {}
+
+# Per-thread kernel scratch buffers, reused across tiles of the same shape
+_thread_state = threading.local()
+
+
+def _kernel_scratch(dtype):
+    scratch = getattr(_thread_state, 'scratch', None)
+    if scratch is None or scratch.dtype != dtype:
+        from dem_processor import KernelScratch
+        scratch = _thread_state.scratch = KernelScratch(dtype)
+    return scratch
+
+
+def _tile_gradients(ctx, tile):
+    """Run the neighbourhood kernels on a halo-extended tile."""
+    processor = ctx['processor']
+    window = np.ascontiguousarray(_open_array(ctx['image'])[tile.window])
+    img_norm = processor._normalize_intensity(window, ctx['smoothing'])
+    gradients = processor._surface_gradients(img_norm, _kernel_scratch(processor.dtype))
+    return img_norm, gradients
+
+
+def _gradient_max_task(ctx, tile):
+    """Pass 1: maximum gradient magnitude inside the tile core."""
+    _, gradients = _tile_gradients(ctx, tile)
+    return float(gradients[-1][tile.inner].max())
+
+
+def _estimate_task(ctx, tile):
+    """Pass 2: write the clipped estimate of the tile core; returns its min/max."""
+    img_norm, gradients = _tile_gradients(ctx, tile)
+    block = ctx['processor']._shaded_estimate(img_norm, gradients, ctx['gradient_max'])[tile.inner]
+    estimate = _open_array(ctx['estimate'], 'r+')
+    estimate[tile.core] = block
+    return float(block.min()), float(block.max())
+
+
+def _smooth_task(ctx, tile):
+    """Pass 3: rescale to 0-1 and post-smooth the tile, writing its core to the output."""
+    processor = ctx['processor']
+    block = processor._normalize_estimate(
+        np.array(_open_array(ctx['estimate'])[tile.window]), ctx['estimate_min'], ctx['estimate_max']
+    )
+    dem = _open_array(ctx['output'], 'r+')
+    dem[tile.core] = processor._post_smooth(block)[tile.inner]
+
+
+class TiledHeightFromShading:
+    """Block-wise height-from-shading with bounded peak memory."""
+
+    def __init__(self, processor, tile_budget=None, scratch_dir=None, workers=1, executor='thread'):
+        """
+        Args:
+            processor: DEMProcessor whose kernels are applied to each tile
+            tile_budget: Working-set budget per tile in bytes (one tile per worker is in flight)
+            scratch_dir: Directory for the intermediate memory-mapped estimate
+            workers: Number of tiles processed concurrently
+            executor: 'thread' (OpenCV and NumPy release the GIL) or 'process'
+                (tiles exchange data through memory-mapped scratch files)
+        """
+        if executor not in ('thread', 'process'):
+            raise ValueError(f"Unknown executor: {executor}")
+        self.processor = processor
+        self.tile_budget = tile_budget or DEFAULT_TILE_BUDGET
+        self.scratch_dir = scratch_dir
+        self.workers = max(int(workers or 1), 1)
+        self.executor = executor
+        self.logger = logging.getLogger(__name__)
+
+    def run(self, image, output_path, smoothing):
+        """
+        Compute the normalized (0-1) DEM for `image` and write it to `output_path` as a .npy file.
+
+        The result matches DEMProcessor._normalized_height; scale it with
+        DEMProcessor._scale_dem to obtain elevations.
+
+        Args:
+            image: 2D uint8 array-like supporting slicing (ndarray or np.memmap)
+            output_path: Destination .npy file for the DEM
+
+        Returns:
+            Read-only memory map of the written DEM
+        """
+        from dem_processor import POST_SMOOTH_SIGMA
+        from profiling import measure
+
+        shape = image.shape[:2]
+        shading_halo = max(smoothing, 0) + SOBEL_RADIUS
+        smooth_halo = post_smooth_radius(POST_SMOOTH_SIGMA)
+        tile_size = self._tile_size(shape, shading_halo)
+        smooth_tile = self._tile_size(shape, smooth_halo)
+        self.logger.debug(f"Tiled height-from-shading: {shape[1]}x{shape[0]}, tile {tile_size}px, "
+                          f"{self.workers} {self.executor} workers")
+
+        scratch_dir = self.scratch_dir or os.path.dirname(os.path.abspath(output_path))
+        scratch_paths = []
+        pool = self._create_pool()
+        try:
+            estimate_path = self._scratch_file(scratch_dir, scratch_paths)
+            dtype = self.processor.dtype
+            np.lib.format.open_memmap(estimate_path, mode='w+', dtype=dtype, shape=shape).flush()
+            np.lib.format.open_memmap(output_path, mode='w+', dtype=dtype, shape=shape).flush()
+
+            if self.executor == 'process' and pool is not None:
+                # Pool processes read the input through a shared memory map
+                image_ref = self._scratch_file(scratch_dir, scratch_paths)
+                np.save(image_ref, np.asarray(image))
+            else:
+                image_ref = image
+
+            ctx = {
+                'processor': self.processor,
+                'image': image_ref,
+                'estimate': estimate_path,
+                'output': output_path,
+                'smoothing': smoothing,
+            }
+
+            profiler = self.processor.profiler
+
+            # Pass 1: global gradient maximum
+            shading_tiles = list(iter_tiles(shape, tile_size, shading_halo, COLUMN_ALIGNMENT))
+            with measure(profiler, 'tiles:gradient_max'):
+                ctx['gradient_max'] = max(self._map(pool, _gradient_max_task, ctx, shading_tiles))
+
+            # Pass 2: clipped estimates into the scratch memmap, tracking global min/max
+            with measure(profiler, 'tiles:estimate', written_to=estimate_path):
+                extrema = self._map(pool, _estimate_task, ctx, shading_tiles)
+            ctx['estimate_min'] = min(low for low, _ in extrema)
+            ctx['estimate_max'] = max(high for _, high in extrema)
+
+            # Pass 3: rescale and post-smooth, streaming tiles into the output file
+            with measure(profiler, 'tiles:post_smooth', written_to=output_path):
+                self._map(pool, _smooth_task, ctx, list(iter_tiles(shape, smooth_tile, smooth_halo)))
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            _open_arrays.clear()
+            for path in scratch_paths:
+                os.remove(path)
+
+        return np.load(output_path, mmap_mode='r')
+
+    def _tile_size(self, shape, halo):
+        """Tile size within the budget, small enough to keep every worker busy."""
+        tile_size = tile_size_for_budget(self.tile_budget, halo)
+        if self.workers > 1:
+            per_axis = int(np.ceil(np.sqrt(self.workers * 2)))
+            tile_size = min(tile_size, max(int(np.ceil(max(shape) / per_axis)), MIN_TILE_SIZE))
+        return tile_size
+
+    def _create_pool(self):
+        if self.workers <= 1:
+            return None
+        if self.executor == 'process':
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        from concurrent.futures import ThreadPoolExecutor
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='dem-tile')
+
+    def _map(self, pool, task, ctx, tiles):
+        if pool is None:
+            return [task(ctx, tile) for tile in tiles]
+        return list(pool.map(functools.partial(task, ctx), tiles))
+
+    def _scratch_file(self, scratch_dir, scratch_paths):
+        fd, path = tempfile.mkstemp(suffix='.npy', dir=scratch_dir)
+        os.close(fd)
+        scratch_paths.append(path)
+        return path
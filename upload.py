@@ -0,0 +1,287 @@
+"""
+Streaming ingestion of uploaded images.
+
+The multipart parser writes every uploaded file through an UploadStream (see
+UploadRequest) instead of Werkzeug's spooled temporary file. The stream hashes
+the bytes and writes them to the upload folder as they arrive. It also reads the
+image signature and dimensions from the header, so an unsupported or oversized
+image is rejected before the rest of the request body is read. Only the
+header is kept in memory; the image is decoded by the worker that processes
+the job, never inside the web request. Views receiving many files at once (see
+multi_file_uploads) drop rejected files instead of failing the whole request.
+"""
+import os
+import struct
+import hashlib
+import logging
+import tempfile
+
+from flask import Request, current_app
+
+# Largest accepted image (width x height); a BGR decode needs 3 bytes per pixel
+MAX_IMAGE_PIXELS = int(os.environ.get('DEM_MAX_IMAGE_PIXELS', 1 << 28))
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+JPEG_SIGNATURE = b'\xff\xd8\xff'
+TIFF_SIGNATURES = (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+')
+
+# JPEG start-of-frame markers (SOF0-SOF15 without DHT, JPG and DAC)
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# TIFF ImageWidth / ImageLength tags and the integer field types they may use
+TIFF_SIZE_TAGS = {256: 'width', 257: 'height'}
+TIFF_INTEGER_TYPES = {3: 'H', 4: 'I', 16: 'Q'}
+
+logger = logging.getLogger(__name__)
+
+
+class UploadRejected(Exception):
+    """
+    The uploaded file is not an image this service accepts.
+
+    Not a ValueError: Werkzeug's form parser silently drops the form on those.
+    """
+
+
+def image_header(data):
+    """
+    Identify a PNG, JPEG or TIFF image and read its dimensions from the header.
+
+    Args:
+        data: Leading bytes of the file (possibly all of it)
+
+    Returns:
+        Tuple (format, width, height); width and height are None while the
+        bytes holding them have not arrived yet, format is None below 8 bytes
+
+    Raises:
+        UploadRejected: The data is not a supported or well-formed image
+    """
+    data = memoryview(data)
+    if len(data) < 8:
+        return None, None, None
+
+    head = bytes(data[:8])
+    if head == PNG_SIGNATURE:
+        return ('png',) + _png_size(data)
+    if head.startswith(JPEG_SIGNATURE):
+        return ('jpeg',) + _jpeg_size(data)
+    if head[:4] in TIFF_SIGNATURES:
+        return ('tiff',) + _tiff_size(data)
+    raise UploadRejected("File is not a PNG, JPEG or TIFF image")
+
+
+def _png_size(data):
+    """Dimensions from the IHDR chunk that must follow the PNG signature."""
+    if len(data) < 24:
+        return None, None
+    if bytes(data[12:16]) != b'IHDR':
+        raise UploadRejected("Corrupt PNG header")
+    return struct.unpack('>II', data[16:24])
+
+
+def _jpeg_size(data):
+    """Dimensions from the first start-of-frame segment of a JPEG stream."""
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            raise UploadRejected("Corrupt JPEG header")
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1  # Fill byte
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            pos += 2  # Segments without a length
+        elif marker in (0xD9, 0xDA):
+            raise UploadRejected("JPEG has no frame header")
+        elif marker in JPEG_SOF_MARKERS:
+            if pos + 9 > len(data):
+                break
+            height, width = struct.unpack('>HH', data[pos + 5:pos + 9])
+            return width, height
+        else:
+            pos += 2 + struct.unpack('>H', data[pos + 2:pos + 4])[0]
+    return None, None
+
+
+def _tiff_size(data):
+    """Dimensions from the first image file directory of a (Big)TIFF file."""
+    order = '<' if bytes(data[:2]) == b'II' else '>'
+    big = struct.unpack(order + 'H', data[2:4])[0] == 43
+    offset_format, count_format, entry_size = ('Q', 'Q', 20) if big else ('I', 'H', 12)
+    if big and len(data) < 16:
+        return None, None
+    ifd = struct.unpack(order + offset_format, data[8:16] if big else data[4:8])[0]
+
+    count_size = struct.calcsize(count_format)
+    if len(data) < ifd + count_size:
+        return None, None
+    count = struct.unpack(order + count_format, data[ifd:ifd + count_size])[0]
+    entries = ifd + count_size
+    if len(data) < entries + count * entry_size:
+        return None, None
+
+    size = {}
+    value_offset = 12 if big else 8
+    for start in range(entries, entries + count * entry_size, entry_size):
+        tag, field_type = struct.unpack(order + 'HH', data[start:start + 4])
+        if tag in TIFF_SIZE_TAGS and field_type in TIFF_INTEGER_TYPES:
+            value_format = order + TIFF_INTEGER_TYPES[field_type]
+            value = data[start + value_offset:start + value_offset + struct.calcsize(value_format)]
+            size[TIFF_SIZE_TAGS[tag]] = struct.unpack(value_format, value)[0]
+    if len(size) != 2:
+        raise UploadRejected("TIFF has no image dimensions")
+    return size['width'], size['height']
+
+
+class UploadStream:
+    """Writable file object given to the multipart parser for one uploaded file."""
+
+    def __init__(self, folder, max_pixels=None, strict=True):
+        """
+        Args:
+            folder: Upload directory; the data is written to a hidden partial
+                file there until store() moves it to its final name
+            max_pixels: Largest accepted width x height (defaults to MAX_IMAGE_PIXELS)
+            strict: Raise UploadRejected as soon as the file is rejected,
+                aborting the request. Non-strict streams belong to multi-file
+                requests, so a rejected file is dropped and reported by
+                finish() instead.
+        """
+        self.max_pixels = MAX_IMAGE_PIXELS if max_pixels is None else max_pixels
+        self.strict = strict
+        self.rejected = None
+        self.format = self.width = self.height = None
+        self.size = 0
+        self.data = bytearray()
+        self._digest = hashlib.sha256()
+        self._position = 0
+        self._stored = False
+        fd, self.path = tempfile.mkstemp(prefix='.upload-', suffix='.part', dir=folder)
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        """Hash and store a chunk, validating the header as soon as it is complete."""
+        if self.rejected is not None:
+            return len(chunk)
+        try:
+            self._digest.update(chunk)
+            self._file.write(chunk)
+            self.size += len(chunk)
+            if self.height is None:
+                self.data += chunk
+                self._check_header()
+                if self.height is not None:
+                    self.data = bytearray()
+        except UploadRejected as e:
+            self.close()
+            if self.strict:
+                raise
+            self.rejected = e
+        except Exception:
+            # The parser drops a stream that failed mid-upload without closing it
+            self.close()
+            raise
+        return len(chunk)
+
+    def _check_header(self):
+        self.format, self.width, self.height = image_header(self.data)
+        if self.height is None:
+            return
+        if self.width == 0 or self.height == 0:
+            raise UploadRejected("Image has no pixels")
+        if self.width * self.height > self.max_pixels:
+            raise UploadRejected(f"Image is {self.width}x{self.height} pixels; "
+                                 f"the limit is {self.max_pixels:,} pixels")
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        with open(self.path, 'rb') as f:
+            f.seek(self._position)
+            chunk = f.read(size)
+        self._position += len(chunk)
+        return chunk
+
+    def finish(self):
+        """
+        Complete the upload once the parser is done with it.
+
+        Returns:
+            Hex SHA-256 digest of the uploaded bytes
+
+        Raises:
+            UploadRejected: The file was rejected while it arrived, or it
+                ended before its header was complete
+        """
+        self._file.close()
+        if self.rejected is not None:
+            raise self.rejected
+        if self.height is None:
+            raise UploadRejected("Image header is truncated")
+        return self._digest.hexdigest()
+
+    def store(self, path):
+        """Move the completed upload to its final path."""
+        os.replace(self.path, path)
+        self.path = path
+        self._stored = True
+
+    def close(self):
+        """Release the header buffer and remove the partial file unless it was stored."""
+        self._file.close()
+        self.data = bytearray()
+        if not self._stored and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def multi_file_uploads(view):
+    """Mark a view receiving many files at once, whose rejected files are dropped and reported."""
+    view.multi_file_uploads = True
+    return view
+
+
+class UploadRequest(Request):
+    """Request class streaming file uploads through UploadStream."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        view = current_app.view_functions.get(self.endpoint)
+        return UploadStream(current_app.config['UPLOAD_FOLDER'], current_app.config.get('MAX_IMAGE_PIXELS'),
+                            strict=not getattr(view, 'multi_file_uploads', False))
+
+
+def ingest_file(path, folder, max_pixels=None, chunk_size=1024 * 1024):
+    """
+    Copy a server-side image into the upload folder with the checks of an upload.
+
+    Args:
+        path: Image to ingest
+        folder: Upload directory
+        max_pixels: Largest accepted width x height (defaults to MAX_IMAGE_PIXELS)
+
+    Returns:
+        Tuple (finished non-strict UploadStream, hex SHA-256 digest); the
+        caller stores it under its final name and closes it
+
+    Raises:
+        UploadRejected: The file is not a supported image
+    """
+    upload = UploadStream(folder, max_pixels, strict=False)
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                upload.write(chunk)
+                if upload.rejected is not None:
+                    break
+        return upload, upload.finish()
+    except Exception:
+        upload.close()
+        raise
+
@@ -0,0 +1,96 @@
+"""
+Ahead-of-time loading of the processing libraries.
+
+The web application imports OpenCV, Pillow and scipy only in the routes and
+writers that need them, so a web worker boots without them. warm_up() loads
+them ahead of time and runs each kernel once on a tiny image. That moves the
+import cost, OpenCV's first-call initialisation and the font loading out of
+the first request or job:
+
+- DEM_PRELOAD=1 warms the web libraries when app.py is imported. Combined
+  with ``gunicorn --preload``, the forked web workers share them.
+- Job worker pool processes warm the processing libraries when they start
+  (DEM_WORKER_WARMUP, on by default; see worker.py), and the pool starts
+  its processes before the first job arrives.
+
+``python benchmark.py startup`` measures boot time, RSS and first-job
+latency with and without warm-up.
+"""
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _web_libraries():
+    """OpenCV PNG encoding and the Pillow fonts of the preview tiles and uploads."""
+    import numpy as np
+    import cv2
+    from rendering import TERRAIN_LUT, colorize, encode_png, _font
+    tile = colorize(np.linspace(0, 1, 64 * 64, dtype=np.float32).reshape(64, 64), 0.0, 1.0, TERRAIN_LUT)
+    cv2.imdecode(np.frombuffer(encode_png(tile), dtype=np.uint8), cv2.IMREAD_COLOR)
+    _font(14)
+    _font(14, bold=True)
+
+
+def _processing_kernels():
+    """Run the whole pipeline, with the GeoTIFF and preview writers, on a small image."""
+    import tempfile
+    import numpy as np
+    from dem_processor import DEMProcessor
+    import mesh  # noqa: F401
+    import terrain_mesh  # noqa: F401
+    image = (np.random.default_rng(0).random((64, 64)) * 255).astype(np.uint8)
+    with tempfile.TemporaryDirectory() as tmp:
+        result = DEMProcessor().process_image(os.path.join(tmp, 'warmup.png'), tmp, 'warmup', image=image,
+                                              formats=('dem', 'dem_image'))
+    if result['status'] != 'success':
+        raise RuntimeError(result['error'])
+
+
+def _matplotlib():
+    """Import matplotlib and draw one figure, which builds its font cache."""
+    import io
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(1, 1))
+    ax.set_title('DEM')
+    fig.savefig(io.BytesIO(), format='png')
+    plt.close(fig)
+
+
+def warm_up(processing=True, matplotlib=None):
+    """
+    Load the libraries of the web routes and, optionally, of DEM processing.
+
+    Failures are logged and skipped; warming up never prevents a process
+    from starting.
+
+    Args:
+        processing: Also run the DEM pipeline and its common output writers once
+        matplotlib: Also build matplotlib's font cache (defaults to whether
+            DEM_RENDERER=matplotlib selects the matplotlib renderer)
+
+    Returns:
+        Dictionary of seconds spent per step
+    """
+    steps = [('web', _web_libraries)]
+    if processing:
+        steps.append(('processing', _processing_kernels))
+        if matplotlib is None:
+            matplotlib = os.environ.get('DEM_RENDERER', 'lut') == 'matplotlib'
+    if matplotlib:
+        steps.append(('matplotlib', _matplotlib))
+
+    timings = {}
+    for name, step in steps:
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            logger.warning(f"Warm-up step {name} failed: {str(e)}")
+        timings[name] = round(time.perf_counter() - start, 3)
+    logger.info(f"Warm-up done in {sum(timings.values()):.2f}s ({timings})")
+    return timings
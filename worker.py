@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Background worker pool for queued DEM processing jobs.
+
+Uploads are stored as 'pending' ProcessingJob rows. The worker pool claims them
+from the database, runs DEMProcessor in a local process pool and moves each job
+through 'processing' to 'completed' or 'failed'. Jobs whose worker stopped
+sending heartbeats are reclaimed and retried.
+
+Run standalone with ``python worker.py`` or inside the web process by setting
+DEM_EMBEDDED_WORKER=1.
+"""
+import os
+import json
+import socket
+import logging
+import threading
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+
+from metrics import JOBS, JOB_DURATION, JOB_QUEUE_WAIT, JOBS_IN_FLIGHT, CACHE_REQUESTS, observe_stage_metrics
+
+# Worker configuration (overridable through the environment)
+WORKER_PROCESSES = int(os.environ.get('DEM_WORKER_PROCESSES', os.cpu_count() or 1))
+POLL_INTERVAL = float(os.environ.get('DEM_WORKER_POLL_INTERVAL', 1.0))
+STALE_JOB_TIMEOUT = float(os.environ.get('DEM_STALE_JOB_TIMEOUT', 300))
+MAX_JOB_ATTEMPTS = int(os.environ.get('DEM_MAX_JOB_ATTEMPTS', 3))
+METRICS_PORT = os.environ.get('DEM_WORKER_METRICS_PORT')  # Standalone workers serve /metrics here when set
+WORKER_WARMUP = os.environ.get('DEM_WORKER_WARMUP', '1') == '1'  # Load the processing libraries at pool start
+
+
+def run_processing_job(input_path, output_folder, job_id, params):
+    """Process a single job inside a pool process (no database access here)."""
+    from dem_processor import DEMProcessor
+    from stage_cache import StageCache
+    processor = DEMProcessor(stage_cache=StageCache(os.path.join(output_folder, 'stages')))
+    return processor.process_image(input_path, output_folder=output_folder, job_id=job_id, **params)
+
+
+def warm_up_process():
+    """Pool process initializer: load the processing libraries before the first job arrives."""
+    from warmup import warm_up
+    warm_up(processing=True)
+
+
+def job_parameters(job):
+    """Collect the DEMProcessor keyword arguments stored on a job."""
+    params = {
+        'scale_factor': job.scale_factor,
+        'smoothing': job.smoothing,
+        'elevation_range': job.elevation_range,
+        'workers': job.workers or 1,
+        'content_hash': job.content_hash,
+        'formats': job.eager_formats,
+        'mesh_max_error': job.mesh_max_error,
+    }
+    # Jobs queued before the solver options existed keep the DEMProcessor defaults
+    solver_params = {'solver': job.solver, 'sun_azimuth': job.sun_azimuth, 'sun_elevation': job.sun_elevation,
+                     'reflectance': job.reflectance}
+    params.update({name: value for name, value in solver_params.items() if value is not None})
+    return params
+
+
+class JobWorkerPool:
+    """Claims pending jobs from the database and runs them on a process pool."""
+
+    def __init__(self, app, max_workers=None, poll_interval=None, stale_timeout=None, max_attempts=None):
+        """
+        Args:
+            app: Flask application providing the database and folder configuration
+            max_workers: Number of processing processes (defaults to DEM_WORKER_PROCESSES)
+            poll_interval: Seconds between queue polls
+            stale_timeout: Seconds without heartbeat after which a job is reclaimed
+            max_attempts: Number of claims before a repeatedly crashing job is failed
+        """
+        self.app = app
+        self.max_workers = max_workers or WORKER_PROCESSES
+        self.poll_interval = poll_interval if poll_interval is not None else POLL_INTERVAL
+        self.stale_timeout = stale_timeout if stale_timeout is not None else STALE_JOB_TIMEOUT
+        self.max_attempts = max_attempts or MAX_JOB_ATTEMPTS
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.logger = logging.getLogger(__name__)
+
+        self._executor = None
+        self._in_flight = {}  # Future -> job id
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_heartbeat = datetime.min
+        self._last_reclaim = datetime.min
+
+    def start(self):
+        """Run the dispatch loop in a daemon thread."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run_forever, name='dem-job-dispatcher', daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def stop(self, wait=True):
+        """Ask the dispatch loop to exit after its current iteration."""
+        self._stop.set()
+        if wait and self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def run_forever(self):
+        """Poll the queue until stop() is called."""
+        self.logger.info(f"Worker {self.worker_id} started with {self.max_workers} processes")
+        if WORKER_WARMUP:
+            self._prestart()
+        with self.app.app_context():
+            try:
+                while not self._stop.is_set():
+                    try:
+                        self.run_once()
+                    except Exception as e:
+                        self.logger.error(f"Worker loop error: {str(e)}")
+                        self._db().session.rollback()
+                    self._stop.wait(self.poll_interval)
+            finally:
+                self._shutdown_executor()
+
+    def run_once(self):
+        """Perform one dispatch iteration; returns the number of newly claimed jobs."""
+        self._collect_finished()
+
+        now = datetime.utcnow()
+        if now - self._last_heartbeat >= timedelta(seconds=self.stale_timeout / 10):
+            self._heartbeat(now)
+        if now - self._last_reclaim >= timedelta(seconds=self.stale_timeout / 2):
+            self.reclaim_stale_jobs(now)
+
+        free_slots = self.max_workers - len(self._in_flight)
+        if free_slots <= 0:
+            return 0
+
+        claimed = self.claim_jobs(free_slots)
+        for job_id in claimed:
+            self._submit(job_id)
+        JOBS_IN_FLIGHT.set(len(self._in_flight))
+        return len(claimed)
+
+    def claim_jobs(self, limit):
+        """Atomically move up to `limit` pending jobs to 'processing' for this worker."""
+        from sqlalchemy import select, update, func
+        from models import ProcessingJob
+        db = self._db()
+
+        candidates = db.session.execute(
+            select(ProcessingJob.id)
+            .where(ProcessingJob.status == 'pending')
+            .order_by(ProcessingJob.created_at)
+            .limit(limit)
+        ).scalars().all()
+
+        now = datetime.utcnow()
+        claimed = []
+        for job_id in candidates:
+            # The status guard makes the claim safe against competing workers
+            result = db.session.execute(
+                update(ProcessingJob)
+                .where(ProcessingJob.id == job_id, ProcessingJob.status == 'pending')
+                .values(
+                    status='processing',
+                    worker_id=self.worker_id,
+                    started_at=now,
+                    heartbeat_at=now,
+                    attempts=func.coalesce(ProcessingJob.attempts, 0) + 1,
+                )
+            )
+            if result.rowcount == 1:
+                claimed.append(job_id)
+        db.session.commit()
+        return claimed
+
+    def reclaim_stale_jobs(self, now=None):
+        """Requeue (or fail) 'processing' jobs whose worker stopped sending heartbeats."""
+        from sqlalchemy import update, or_, func
+        from models import ProcessingJob
+        db = self._db()
+
+        now = now or datetime.utcnow()
+        self._last_reclaim = now
+        cutoff = now - timedelta(seconds=self.stale_timeout)
+        stale = (
+            ProcessingJob.status == 'processing',
+            or_(ProcessingJob.heartbeat_at.is_(None), ProcessingJob.heartbeat_at < cutoff),
+        )
+
+        exhausted = db.session.execute(
+            update(ProcessingJob)
+            .where(*stale, func.coalesce(ProcessingJob.attempts, 0) >= self.max_attempts)
+            .values(
+                status='failed',
+                worker_id=None,
+                processing_log='Error: worker stopped responding too many times',
+            )
+        ).rowcount
+        requeued = db.session.execute(
+            update(ProcessingJob)
+            .where(*stale)
+            .values(status='pending', worker_id=None, heartbeat_at=None)
+        ).rowcount
+        db.session.commit()
+
+        JOBS.inc(exhausted, status='failed')
+        JOBS.inc(requeued, status='retried')
+        if exhausted or requeued:
+            self.logger.warning(f"Reclaimed stale jobs: {requeued} requeued, {exhausted} failed")
+        return requeued, exhausted
+
+    def _submit(self, job_id):
+        """Hand a claimed job to the process pool."""
+        from models import ProcessingJob
+        db = self._db()
+        job = db.session.get(ProcessingJob, job_id)
+
+        input_path = os.path.join(self.app.config['UPLOAD_FOLDER'], job.filepath)
+        future = self._get_executor().submit(
+            run_processing_job, input_path, self.app.config['OUTPUT_FOLDER'], job_id, job_parameters(job)
+        )
+        self._in_flight[future] = job_id
+        self.logger.info(f"Job {job_id} dispatched (attempt {job.attempts})")
+
+    def _collect_finished(self):
+        """Record the outcome of every finished future."""
+        finished = [future for future in self._in_flight if future.done()]
+        pool_broken = False
+        for future in finished:
+            job_id = self._in_flight.pop(future)
+            try:
+                self._record_result(job_id, future.result())
+            except BrokenProcessPool:
+                # A pool process died (e.g. OOM kill); put the job back in the queue
+                pool_broken = True
+                self._release_job(job_id, 'Error: processing worker crashed')
+            except Exception as e:
+                self._record_result(job_id, {'status': 'error', 'log': f"Error: {str(e)}"})
+
+        if pool_broken:
+            self._shutdown_executor()
+
+    def _record_result(self, job_id, result):
+        """Store the processor result, unless the job was reclaimed meanwhile."""
+        from models import ProcessingJob
+        db = self._db()
+        job = db.session.get(ProcessingJob, job_id)
+        if job is None or job.status != 'processing' or job.worker_id != self.worker_id:
+            self.logger.warning(f"Job {job_id} no longer owned by {self.worker_id}; discarding result")
+            return
+
+        if result.get('status') == 'success':
+            job.status = 'completed'
+            job.output_files = result['output_files']
+            job.stage_report = json.dumps(result.get('stages', {}))
+            job.statistics = json.dumps(result.get('statistics', {}))
+        else:
+            job.status = 'failed'
+        if result.get('metrics'):
+            job.stage_metrics = json.dumps(result['metrics'])
+        job.processing_log = result.get('log')
+        job.completed_at = datetime.utcnow()
+        job.heartbeat_at = None
+        db.session.commit()
+        self.logger.info(f"Job {job_id} {job.status}")
+        self._observe_result(job, result)
+
+        if job.status == 'completed' and job.cache_key:
+            try:
+                self.app.extensions['result_cache'].store(
+                    job.cache_key, job_id, self.app.config['OUTPUT_FOLDER'], job.output_files, job.processing_log,
+                    statistics=job.statistics
+                )
+            except Exception as e:
+                # The job itself succeeded; a cache failure only costs a future recompute
+                self.logger.error(f"Could not cache result of job {job_id}: {str(e)}")
+                db.session.rollback()
+
+    def _observe_result(self, job, result):
+        """Update the job, stage and stage cache metrics with a finished job."""
+        JOBS.inc(status=job.status)
+        if job.started_at is not None:
+            JOB_DURATION.observe((job.completed_at - job.started_at).total_seconds(), status=job.status)
+            if job.created_at is not None:
+                JOB_QUEUE_WAIT.observe(max((job.started_at - job.created_at).total_seconds(), 0))
+        observe_stage_metrics(result.get('metrics'))
+        for outcome in (result.get('stages') or {}).values():
+            if outcome in ('reused', 'computed'):
+                CACHE_REQUESTS.inc(cache='stage', outcome='hit' if outcome == 'reused' else 'miss')
+
+    def _release_job(self, job_id, message):
+        """Return a job to the queue, or fail it once it has used all attempts."""
+        from models import ProcessingJob
+        db = self._db()
+        job = db.session.get(ProcessingJob, job_id)
+        if job is None or job.worker_id != self.worker_id:
+            return
+
+        if (job.attempts or 0) >= self.max_attempts:
+            job.status = 'failed'
+            job.processing_log = message
+        else:
+            job.status = 'pending'
+        JOBS.inc(status='failed' if job.status == 'failed' else 'retried')
+        job.worker_id = None
+        job.heartbeat_at = None
+        db.session.commit()
+
+    def _heartbeat(self, now):
+        """Refresh heartbeat_at for every job this worker is running."""
+        from sqlalchemy import update
+        from models import ProcessingJob
+        self._last_heartbeat = now
+        if not self._in_flight:
+            return
+        db = self._db()
+        db.session.execute(
+            update(ProcessingJob)
+            .where(ProcessingJob.id.in_(list(self._in_flight.values())), ProcessingJob.worker_id == self.worker_id)
+            .values(heartbeat_at=now)
+        )
+        db.session.commit()
+
+    def _get_executor(self):
+        if self._executor is None:
+            # 'spawn' keeps pool processes free of the parent's database connections and threads
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=warm_up_process if WORKER_WARMUP else None,
+            )
+        return self._executor
+
+    def _prestart(self):
+        """Start (and warm up) every pool process now instead of at the first jobs."""
+        executor = self._get_executor()
+        for _ in range(self.max_workers):
+            # While no process is idle, each submission spawns another one
+            executor.submit(int)
+
+    def _shutdown_executor(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _db(self):
+        return self.app.extensions['sqlalchemy']
+
+
+if __name__ == '__main__':
+    from app import app
+
+    if METRICS_PORT:
+        import metrics
+        metrics.serve(int(METRICS_PORT))
+    pool = JobWorkerPool(app)
+    try:
+        pool.run_forever()
+    except KeyboardInterrupt:
+        pool.stop(wait=False)